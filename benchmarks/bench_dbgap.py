@@ -0,0 +1,23 @@
+import pytest
+
+from ddent.dbgap import transform_to_codesystem
+
+import synthetic
+
+@pytest.fixture(scope="module")
+def data_dictionary(tmp_path_factory):
+    path = tmp_path_factory.mktemp("dbgap") / "phs000001.v1.pht000001.v1.Synthetic.data_dict.xml"
+    path.write_bytes(synthetic.data_dictionary_xml("pht000001.v1", "phs000001.v1.p1", 50000, seed=19))
+    return str(path)
+
+@pytest.mark.benchmark(group="dbgap")
+def bench_transform_to_codesystem_50k(benchmark, per_item, data_dictionary):
+    per_item(50000)
+    codesystem = benchmark(transform_to_codesystem, data_dictionary, "Synthetic", "Synthetic table")
+    assert codesystem['count'] == 50000
+
+@pytest.mark.benchmark(group="dbgap")
+def bench_transform_to_codesystem_50k_extras(benchmark, per_item, data_dictionary):
+    per_item(50000)
+    codesystem = benchmark(transform_to_codesystem, data_dictionary, "Synthetic", "Synthetic table", add_extras=True)
+    assert codesystem['concept'][0]['coded_values'][1]['display'] == "Yes"
@@ -0,0 +1,36 @@
+import pytest
+
+import ddent.terminologies
+from ddent.ddent import transform_dd_codesystem
+
+import synthetic
+
+@pytest.fixture(scope="module")
+def study():
+    # 4 tables of 2,500 variables, a quarter of which reuse a definition
+    return [synthetic.codesystem(f"pht{table:06d}.v1", 2500, seed=table, reuse=0.25) for table in range(4)]
+
+def reset_terminologies():
+    for system in ddent.terminologies._external_systems:
+        system.codes = {}
+        system.pending = []
+
+def transform(study, **kwargs):
+    return transform_dd_codesystem("phs000001.v1.p1", "Synthetic", "Synthetic study", study, synthetic.SyntheticClamp(), synthetic.StubFhir(), **kwargs)
+
+@pytest.mark.benchmark(group="transform_dd_codesystem")
+def bench_transform_dd_codesystem(benchmark, per_item, study):
+    per_item(sum(codesystem['count'] for codesystem in study))
+    output = benchmark.pedantic(transform, args=(study,), setup=reset_terminologies, rounds=5)
+    assert output.conceptmap['dd'] is not None
+
+@pytest.mark.benchmark(group="transform_dd_codesystem")
+def bench_transform_dd_codesystem_lean(benchmark, per_item, study):
+    per_item(sum(codesystem['count'] for codesystem in study))
+    benchmark.pedantic(transform, args=(study,), kwargs={"lean": True}, setup=reset_terminologies, rounds=5)
+
+@pytest.mark.benchmark(group="transform_dd_codesystem")
+def bench_transform_dd_codesystem_deferred(benchmark, per_item, study):
+    """Codes are identified in one pass after NLP, rather than as they're matched"""
+    per_item(sum(codesystem['count'] for codesystem in study))
+    benchmark.pedantic(transform, args=(study,), kwargs={"defer_resolution": True}, setup=reset_terminologies, rounds=5)
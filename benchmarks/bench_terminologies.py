@@ -0,0 +1,54 @@
+import pytest
+
+from ddent.nlp import NlpResult
+from ddent.terminologies import match_terms, parse_cui_field, make_cui_valueset, _systems_by_name
+
+import synthetic
+
+@pytest.fixture(scope="module")
+def clamp_results():
+    # 10k CUI fields, drawn from 500 distinct ones
+    return [{"CUI": field} for field in synthetic.cui_fields(10000, distinct=500, seed=18)]
+
+def match_all(clamp_results, resolve):
+    for result in clamp_results:
+        match_terms(result, "source text", resolve=resolve)
+
+@pytest.mark.benchmark(group="match_terms")
+def bench_match_terms(benchmark, per_item, clamp_results):
+    """Repeated fields are served from parse_cui_field's memo"""
+    per_item(len(clamp_results))
+    benchmark(match_all, clamp_results, False)
+
+@pytest.mark.benchmark(group="match_terms")
+def bench_match_terms_unmemoized(benchmark, per_item, clamp_results):
+    per_item(len(clamp_results))
+    benchmark.pedantic(match_all, args=(clamp_results, False), setup=parse_cui_field.cache_clear, rounds=20)
+
+@pytest.mark.benchmark(group="match_terms")
+def bench_match_terms_resolved(benchmark, per_item, clamp_results):
+    """Codes are identified as they are matched (against the stub display source)"""
+    per_item(len(clamp_results))
+    benchmark(match_all, clamp_results, True)
+
+def umls_catalog(count):
+    system = _systems_by_name["UMLS"]
+    for i in range(count):
+        cui = f"C{i:07d}"
+        system.add_concept(cui, {"system": system.url, "code": cui, "display": f"Concept {cui}"})
+    return system
+
+@pytest.mark.benchmark(group="codesystem")
+def bench_get_codesystem_100k(benchmark, per_item):
+    system = umls_catalog(100000)
+    per_item(100000)
+    codesystem = benchmark(system.get_codesystem)
+    assert codesystem['count'] == 100000
+
+@pytest.mark.benchmark(group="codesystem")
+def bench_make_cui_valueset_100k(benchmark, per_item):
+    system = umls_catalog(100000)
+    cuivars = {system.url: {cui: NlpResult(concept, 0, 4, "some source text") for cui, concept in system.codes.items()}}
+    per_item(100000)
+    valueset = benchmark(make_cui_valueset, cuivars, "http://synthetic/ValueSet/CUI/bench", "bench", "Benchmark", "Benchmark")
+    assert len(valueset['compose']['include'][0]['concept']) == 100000
@@ -0,0 +1,52 @@
+"""
+Fixtures shared by the benchmarks. Nothing here touches the network: the
+terminology lookups are replaced with local stubs and the NLP and display
+caches are disabled so every round does the same work.
+"""
+
+import pytest
+
+import ddent.terminologies
+import ddent.display_cache
+import ddent.nlp.cache
+
+import synthetic
+
+@pytest.fixture(autouse=True)
+def offline_terminologies(monkeypatch):
+    """Identify codes with the synthetic display source and start each
+    benchmark with empty terminologies"""
+    monkeypatch.setattr(ddent.display_cache, "_display_cache", None)
+    monkeypatch.setattr(ddent.nlp.cache, "_nlp_cache", None)
+    monkeypatch.setattr(ddent.terminologies, "_push_threshold", None)
+
+    for system in ddent.terminologies._external_systems:
+        monkeypatch.setattr(system, "display_source", synthetic.display_source(system.url))
+        monkeypatch.setattr(system, "bulk_source", None)
+        monkeypatch.setattr(system, "rate_limit", None)
+        monkeypatch.setattr(system, "codes", {})
+        monkeypatch.setattr(system, "pending", [])
+    ddent.terminologies.parse_cui_field.cache_clear()
+    yield ddent.terminologies._external_systems
+
+# (benchmark name, items per round, median seconds per round)
+_per_item = []
+
+@pytest.fixture
+def per_item(request, benchmark):
+    """Call with the number of items (fields, codes, variables...) each round
+    processes and the median time per item is reported after the run"""
+    def record(items):
+        benchmark.extra_info['items'] = items
+    yield record
+
+    if 'items' in benchmark.extra_info and benchmark.stats is not None:
+        median = benchmark.stats.stats.median
+        benchmark.extra_info['per_item_us'] = median / benchmark.extra_info['items'] * 1e6
+        _per_item.append((request.node.name, benchmark.extra_info['items'], median))
+
+def pytest_terminal_summary(terminalreporter):
+    if len(_per_item) > 0:
+        terminalreporter.section("time per item (median)")
+        for name, items, median in sorted(_per_item):
+            terminalreporter.write_line(f"{name:<48} {median / items * 1e6:>10.2f} us  ({items} per round)")
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+"""
+End-to-end scale test: runs complete dbGaP ingests (the same steps as
+scripts/ingest_dbgap_table) against synthetic studies served by the local
+stand-ins in standins.py, and reports variables/sec, peak RSS and the time
+spent in each stage for each study size.
+
+Every size gets fresh stand-ins and is ingested in a fresh process so that
+the peak RSS belongs to that size alone. The stage times are summed across
+threads, so with concurrency they can add up to more than the wall time.
+
+    python benchmarks/scale.py --variables 1000 10000 100000 --clamp-latency 0.02
+"""
+
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+from collections import defaultdict
+from contextlib import redirect_stdout
+from pathlib import Path
+from threading import Lock
+from urllib.parse import urlsplit
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from requests.adapters import HTTPAdapter
+
+import standins
+
+# The hosts behind each of the stand-ins
+_service_hosts = {
+    "dbgap": ["ftp.ncbi.nlm.nih.gov", "www.ncbi.nlm.nih.gov"],
+    "terminology": ["utslogin.nlm.nih.gov", "uts-ws.nlm.nih.gov", "rxnav.nlm.nih.gov", "data.bioontology.org"]
+}
+
+class RerouteAdapter(HTTPAdapter):
+    """Sends requests for the real services to the stand-ins instead"""
+    def __init__(self, routes, **kwargs):
+        self.routes = routes            # host => http://127.0.0.1:port
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        if url.hostname in self.routes:
+            request.url = url._replace(scheme="http", netloc=self.routes[url.hostname]).geturl()
+        return super().send(request, **kwargs)
+
+def reroute(session, routes):
+    current = session.get_adapter("https://")
+    adapter = RerouteAdapter(routes, pool_connections=current._pool_connections, pool_maxsize=current._pool_maxsize, max_retries=current.max_retries)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+class StandInFhir:
+    """Just enough of a FHIR client for the ingest to load into the stand-in"""
+    def __init__(self, base_url):
+        from ddent.sessions import pooled_session
+        self.base_url = base_url
+        self.session = pooled_session()
+
+    def _result(self, response):
+        return {"status_code": response.status_code, "response": response.json()}
+
+    def load(self, resource_type, resource):
+        return self._result(self.session.post(f"{self.base_url}/{resource_type}", json=resource))
+
+    def post(self, path, data):
+        return self._result(self.session.post(f"{self.base_url}/{path}", json=data))
+
+    def patch(self, resource_type, id, ops):
+        return self._result(self.session.patch(f"{self.base_url}/{resource_type}/{id}", data=json.dumps(ops),
+                                                headers={"Content-Type": "application/json-patch+json"}))
+
+class StageTimes:
+    def __init__(self):
+        self.lock = Lock()
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+
+    def wrap(self, stage, owner, name):
+        """Replace owner.name with a version that adds its time to stage"""
+        original = getattr(owner, name)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with self.lock:
+                    self.seconds[stage] += elapsed
+                    self.calls[stage] += 1
+        setattr(owner, name, timed)
+
+def instrument():
+    import ddent.jobs
+    import ddent.ddent
+    import ddent.loaders
+    import ddent.conceptmaps
+    import ddent.terminologies
+
+    stages = StageTimes()
+    stages.wrap("dbgap listing", ddent.jobs, "extract_xmls_for_id")
+    stages.wrap("dbgap download", ddent.jobs, "transform_to_codesystem")
+    stages.wrap("transform (total)", ddent.jobs, "transform_dd_codesystem")
+    stages.wrap("nlp", ddent.ddent, "extract_cuis")
+    stages.wrap("terminology lookups", ddent.terminologies.ExternalSystem, "lookup")
+    stages.wrap("deferred resolution", ddent.ddent, "resolve_concepts")
+    stages.wrap("terminology push", ddent.ddent, "push_changes")
+    stages.wrap("conceptmaps", ddent.conceptmaps.ConceptMapWriter, "add_element")
+    stages.wrap("conceptmaps", ddent.conceptmaps.ConceptMapWriter, "close")
+    stages.wrap("fhir load", ddent.loaders, "load_resource")
+    stages.wrap("fhir load", ddent.loaders.BundleLoader, "send")
+    return stages
+
+def run_ingest(study_specs, ports, options, results):
+    """Runs in its own process: ingest each of the studies and put the report on results"""
+    from ddent.bioportal import BioPortalClient
+    from ddent.jobs import JobQueue, run_batch
+    from ddent.loaders import UploadExecutor
+    from ddent.nlm import NlmClient
+    from ddent.nlp import get_extraction_modules, get_nlp
+    import ddent.dbgap
+
+    routes = {}
+    for service, hosts in _service_hosts.items():
+        for host in hosts:
+            routes[host] = f"127.0.0.1:{ports[service]}"
+    reroute(ddent.dbgap._session, routes)
+    reroute(NlmClient("standin").session, routes)
+    reroute(BioPortalClient("standin").session, routes)
+
+    if not options['rate_limits']:
+        # The stand-ins aren't UTS, so there's no need to be polite to them
+        import ddent.terminologies
+        for system in ddent.terminologies._external_systems:
+            system.rate_limit = None
+
+    stages = instrument()
+    fhir = StandInFhir(f"http://127.0.0.1:{ports['fhir']}/fhir")
+    uploader = None
+    if options['upload_workers'] > 0:
+        uploader = UploadExecutor(fhir, workers=options['upload_workers'])
+
+    with tempfile.TemporaryDirectory() as workdir, open(os.devnull, 'wt') as devnull:
+        with redirect_stdout(devnull):
+            get_extraction_modules({"CLAMP": {"endpoint": [f"http://127.0.0.1:{port}" for port in ports['clamp']]}})
+            nlp = get_nlp()
+
+            queue = JobQueue(str(Path(workdir) / "queue.db"))
+            for accession in study_specs:
+                queue.add_study(accession, f"Synthetic study {accession}")
+
+            start = time.perf_counter()
+            variables = run_batch(queue, nlp, fhir,
+                                  workers=options['workers'],
+                                  download_workers=options['download_workers'],
+                                  nlp_workers=options['nlp_workers'],
+                                  nlp_batch_size=options['nlp_batch_size'],
+                                  defer_resolution=options['defer_resolution'],
+                                  bundle=options['bundle'],
+                                  lean=options['lean'],
+                                  uploader=uploader)
+            elapsed = time.perf_counter() - start
+            if uploader is not None:
+                uploader.shutdown()
+        failures = queue.failures()
+
+    results.put({
+        "variables": variables,
+        "seconds": elapsed,
+        "variables_per_second": variables / elapsed if elapsed > 0 else 0.0,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "stages": dict(stages.seconds),
+        "calls": dict(stages.calls),
+        "failures": failures
+    })
+
+def run_size(variable_count, args):
+    """Ingest variable_count variables (split across args.studies studies)"""
+    study_specs = {}
+    for number in range(1, args.studies + 1):
+        accession = f"phs{number:06d}.v1.p1"
+        count = variable_count // args.studies + (1 if number <= variable_count % args.studies else 0)
+        study_specs[accession] = {"tables": args.tables, "variable_count": count, "reuse": args.reuse, "seed": number}
+
+    latencies = {
+        "dbgap": args.dbgap_latency,
+        "clamp": args.clamp_latency,
+        "terminology": args.terminology_latency,
+        "fhir": args.fhir_latency
+    }
+    options = {
+        "workers": args.workers,
+        "download_workers": args.download_workers,
+        "nlp_workers": args.nlp_workers,
+        "nlp_batch_size": args.nlp_batch_size,
+        "upload_workers": args.upload_workers,
+        "defer_resolution": args.defer_resolution,
+        "bundle": args.bundle,
+        "lean": args.lean,
+        "rate_limits": args.rate_limits
+    }
+
+    ports, server = standins.start(study_specs, latencies, clamp_instances=args.clamp_instances, clamp_capacity=args.clamp_capacity)
+    try:
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        ingest = context.Process(target=run_ingest, args=(study_specs, ports, options, results))
+        ingest.start()
+        report = results.get()
+        ingest.join()
+    finally:
+        server.terminate()
+    return report
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Run complete ingests of synthetic studies against local stand-ins for CLAMP, UTS, RxNav, BioPortal, dbGaP and FHIR")
+    parser.add_argument("--variables", type=int, nargs="+", default=[1000, 10000, 100000], help="Total number of variables to ingest for each run")
+    parser.add_argument("--studies", type=int, default=1, help="Number of studies the variables are split across")
+    parser.add_argument("--tables", type=int, default=10, help="Number of tables in each study")
+    parser.add_argument("--reuse", type=float, default=0.3, help="Fraction of the variables whose definition repeats one used earlier in the study")
+    parser.add_argument("--clamp-latency", type=float, default=0.0, help="Seconds the CLAMP stand-in waits before responding")
+    parser.add_argument("--clamp-instances", type=int, default=1, help="Number of CLAMP stand-ins the requests are spread across")
+    parser.add_argument("--clamp-capacity", type=int, help="Requests each CLAMP stand-in works on at once (unlimited by default)")
+    parser.add_argument("--terminology-latency", type=float, default=0.0, help="Seconds the UTS/RxNav/BioPortal stand-in waits before responding")
+    parser.add_argument("--fhir-latency", type=float, default=0.0, help="Seconds the FHIR stand-in waits before responding")
+    parser.add_argument("--dbgap-latency", type=float, default=0.0, help="Seconds the dbGaP stand-in waits before responding")
+    parser.add_argument("--workers", type=int, default=1, help="Number of studies ingested concurrently")
+    parser.add_argument("--download-workers", type=int, default=4)
+    parser.add_argument("--nlp-workers", type=int, default=4)
+    parser.add_argument("--nlp-batch-size", type=int, help="Number of definitions packed into each NLP request (by default, the module's own batch size)")
+    parser.add_argument("--upload-workers", type=int, default=4)
+    parser.add_argument("--defer-resolution", action="store_true")
+    parser.add_argument("--bundle", choices=["transaction", "batch"])
+    parser.add_argument("--lean", action="store_true", help="Leave the comments out of the ConceptMaps")
+    parser.add_argument("--rate-limits", action="store_true", help="Keep the production rate limits on the terminology lookups (which will dominate the run)")
+    parser.add_argument("--json", type=str, help="Also write the reports to this file")
+    args = parser.parse_args()
+
+    reports = {}
+    for variable_count in args.variables:
+        print(f"Ingesting {variable_count} variables...")
+        report = run_size(variable_count, args)
+        reports[variable_count] = report
+
+        print(f"  {report['variables']} variables in {report['seconds']:.1f}s: {report['variables_per_second']:.1f} variables/s, peak RSS {report['peak_rss_mb']:.0f}MB")
+        for stage, seconds in sorted(report['stages'].items(), key=lambda item: -item[1]):
+            print(f"    {stage:<22} {seconds:>9.2f}s")
+        for accession, error in report['failures']:
+            print(f"  FAILED {accession}: {error}")
+
+    if args.json is not None:
+        with open(args.json, 'wt') as f:
+            json.dump(reports, f, indent=2)
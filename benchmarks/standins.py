@@ -0,0 +1,244 @@
+"""
+Local stand-ins for the remote services an ingest depends on, for running
+complete ingests at scale without the network.
+
+    dbgap        - The dbGaP FTP listings, data dictionaries and dataset pages
+    clamp        - CLAMP's /getJson API
+    terminology  - UTS (tickets and CUI names), RxNav and BioPortal
+    fhir         - A FHIR server that accepts (and forgets) everything
+
+Each service is its own HTTP/1.1 server that waits latency seconds before
+answering every request. CLAMP can be run as several instances, each of
+which only works on capacity requests at a time (the rest queue), like a
+real CLAMP server with a fixed number of pipeline threads. start() runs them all in a separate process, so
+they don't compete with the ingest being measured, and returns the port for
+each service along with the process to terminate when done.
+"""
+
+import json
+import multiprocessing
+import re
+import socket
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from itertools import count
+from threading import BoundedSemaphore, Thread
+from urllib.parse import urlsplit, parse_qs
+
+import synthetic
+
+_owl_class = "http://www.w3.org/2002/07/owl#Class"
+_snomed_class_prefix = "http://purl.bioontology.org/ontology/SNOMEDCT/"
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, routes, latency=0.0, capacity=None):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.routes = [(method, re.compile(pattern), handler) for method, pattern, handler in routes]
+        self.latency = latency
+        self.capacity = None if capacity is None else BoundedSemaphore(capacity)
+        self.requests = 0
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # Otherwise the small responses sit waiting on delayed ACKs
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, body, content_type="application/json"):
+        if not isinstance(body, (bytes, str)):
+            body = json.dumps(body)
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length > 0 else b""
+
+    def dispatch(self, method):
+        self.server.requests += 1
+        if self.server.capacity is not None:
+            with self.server.capacity:
+                return self.route(method)
+        return self.route(method)
+
+    def route(self, method):
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+
+        url = urlsplit(self.path)
+        for route_method, pattern, handler in self.server.routes:
+            match = pattern.fullmatch(url.path)
+            if route_method == method and match:
+                status, body, *content_type = handler(self, match, parse_qs(url.query))
+                return self.respond(status, body, *content_type)
+        self.respond(404, {"error": f"No stand-in for {method} {url.path}"})
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_PUT(self):
+        self.dispatch("PUT")
+
+    def do_PATCH(self):
+        self.dispatch("PATCH")
+
+def dbgap_routes(studies):
+    """studies is {accession: [SyntheticTable]}"""
+    def filename(accession, table):
+        return f"{accession.rsplit('.', 1)[0]}.{table.table_id}.{accession.rsplit('.', 1)[1]}.{table.name}.data_dict.xml"
+
+    def listing(handler, match, query):
+        accession = match.group(2)
+        if accession not in studies:
+            return 404, "Not Found", "text/html"
+        anchors = "\n".join(f'<a href="{filename(accession, table)}">{filename(accession, table)}</a>' for table in studies[accession])
+        return 200, f"<html><body><pre>\n{anchors}\n</pre></body></html>", "text/html"
+
+    def dictionary(handler, match, query):
+        accession = match.group(2)
+        for table in studies.get(accession, []):
+            if filename(accession, table) == match.group(3):
+                return 200, table.xml, "application/xml"
+        return 404, "Not Found", "text/html"
+
+    def dataset_page(handler, match, query):
+        accession = query.get('study_id', [""])[0]
+        pht = int(query.get('pht', ["0"])[0])
+        for table in studies.get(accession, []):
+            if table.number == pht:
+                return 200, f"""<html><body>
+<b>Dataset Name</b>: {table.name}<br/>
+<dl>
+<dt>Dataset Description</dt>
+<dd>
+<p>{table.description}</p>
+</dd>
+</dl>
+</body></html>""", "text/html"
+        return 404, "Not Found", "text/html"
+
+    return [
+        ("GET", r"/dbgap/studies/([^/]+)/([^/]+)/pheno_variable_summaries/", listing),
+        ("GET", r"/dbgap/studies/([^/]+)/([^/]+)/pheno_variable_summaries/+([^/]+)", dictionary),
+        ("GET", r"/projects/gap/cgi-bin/dataset.cgi", dataset_page)
+    ]
+
+def clamp_routes():
+    def get_json(handler, match, query):
+        text = query.get('text', [""])[0]
+        return 200, {"Results": synthetic.clamp_payload(text)}
+
+    return [("GET", r"/getJson", get_json)]
+
+def terminology_routes():
+    tickets = count(1)
+
+    def tgt(handler, match, query):
+        handler.body()
+        return 201, '<form action="https://utslogin.nlm.nih.gov/cas/v1/api-key/TGT-standin-1" method="POST"></form>', "text/html"
+
+    def service_ticket(handler, match, query):
+        handler.body()
+        return 200, f"ST-standin-{next(tickets)}", "text/plain"
+
+    def cui(handler, match, query):
+        return 200, {"result": {"ui": match.group(1), "name": f"Concept {match.group(1)}"}}
+
+    def rxnorm(handler, match, query):
+        return 200, {"idGroup": {"rxnormId": [match.group(1)], "name": f"Drug {match.group(1)}"}}
+
+    def snomed(handler, match, query):
+        return 200, {"@id": f"{_snomed_class_prefix}{match.group(1)}", "prefLabel": f"Finding {match.group(1)}"}
+
+    def snomed_batch(handler, match, query):
+        request = json.loads(handler.body())
+        classes = []
+        for item in request[_owl_class]['collection']:
+            term = item['class'].split("/")[-1]
+            classes.append({"@id": item['class'], "prefLabel": f"Finding {term}"})
+        return 200, {_owl_class: classes}
+
+    return [
+        ("POST", r"/cas/v1/api-key", tgt),
+        ("POST", r"/cas/v1/tickets/([^/]+)", service_ticket),
+        ("GET", r"/rest/content/current/CUI/([^/]+)", cui),
+        ("GET", r"/REST/rxcui/([^/]+)\.json", rxnorm),
+        ("GET", r"/ontologies/SNOMEDCT/classes/([^/]+)", snomed),
+        ("POST", r"/batch", snomed_batch)
+    ]
+
+def fhir_routes():
+    ids = count(1)
+
+    def create(handler, match, query):
+        resource = json.loads(handler.body())
+        resource['id'] = str(next(ids))
+        return 201, resource
+
+    def bundle(handler, match, query):
+        request = json.loads(handler.body())
+        entries = []
+        for entry in request.get('entry', []):
+            resource_type = entry['resource']['resourceType']
+            entries.append({"response": {"status": "201 Created", "location": f"{resource_type}/{next(ids)}/_history/1"}})
+        return 200, {"resourceType": "Bundle", "type": f"{request.get('type', 'batch')}-response", "entry": entries}
+
+    def patch(handler, match, query):
+        handler.body()
+        return 200, {"resourceType": match.group(1), "id": match.group(2)}
+
+    def search(handler, match, query):
+        return 200, {"resourceType": "Bundle", "type": "searchset", "total": 0, "entry": []}
+
+    return [
+        ("POST", r"/fhir/?", bundle),
+        ("POST", r"/fhir/([A-Za-z]+)", create),
+        ("PUT", r"/fhir/([A-Za-z]+)(/[^/]+)?", create),
+        ("PATCH", r"/fhir/([A-Za-z]+)/([^/]+)", patch),
+        ("GET", r"/fhir/([A-Za-z]+)", search)
+    ]
+
+def _serve(study_specs, latencies, ports, clamp_instances, clamp_capacity):
+    studies = {accession: synthetic.study(accession, **spec) for accession, spec in study_specs.items()}
+    servers = {
+        "dbgap": StandInServer(dbgap_routes(studies), latencies.get("dbgap", 0.0)),
+        "terminology": StandInServer(terminology_routes(), latencies.get("terminology", 0.0)),
+        "fhir": StandInServer(fhir_routes(), latencies.get("fhir", 0.0))
+    }
+    clamp = [StandInServer(clamp_routes(), latencies.get("clamp", 0.0), capacity=clamp_capacity) for instance in range(clamp_instances)]
+    for server in list(servers.values()) + clamp:
+        Thread(target=server.serve_forever, daemon=True).start()
+
+    service_ports = {name: server.server_address[1] for name, server in servers.items()}
+    service_ports["clamp"] = [server.server_address[1] for server in clamp]
+    ports.put(service_ports)
+
+    while True:
+        time.sleep(3600)
+
+def start(study_specs, latencies, clamp_instances=1, clamp_capacity=None):
+    """Start the stand-ins in their own process. study_specs is {accession:
+    keyword arguments for synthetic.study} and latencies is {service: seconds}.
+    Returns (ports, process), where ports is {service: port}, except for
+    clamp, which is the list of ports for each of its instances"""
+    context = multiprocessing.get_context("spawn")
+    ports = context.Queue()
+    process = context.Process(target=_serve, args=(study_specs, latencies, ports, clamp_instances, clamp_capacity), daemon=True)
+    process.start()
+    return ports.get(timeout=60), process
@@ -0,0 +1,166 @@
+"""
+Deterministic synthetic data for the benchmarks.
+
+Everything here is generated from a seeded random.Random (or, for the NLP
+payloads, from a hash of the text itself) so that every run sees exactly the
+same data dictionaries, CUI fields and NLP results.
+"""
+
+import random
+import zlib
+from xml.sax.saxutils import escape
+
+from ddent.nlp.nlp_clamp import NlpClamp
+
+WORDS = ["age", "blood", "pressure", "systolic", "diastolic", "heart", "rate",
+         "diabetes", "mellitus", "type", "insulin", "glucose", "fasting",
+         "cholesterol", "smoking", "status", "current", "former", "never",
+         "asthma", "inhaler", "medication", "dose", "daily", "weight", "height",
+         "body", "mass", "index", "visit", "baseline", "follow-up", "year",
+         "participant", "reported", "history", "of", "myocardial", "infarction",
+         "stroke", "cancer", "breast", "lung", "alcohol", "use", "per", "week",
+         "hemoglobin", "creatinine", "kidney", "disease", "chronic", "aspirin",
+         "metformin", "statin", "depression", "anxiety", "sleep", "hours"]
+
+SEMANTICS = ["T047", "T121", "T033", "T184", "T059", "T201", "T109"]
+
+def definition(rng, min_words=4, max_words=24):
+    return " ".join(rng.choice(WORDS) for i in range(rng.randint(min_words, max_words)))
+
+def cui_field(rng):
+    """A CUI field as returned by CLAMP: the UMLS CUI, usually with SNOMED
+    codes and occasionally RxNorm/Generic codes (and the odd null)"""
+    parts = [f"C{rng.randint(0, 99999):07d}"]
+    if rng.random() < 0.6:
+        parts.append("SNOMEDCT_US[" + ",".join(str(rng.randint(10**5, 10**9)) for i in range(rng.randint(1, 3))) + "]")
+    if rng.random() < 0.15:
+        parts.append(f"RxNorm=[{rng.randint(1000, 999999)}]")
+    if rng.random() < 0.1:
+        parts.append(f"Generic=[{rng.randint(1000, 999999)}]")
+    if rng.random() < 0.1:
+        parts.insert(0, "null")
+    return ",".join(parts)
+
+def cui_fields(count, distinct=None, seed=0):
+    """count CUI fields drawn from distinct different ones. Real studies see
+    the same handful of concepts over and over"""
+    rng = random.Random(seed)
+    pool = [cui_field(rng) for i in range(distinct or count)]
+    return [rng.choice(pool) for i in range(count)]
+
+def clamp_payload(text):
+    """The Results that CLAMP's /getJson would return for text, roughly one
+    concept for every five words"""
+    rng = random.Random(zlib.crc32(text.encode("utf-8")))
+    results = []
+    for i in range(len(text.split()) // 5 + rng.randint(0, 1)):
+        start = rng.randint(0, max(len(text) - 10, 0))
+        results.append({
+            "CUI": cui_field(rng),
+            "Location_Start": start,
+            "Location_End": min(start + rng.randint(3, 20), len(text)),
+            "Semantics": rng.choice(SEMANTICS),
+            "Assertion": rng.choice(["present", "absent", None]),
+            "Entity": "problem",
+            "Concept_Prob": round(rng.random(), 3)
+        })
+    return results
+
+def display_source(system_url):
+    """Stand in for the UMLS/BioPortal/RxNav name lookups"""
+    def display(cui, source):
+        return {
+            "system": system_url,
+            "code": cui,
+            "display": f"Concept {cui}"
+        }
+    return display
+
+class SyntheticClamp(NlpClamp):
+    """CLAMP, minus the HTTP request"""
+    def __init__(self):
+        super().__init__({"CLAMP": {"endpoint": "synthetic"}})
+
+    def extract(self, text):
+        return clamp_payload(text)
+
+def variables(count, rng, reuse=0.0, prefix="phv", definitions=None):
+    """Variable dicts for a data dictionary. reuse is the fraction of the
+    definitions which repeat one that has already been used. Pass the same
+    definitions list for each table to reuse definitions across a study"""
+    if definitions is None:
+        definitions = []
+    result = []
+    for i in range(count):
+        if len(definitions) > 0 and rng.random() < reuse:
+            text = rng.choice(definitions)
+        else:
+            text = definition(rng)
+            definitions.append(text)
+        result.append({
+            "code": f"{prefix}{i:08d}.v1.p1",
+            "display": f"VAR_{i}",
+            "definition": text
+        })
+    return result
+
+def data_dictionary_xml(table_id, study_id, count, seed=0, reuse=0.0, table_vars=None):
+    """A dbGaP data_dict.xml for a table with count variables (or the
+    variables in table_vars)"""
+    if table_vars is None:
+        table_vars = variables(count, random.Random(seed), reuse=reuse, prefix=f"phv{seed:03d}")
+    lines = [f'<?xml version="1.0" encoding="UTF-8"?>',
+             f'<data_table id="{table_id}" study_id="{study_id}" participant_type="Subject" date_created="Mon Jan 1 00:00:00 2024">',
+             f'<description>Synthetic table {table_id}</description>']
+    for variable in table_vars:
+        lines.append(f'<variable id="{variable["code"]}"><name>{variable["display"]}</name>'
+                     f'<description>{escape(variable["definition"])}</description><type>integer</type>'
+                     f'<value code="0">No</value><value code="1">Yes</value></variable>')
+    lines.append('</data_table>')
+    return "\n".join(lines).encode("utf-8")
+
+def codesystem(table_id, count, seed=0, reuse=0.0):
+    """A DD CodeSystem like transform_to_codesystem would produce"""
+    rng = random.Random(seed)
+    concepts = variables(count, rng, reuse=reuse, prefix=f"phv{seed:03d}")
+    return {
+        "resourceType": "CodeSystem",
+        "url": f"http://synthetic/CodeSystems/DD/DbGAP/{table_id}",
+        "name": table_id,
+        "title": f"Synthetic table {table_id}",
+        "concept": concepts,
+        "count": len(concepts)
+    }
+
+class SyntheticTable:
+    def __init__(self, number, table_id, name, description, xml):
+        self.number = number
+        self.table_id = table_id
+        self.name = name
+        self.description = description
+        self.xml = xml
+
+def study(accession, tables, variable_count, reuse=0.0, seed=0):
+    """The tables for a dbGaP study with variable_count variables spread
+    evenly across them. reuse applies across the whole study, so a table's
+    definitions may repeat those of earlier tables"""
+    rng = random.Random(seed)
+    study_id = accession.split(".")[0]
+    definitions = []
+    result = []
+    for number in range(1, tables + 1):
+        count = variable_count // tables + (1 if number <= variable_count % tables else 0)
+        table_id = f"pht{seed * 1000 + number:06d}.v1"
+        table_vars = variables(count, rng, reuse=reuse, prefix=f"phv{seed:03d}{number:03d}", definitions=definitions)
+        xml = data_dictionary_xml(table_id, accession, count, table_vars=table_vars)
+        result.append(SyntheticTable(seed * 1000 + number, table_id, f"Synthetic_Table_{number}", f"Synthetic table {number} of {study_id}", xml))
+    return result
+
+class StubFhir:
+    """Accepts everything, as quickly as possible"""
+    def __init__(self):
+        self.loads = 0
+
+    def load(self, resource_type, resource):
+        self.loads += 1
+        return {"status_code": 201, "response": resource}
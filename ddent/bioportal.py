@@ -2,16 +2,30 @@
 
 This requires an apikey which must be provided by the application before use"""
 
-import requests
+
+from ddent.sessions import pooled_session
+from ddent.metrics import metrics
+
+_owl_class = "http://www.w3.org/2002/07/owl#Class"
+_snomed_ontology = "http://data.bioontology.org/ontologies/SNOMEDCT"
+_snomed_class_prefix = "http://purl.bioontology.org/ontology/SNOMEDCT/"
+
+# BioPortal doesn't publish a limit on the batch size, but this keeps the 
+# individual requests reasonable
+BATCH_SIZE = 100
 
 class BioPortal:
     def __init__(self, apikey):
         self.apikey = apikey
         self.auth_header = {"Authorization": f"apikey token={apikey}"}
+        self.session = pooled_session(headers=self.auth_header)
 
     def get_snomed(self, term, source):
         url = f"http://data.bioontology.org/ontologies/SNOMEDCT/classes/{term}"
-        response = requests.get(url, headers = self.auth_header)
+        with metrics().request("bioportal"):
+            response = self.session.get(url)
+        if response.status_code != 200:
+            metrics().incr("request_errors", service="bioportal")
 
         if response.status_code == 200:
             content = response.json()
@@ -22,6 +36,36 @@ class BioPortal:
                 "display": content['prefLabel']
             }
 
+    def get_snomed_batch(self, terms):
+        """Look up the labels for a list of SNOMED codes using BioPortal's batch
+        endpoint. Returns a dict of code => concept for the codes that were found"""
+        concepts = {}
+        for i in range(0, len(terms), BATCH_SIZE):
+            payload = {
+                _owl_class: {
+                    "collection": [{
+                        "class": f"{_snomed_class_prefix}{term}",
+                        "ontology": _snomed_ontology
+                    } for term in terms[i:i + BATCH_SIZE]],
+                    "display": "prefLabel"
+                }
+            }
+            with metrics().request("bioportal_batch"):
+                response = self.session.post("http://data.bioontology.org/batch", json=payload)
+
+            if response.status_code == 200:
+                for cls in response.json().get(_owl_class, []):
+                    term = cls['@id'].split("/")[-1]
+                    concepts[term] = {
+                        "system": "http://snomed.info/sct",
+                        "code": term,
+                        "display": cls['prefLabel']
+                    }
+            else:
+                metrics().incr("request_errors", service="bioportal_batch")
+                print(f"BioPortal batch request failed ({response.status_code}): {response.text}")
+        return concepts
+
 
 _biop = None
 def BioPortalClient(apikey=None):
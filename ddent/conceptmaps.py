@@ -0,0 +1,110 @@
+"""
+Streaming writer for large ConceptMaps.
+
+Rather than building the entire ConceptMap in memory before loading it, the
+elements are serialized one at a time into shard files on disk. Once a shard
+reaches max_bytes, it is closed and the remaining elements go into the next
+one. Shards are split between groups where possible, with a group that is too
+large to fit continuing (with the same source and target) in the next shard.
+
+When a map fits in a single shard, it keeps the original url. Otherwise each
+shard gets -1, -2, etc. appended to the url and name and (part N) appended to
+the title.
+
+If on_shard is given, it is called with the url and path of each shard as
+soon as the shard is closed, so it can be loaded (and removed) while the
+rest of the map is still being written.
+"""
+
+import json
+from pathlib import Path
+
+# Comfortably under the payload limits of the FHIR servers we load into
+DEFAULT_SHARD_SIZE = 16 * 1024 * 1024
+
+class ConceptMapWriter:
+    def __init__(self, header, directory, max_bytes=DEFAULT_SHARD_SIZE, on_shard=None):
+        """header is the ConceptMap minus its groups"""
+        self.header = {key: value for key, value in header.items() if key != 'group'}
+        self.directory = Path(directory)
+        # Leave room for the header (with its part number) and the closing brackets
+        self.max_bytes = max_bytes - len(json.dumps(self.header)) - 64
+        self.on_shard = on_shard
+
+        self.shards = []            # [(url, path)]
+        self.file = None
+        self.size = 0
+        self.group = None           # (source, target) of the group currently being written
+        self.groups_written = 0     # in the current shard
+        self.shard_elements = 0
+        self.group_elements = 0
+
+    def _write(self, text):
+        self.file.write(text)
+        self.size += len(text)
+
+    def _open_shard(self):
+        path = self.directory / f"{self.header['name']}-{len(self.shards) + 1}.json"
+        self.file = open(path, 'wt')
+        self.shards.append((None, path))
+        self.size = 0
+        self.group = None
+        self.groups_written = 0
+        self.shard_elements = 0
+        self.group_elements = 0
+        self._write('{"group": [')
+
+    def _close_shard(self, last):
+        """The header is written last, since we don't know the url until we
+        know whether there will be more than one shard"""
+        if self.group is not None:
+            self._write(']}')
+
+        header = dict(self.header)
+        part = len(self.shards)
+        if not (last and part == 1):
+            header['url'] = f"{header['url']}-{part}"
+            header['name'] = f"{header['name']}-{part}"
+            header['title'] = f"{header['title']} (part {part})"
+
+        self._write('], ' + json.dumps(header)[1:])
+        self.file.close()
+        self.file = None
+        self.shards[-1] = (header['url'], self.shards[-1][1])
+        if self.on_shard is not None:
+            self.on_shard(*self.shards[-1])
+
+    def add_element(self, source, target, element):
+        data = json.dumps(element)
+        if self.file is not None and self.shard_elements > 0 and self.size + len(data) > self.max_bytes:
+            self._close_shard(last=False)
+
+        if self.file is None:
+            self._open_shard()
+
+        if self.group != (source, target):
+            if self.group is not None:
+                self._write(']}')
+            separator = ", " if self.groups_written > 0 else ""
+            self._write(f'{separator}{{"source": {json.dumps(source)}, "target": {json.dumps(target)}, "element": [')
+            self.group = (source, target)
+            self.groups_written += 1
+            self.group_elements = 0
+
+        separator = ", " if self.group_elements > 0 else ""
+        self._write(separator + data)
+        self.group_elements += 1
+        self.shard_elements += 1
+
+    def close(self):
+        """Finish the last shard and return [(url, path)] for each of them. A
+        map without any elements still gets a (groupless) shard"""
+        if self.file is None and len(self.shards) == 0:
+            self._open_shard()
+        if self.file is not None:
+            self._close_shard(last=True)
+        return self.shards
+
+def load_shard(path):
+    with open(path, 'rt') as f:
+        return json.load(f)
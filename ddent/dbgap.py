@@ -1,13 +1,16 @@
 """This is just a simple function to pull the contents from the DbGAP FTP site (XML File) for a singular table
 and extract the contents into a CodeSystem suitable for ddent"""
 
-import pdb
 
 import re
 from bs4 import BeautifulSoup
 import requests
 import xml.etree.ElementTree
 from ddent import ddent_properties
+from ddent.sessions import pooled_session, HostLimits
+from ddent.mirror import dbgap_mirror
+from ddent.metrics import metrics
+from concurrent.futures import ThreadPoolExecutor
 
 ddregx = re.compile(r'.data_dict[0-9a-zA-Z_]*.xml')
 idregx = re.compile(r'phs[0-9]+.v[0-9]+.p[0-9]+')
@@ -15,58 +18,229 @@ tidregx = re.compile(r'.pht0*([0-9]+).')
 dstname = re.compile("<b>Dataset Name</b>: ([A-Za-z_0-9]+)<br/>")
 dstdesc = re.compile("<dt>Dataset Description</dt>\n<dd>\n<p>([\w\s\.]+)</p>")
 
-def extract_xmls_for_id(id):
+# Number of table pages/data dictionaries fetched at one time
+DEFAULT_WORKERS = 4
+
+# NCBI asks that clients without an API key stick to 3 requests per second 
+_host_limits = HostLimits(max_per_host=3, rate=3)
+_session = pooled_session(retries=3)
+
+def _fetch(url, **kwargs):
+    with _host_limits.slot(url):
+        with metrics().request("dbgap"):
+            response = _session.get(url, **kwargs)
+    if response.status_code >= 300:
+        metrics().incr("request_errors", service="dbgap")
+    return response
+
+def get(url, **kwargs):
+    """GET the url while respecting the per-host limits. Failures are retried
+    by the session. If a mirror has been opened, the response will come from 
+    the mirror whenever possible"""
+    mirror = dbgap_mirror()
+    if mirror is not None:
+        return mirror.get(url, _fetch)
+    return _fetch(url, **kwargs)
+
+def get_table_details(id, xml_url):
+    """Scrape the table's name and description from its dbGaP dataset page"""
+    study_id = id.split(".")[0]
+    table_name = study_id
+    table_desc = None
+
+    tid = tidregx.search(xml_url)
+    if tid:
+        tid = tid.groups()[0]
+        table_name = tid
+        table_page_url = f"https://www.ncbi.nlm.nih.gov/projects/gap/cgi-bin/dataset.cgi?study_id={id}&pht={tid}"
+        print(table_page_url)
+        try:
+            t_content = get(table_page_url)
+            if t_content.status_code == 200:
+
+                soup = BeautifulSoup(t_content.text, "html.parser")
+                for b in soup.find_all('b'):
+                    if b.text == 'Dataset Name':
+                        table_name = b.next_sibling.string.replace(": ", "")
+
+                for dt in soup.find_all('dt'):
+                    if dt.text == 'Dataset Description':
+                        table_desc = dt.find_next("p").text
+            print(f"\t{tid} - {table_name} | {table_desc}")
+        except:
+            print(f"There was a problem with getting the table name for table: {tid}")
+            pass
+    return (table_name, table_desc)
+
+def extract_xmls_for_id(id, workers=DEFAULT_WORKERS):
+    """Return {xml_url: (table_name, table_desc)} for each of the data dictionaries
+    in the study, in the order they are listed by dbGaP. The table pages are 
+    fetched concurrently"""
     study_id = id.split(".")[0]
     url = f"https://ftp.ncbi.nlm.nih.gov/dbgap/studies/{study_id}/{id}/pheno_variable_summaries/"
-    response = requests.get(url)
+    response = get(url)
     xmls = {}
-    table_desc = None
     if response.status_code == 200:
         page_content = BeautifulSoup(response.content, "html.parser")
+        xml_urls = []
         for anchor in page_content.find_all("a"):
             if ddregx.search(anchor.text) is not None:
-                xml = f"{url}/{anchor.text}"   
-                tid = tidregx.search(xml)
-                table_name = study_id
-                if tid:
-                    tid = tid.groups()[0]
-                    table_name = tid
-                    table_page_url = f"https://www.ncbi.nlm.nih.gov/projects/gap/cgi-bin/dataset.cgi?study_id={id}&pht={tid}"
-                    print(table_page_url)
-                    #pdb.set_trace()
-                    try:
-                        t_content = requests.get(table_page_url)
-                        if t_content.status_code == 200:
-
-                            soup = BeautifulSoup(t_content.text, "html.parser")
-                            for b in soup.find_all('b'):
-                                if b.text == 'Dataset Name':
-                                    table_name = b.next_sibling.string.replace(": ", "")
-
-                            for dt in soup.find_all('dt'):
-                                if dt.text == 'Dataset Description':
-                                    table_desc = dt.find_next("p").text
-                        print(f"\t{tid} - {table_name} | {table_desc}")
-                    except:
-                        print(f"There was a problem with getting the table name for table: {tid}")
-                        pass
-                        
-                xmls[xml] = (table_name, table_desc)
+                xml_urls.append(f"{url}/{anchor.text}")
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            details = executor.map(lambda xml_url: get_table_details(id, xml_url), xml_urls)
+            for xml_url, table_details in zip(xml_urls, details):
+                xmls[xml_url] = table_details
     return xmls
 
-def transform_to_codesystem(xml_url, tname=None, tdesc=None, codesystem=None, add_extras=False):
-    response = requests.get(xml_url)
+def parse_variable(var, add_extras=False):
+    """Transform a single variable element from the data dictionary into the 
+    dict used for the CodeSystem's concept"""
+    try:
+        vardesc =  var.find('description').text
+    except:
+        vardesc = ""
+    try:
+        variable = {
+            "code": var.get('id'),
+            "display": var.find('name').text,
+            "definition" : vardesc
+        }
+    except:
+        print(f"Unable to parse variable, {var.get('id')}, from the data dictionary")
+        return None
+
+    # Do we want to capture min/max/units information as well?
+    if add_extras:
+        try: 
+            variable['type'] = var.find('type').text.lower()
+        except:
+            pass
+    
+        # Coding details
+        try:
+            codes = var.findall('value')
+            if len(codes) > 0:
+                codings = []
+                for code in codes:
+                    attribs = code.attrib
+                    code_value = attribs['code']
+                    value = code.text
+                    codings.append({
+                        'code': code_value,
+                        'display': value 
+                    })
+                variable['coded_values'] = codings
+        except:
+            pass
+
+        try:
+            variable['comment'] = var.find('comment').text
+        except:
+            pass                        
+
+        try:
+            variable["unit"] = var.find('unit').text
+        except:
+            pass
 
-    if response.status_code < 300:
-        data = xml.etree.ElementTree.fromstring(response.text)
-        table_id = data.attrib['id']
-        study_id = data.attrib['study_id']
+        try:
+            variable["logical_min"] = var.find('logical_min').text
+        except:
+            pass
+    
+        try:
+            variable['logical_max'] = var.find('logical_max').text
+        except:
+            pass
+    return variable
+
+class DataDictionaryReader:
+    """Streams the variables from a dbGaP data dictionary without building the
+    entire document in memory. source can be a filename or a file-like object
+    such as the raw body of a streamed HTTP response.
+
+    Iterating over the reader yields the variable dicts (see parse_variable). 
+    The table's id, study_id and description are available once iteration has 
+    started."""
+    def __init__(self, source, add_extras=False, verbose=False):
+        self.source = source
+        self.add_extras = add_extras
+        self.verbose = verbose
+        self.table_id = None
+        self.study_id = None
+        self.description = None
+
+    def __iter__(self):
+        depth = 0
+        root = None
+
+        for event, elem in xml.etree.ElementTree.iterparse(self.source, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = elem
+                    self.table_id = root.attrib['id']
+                    self.study_id = root.attrib['study_id']
+                depth += 1
+                continue
+
+            depth -= 1
+            # We only care about the table's immediate children. Everything
+            # deeper is handled when its parent element is complete
+            if depth != 1:
+                continue
+
+            if elem.tag == 'description':
+                if elem.text:
+                    self.description = elem.text
+            elif elem.tag not in ('unique_key', 'has_coll'):
+                variable = parse_variable(elem, add_extras=self.add_extras)
+                if variable is not None:
+                    if self.verbose:
+                        print(variable)
+                    yield variable
+
+            # Drop the processed element so the tree never grows beyond the 
+            # one variable we are working on
+            elem.clear()
+            root.clear()
+
+def open_data_dictionary(xml_url):
+    """Return a file-like object for the data dictionary found at xml_url, 
+    which may be a URL or a local filename"""
+    if xml_url.startswith(("http://", "https://")):
+        response = get(xml_url, stream=True)
+
+        if response.status_code >= 300:
+            print(f"There was a problem retrieving the data dictionary at {xml_url}: {response.status_code}")
+            return None
+
+        # Let requests deal with any gzip encoding as we read the body
+        if isinstance(response, requests.Response):
+            response.raw.decode_content = True
+        return response.raw
+    return open(xml_url, 'rb')
+
+def transform_to_codesystem(xml_url, tname=None, tdesc=None, codesystem=None, add_extras=False, verbose=False):
+    source = open_data_dictionary(xml_url)
+
+    if source is not None:
+        # Streamed, so this includes the time spent downloading the body
+        with source, metrics().stage("data_dictionary"):
+            reader = DataDictionaryReader(source, add_extras=add_extras, verbose=verbose)
+            variables = list(reader)
+        metrics().incr("tables")
+        metrics().incr("variables_parsed", len(variables))
+
+        table_id = reader.table_id
+        study_id = reader.study_id
         table_name = tname
         table_desc = tdesc
 
+        if reader.description is not None:
+            table_desc = reader.description
         if table_desc is None:
             table_desc = tname
-        variables = []
 
         # For DbGAP, the study id actually comprises the table ID, so 
         # there really isn't a need to duplicate it. But, we'll add
@@ -78,75 +252,6 @@ def transform_to_codesystem(xml_url, tname=None, tdesc=None, codesystem=None, ad
         if table_name == study_id:
             table_name = table_identifier
 
-        for var in data:
-            if var.tag == 'description':
-                if var.text:
-                    table_desc = var.text
-                    
-            elif var.tag not in ('unique_key', 'has_coll'):
-                try:
-                    vardesc =  var.find('description').text
-                except:
-                    vardesc = ""
-                try:
-                    variables.append({
-                        "code": var.get('id'),
-                        "display": var.find('name').text,
-                        "definition" : vardesc
-                    })
-                    print(variables[-1])
-                except:
-                    pdb.set_trace()
-                    print(var.text)
-
-                # Do we want to capture min/max/units information as well?
-                if add_extras:
-                    try: 
-                        variables[-1]['type'] = var.find('type').text.lower()
-                    except:
-                        pass
-                
-                    # Coding details
-                    try:
-                        codes = var.findall('value')
-                        if len(codes) > 0:
-                            #pdb.set_trace()
-                            codings = []
-                            for code in codes:
-                                attribs = code.attrib
-                                code_value = attribs['code']
-                                value = code.text
-                                codings.append({
-                                    'code': code_value,
-                                    'display': value 
-                                })
-                            variables[-1]['coded_values'] = codings
-                            print(codings)
-                    except:
-                        pass
-
-                    try:
-                        variables[-1]['comment'] = var.find('comment').text
-                    except:
-                        pass                        
-
-                    #pdb.set_trace()
-
-                    try:
-                        variables[-1]["unit"] = var.find('unit').text
-                    except:
-                        pass
-
-                    try:
-                        variables[-1]["logical_min"] = var.find('logical_min').text
-                    except:
-                        pass
-                
-                    try:
-                        variables[-1]['logical_max'] = var.find('logical_max').text
-                    except:
-                        pass
-
         if table_name is None or table_name.strip() == "":
             table_name = f"DD Vars for {table_id}"
         
@@ -174,4 +279,3 @@ def transform_to_codesystem(xml_url, tname=None, tdesc=None, codesystem=None, ad
             codesystem['concept'] += variables
             codesystem['count'] = len(codesystem['concept'])
             return codesystem
-
@@ -11,13 +11,16 @@ A properly formatted CodeSystem includes the following properties for each of th
 
 """
 import requests
-import sys
-from ddent.terminologies import match_terms, push_changes, make_cui_valueset, get_codesystems_used
-from pprint import pformat
+from ddent.terminologies import match_terms, push_changes, make_cui_valueset, get_codesystems_used, resolve_concepts, register_concepts
+from ddent.nlp import extract_cuis
+from ddent.mappings import MappingIndex
+from ddent.conceptmaps import ConceptMapWriter, load_shard, DEFAULT_SHARD_SIZE
+from ddent.loaders import DirectLoader, ParallelLoader, BundleLoader, DEFAULT_BUNDLE_SIZE
+from ddent.metrics import metrics
 from collections import defaultdict
+from tempfile import TemporaryDirectory
 import re
-
-import pdb
+import time
 
 from . import ddent_properties, build_uri
 
@@ -58,19 +61,42 @@ def build_valueset(url, name, title, desc, codesystems):
     print(vs['url'])
     return vs
 
-def load_resource(fhirclient, resource_type, resource):
-    result = fhirclient.load(resource_type, resource)
-    print(f"{resource_type} {resource['url']}")
-    if result['status_code'] != 201:
-        print(pformat(resource))
-        print(pformat(result))
-        pdb.set_trace()
-        sys.exit(1)    
-
-    return result
-
 # perform the transformation 
-def transform_dd_codesystem(study_id, title, desc, codesystems, nlp_endpoint, fhirclient):
+# nlp_workers is the number of definitions that will be sent to the NLP module
+# concurrently. The results are always consumed in the original order, so the
+# mappings are the same regardless of the number of workers. 
+#
+# nlp_batch_size is the number of definitions submitted in each NLP request,
+# for modules that can handle more than one at a time (see 
+# NlpBase.get_cuis_batch). By default, the NLP module picks (see 
+# NlpBase.get_batch_size)
+#
+# dedupe will cause definitions which only differ by whitespace and case to be
+# sent to the NLP module only once, with the results shared across the copies
+#
+# defer_resolution will postpone identifying the concepts returned by NLP until
+# all of the definitions have been processed. At that point, all of the new 
+# codes are resolved at once using resolve_workers threads per terminology
+#
+# If a manifest (ddent.manifest.IngestManifest) is provided, only variables 
+# that are new or have changed since they were last recorded are sent to NLP.
+# The mappings for the rest are carried forward from the manifest
+#
+# bundle can be "transaction" or "batch", in which case the study's CodeSystems,
+# ValueSets and ConceptMaps are gathered up and loaded as Bundles no larger
+# than bundle_size bytes rather than one request at a time. The terminology
+# CodeSystems (UMLS, SNOMED, etc) are still pushed on their own, since they
+# are shared across studies
+#
+# If an uploader (ddent.loaders.UploadExecutor) is provided, everything sent
+# to the FHIR server goes through it so that busy servers are retried, and the
+# resources are loaded in the background while the rest of the study is built
+#
+# The ConceptMaps are written out to disk as they are built and split into
+# shards no larger than conceptmap_size bytes, each of which is loaded as
+# soon as it is written. lean leaves out the comments on the DD => CUI
+# targets, which repeat the variable's definition for every CUI found in it
+def transform_dd_codesystem(study_id, title, desc, codesystems, nlp_endpoint, fhirclient, nlp_workers=1, nlp_batch_size=None, dedupe=True, defer_resolution=False, resolve_workers=4, manifest=None, bundle=None, bundle_size=DEFAULT_BUNDLE_SIZE, uploader=None, conceptmap_size=DEFAULT_SHARD_SIZE, lean=False):
     class transform_output:
         def __init__(self, study_id, title, desc):
             self.study_id = study_id
@@ -80,8 +106,11 @@ def transform_dd_codesystem(study_id, title, desc, codesystems, nlp_endpoint, fh
                 "DD": {},
                 "CUI": {}
             }   
+            # The resources themselves aren't kept once they are loaded, just
+            # references to them ({resourceType, url, id})
             self.valueset = {}         # dd|cui => ingested VS 
-            self.conceptmap = {}       # dd|cui => ingested CM 
+            self.conceptmap = {}       # dd|cui => ingested CM (the first shard if it was split)
+            self.conceptmap_shards = {}    # dd|cui => [ingested CM shards]
 
     cm_dd2cui = None
     cm_cui2dd = None
@@ -91,40 +120,53 @@ def transform_dd_codesystem(study_id, title, desc, codesystems, nlp_endpoint, fh
     cui_cs_used = set()
     transoutput = transform_output(study_id, title, desc)
 
-    class DdVar:
-        def __init__(self, entry):
-            self.code = entry['code']
-            self.display = entry['display']
-            self.definition = entry['definition']
-            self.cuis = set()
+    if uploader is not None:
+        fhirclient = uploader
 
-    class CuiVar:
-        def __init__(self, concept): #entry, source_text):
-            self.nlp_result = concept
-            self.cui = concept.cui
-            self.concept = concept.concept
-            self.vars = set()
-
-        def definition(self):
-            return self.nlp_result.definition()
+    if bundle is not None:
+        loader = BundleLoader(fhirclient, bundle_type=bundle, max_bytes=bundle_size)
+    elif uploader is not None:
+        loader = ParallelLoader(uploader)
+    else:
+        loader = DirectLoader(fhirclient)
+    ddloads = []
 
     valid_codesystems = {
         "cui" : [],
         "dd": []
     }
     cui_codesystems = {}        # CUI CS URI => (cui_cs and dd_cs)
-    ddvars = {}     # code => DdVar
-    cuivars = defaultdict(dict)    # cui.system => CuiVar
-
-    # TODO: We need to block all CM relationships into DD-Table-URL:CUI-URL => [(source, [target])]
-    # Numbers shouldn't be too high, so it's probably not horrible to join the systems with a simple
-    # defaultdict(list) of tuples. 
-    # We have uneven CodeSystems: 3 total CUI CS and N Table Code Systems. So, we need 
-    # to be able to organize them appropriately within the element/target
-
-    # ddsystem:cuisystem => { pvh => [cui1, cui2...]}
-    table_mappings = defaultdict(lambda: defaultdict(set))
-    cui_mappings = defaultdict(lambda: defaultdict(set))
+    dd_displays = {}     # code => display
+    cuivars = defaultdict(dict)    # cui.system => {cui => first NlpResult found for it}
+
+    # Both ConceptMaps are generated from this, grouped by table and CUI system
+    mappings = MappingIndex()
+
+    # Extract the CUIs for the entire study up front so that the NLP requests
+    # aren't limited by the size of the individual tables
+    entries = [entry for codesystem in codesystems for entry in codesystem['concept']]
+    definitions = [entry['definition'] for entry in entries]
+
+    carried = [None] * len(entries)
+    if manifest is not None:
+        carried = manifest.carry_forward(study_id, entries)
+        register_concepts([results for results in carried if results is not None])
+
+        # Anything we can carry forward doesn't need to be submitted at all
+        definitions = [definition if previous is None else "" for definition, previous in zip(definitions, carried)]
+        print(f"{len(entries) - carried.count(None)} of {len(entries)} variables are unchanged since the last ingest")
+
+    with metrics().stage("nlp"):
+        nlp_results = extract_cuis(nlp_endpoint, definitions, workers=nlp_workers, dedupe=dedupe, resolve=not defer_resolution, batch_size=nlp_batch_size)
+    if defer_resolution:
+        with metrics().stage("resolution"):
+            nlp_results = resolve_concepts(nlp_results, workers=resolve_workers)
+
+    if manifest is not None:
+        changed = [(entry, results) for entry, results, previous in zip(entries, nlp_results, carried) if previous is None]
+        manifest.record(study_id, [entry for entry, results in changed], [results for entry, results in changed])
+        nlp_results = [results if previous is None else previous for results, previous in zip(nlp_results, carried)]
+    nlp_results = iter(nlp_results)
 
     for codesystem in codesystems:
         table_id = codesystem['name']
@@ -132,13 +174,10 @@ def transform_dd_codesystem(study_id, title, desc, codesystems, nlp_endpoint, fh
         
         cuis_added = 0
         for entry in codesystem['concept']:
-            ddvar = DdVar(entry)
-            ddvars[ddvar.code] = ddvar 
-
-            if ddvar.definition.strip() != "":
-                cuis = nlp_endpoint.get_cuis(ddvar.definition)
-                # cuis = requests.get(f"{nlp_endpoint}/getJson?text={ddvar.definition}")
+            dd_displays[entry['code']] = entry['display']
+            cuis = next(nlp_results)
 
+            if entry['definition'].strip() != "":
                 for cui in cuis:
                     code = cui.cui
                     system = cui.system()
@@ -147,48 +186,43 @@ def transform_dd_codesystem(study_id, title, desc, codesystems, nlp_endpoint, fh
                         # We'll be reporting the CUI Code systems that were used
                         # upon return, so let's keep tack of them
                         cui_cs_used.add(system)
-                        cuivar = CuiVar(cui) #, ddvar.definition)
-                        cuivars[system][code] = (cuivar)
-
-                    mapkey = f"{table_uri}:::{system}"
-
-                    table_mappings[mapkey][ddvar.code].add(code)
-                    cui_mappings[mapkey][code].add(ddvar.code)
+                        cuivars[system][code] = cui
 
-                    cuivar.vars.add(ddvar)
-                    ddvar.cuis.add(code)
+                    mappings.add(table_uri, system, entry['code'], code)
                     cuis_added += 1
 
         if cuis_added > 0:
             push_changes(fhirclient)
-            ddresponse = load_resource(fhirclient, "CodeSystem", codesystem)['response']
+            ddloads.append(loader.add("CodeSystem", codesystem))
             valid_codesystems['dd'].append(codesystem)
             #pdb.set_trace()
 
-            transoutput.codesystems['DD'][codesystem['url']] = ddresponse
+    # The per table pushes only happen once enough codes have accumulated, so
+    # make sure the rest are on the server before the ConceptMaps refer to them
+    push_changes(fhirclient, force=True)
     transoutput.codesystems['CUI'] = get_codesystems_used(cui_cs_used)
     #pdb.set_trace()
     valueset = build_valueset(build_uri("ValueSet", "DD", f"{study_id}"), study_id, title, desc, valid_codesystems['dd'])
     if valueset == None:
         print(codesystems)
+        loader.finish()
+        for ddload in ddloads:
+            transoutput.codesystems['DD'][ddload.url] = ddload.reference()
         return transoutput
 
     valueset['identifier'] = [{
         "system": f"{ddent_properties['urlbase']}/study/vs/dd",
         "value": study_id
     }]
-    ddresponse = load_resource(fhirclient, "ValueSet", valueset)['response']
+    vsddload = loader.add("ValueSet", valueset)
 
     valueset_cui = make_cui_valueset(cuivars, build_uri("ValueSet", "CUI", f"{study_id}"), study_id + "-CUI", "CUIs for " + title, desc)
     valueset_cui['identifier'] = [{
         "system": f"{ddent_properties['urlbase']}/study/vs/cui",
         "value": study_id
     }]
-    cuiresponse = load_resource(fhirclient, "ValueSet", valueset_cui)['response']
-
-    transoutput.valueset['dd'] = ddresponse
-    print(ddresponse['url'])
-    transoutput.valueset['cui'] = cuiresponse
+    vscuiload = loader.add("ValueSet", valueset_cui)
+    print(valueset['url'])
 
     cm_name = f"{study_id}-DDtoCUI"
     cm_dd2cui = {
@@ -226,46 +260,44 @@ def transform_dd_codesystem(study_id, title, desc, codesystems, nlp_endpoint, fh
         "group" : []
     }   
 
-    for csmap in table_mappings:
-        urls = csmap.split(":::")
-        if len(urls) != 2:
-            pdb.set_trace()
-        table_url, cui_url = urls[0:2]
-
-        ddgroup = {
-            "source": table_url,
-            "target": cui_url,
-            "element": []
-        }
-
-        for code in table_mappings[csmap]:
+    # Each shard is handed to the loader as soon as it's written, and its file
+    # removed, so only the shards still waiting to be loaded are held anywhere
+    cmddloads = []
+    cmcuiloads = []
+    def shard_loader(loads):
+        def load(url, path):
+            loads.append(loader.add("ConceptMap", load_shard(path)))
+            path.unlink()
+        return load
+
+    conceptmap_start = time.perf_counter()
+    workdir = TemporaryDirectory(prefix="ddent-")
+    dd2cui_writer = ConceptMapWriter(cm_dd2cui, workdir.name, max_bytes=conceptmap_size, on_shard=shard_loader(cmddloads))
+    cui2dd_writer = ConceptMapWriter(cm_cui2dd, workdir.name, max_bytes=conceptmap_size, on_shard=shard_loader(cmcuiloads))
+
+    for table_url, cui_url, elements in mappings.dd_to_cui():
+        for code, cuis in elements:
             # Populate the elements
             element = {
                 "code": code,
-                "display": ddvars[code].display,
+                "display": dd_displays[code],
                 "target": []
             }
 
-            for cui in table_mappings[csmap][code]:
+            for cui in cuis:
                 concept = cuivars[cui_url][cui].concept
-                element['target'].append({
+                target = {
                     "code": cui,
                     "display": concept['display'],
-                    "comment": cuivars[cui_url][cui].definition(),
                     "equivalence": ddent_properties['equivalence']
-                })
-            ddgroup['element'].append(element)
-        cm_dd2cui['group'].append(ddgroup)
-
-    for csmap in cui_mappings:
-        table_url, cui_url = csmap.split(":::")
-
-        ddgroup = {
-            "source": cui_url,
-            "target": table_url,
-            "element": []
-        }
-        for code in cui_mappings[csmap]:
+                }
+                if not lean:
+                    target['comment'] = cuivars[cui_url][cui].definition()
+                element['target'].append(target)
+            dd2cui_writer.add_element(table_url, cui_url, element)
+
+    for table_url, cui_url, elements in mappings.cui_to_dd():
+        for code, ddcodes in elements:
             # Populate the elements
             element = {
                 "code": code,
@@ -273,21 +305,32 @@ def transform_dd_codesystem(study_id, title, desc, codesystems, nlp_endpoint, fh
                 "target": []
             }
 
-            for var in cui_mappings[csmap][code]:
+            for var in ddcodes:
                 element['target'].append({
                     "code": var,
-                    "display": ddvars[var].display,
+                    "display": dd_displays[var],
                     "equivalence": ddent_properties['equivalence']
                 })
-            ddgroup['element'].append(element)
-        cm_cui2dd['group'].append(ddgroup)
-
-    cmddresponse = load_resource(fhirclient, "ConceptMap", cm_dd2cui)['response']
-
-    cmcuiresponse = load_resource(fhirclient, "ConceptMap", cm_cui2dd)['response']
-
-    transoutput.conceptmap['dd'] = cmddresponse
-    transoutput.conceptmap['cui'] = cmcuiresponse
+            cui2dd_writer.add_element(cui_url, table_url, element)
+
+    dd2cui_writer.close()
+    cui2dd_writer.close()
+    # With the DirectLoader, this includes loading the shards
+    metrics().observe("stage_seconds", time.perf_counter() - conceptmap_start, stage="conceptmaps")
+
+    # Anything still in flight (or in the last bundle) is sent from here
+    with metrics().stage("load"):
+        loader.finish()
+    workdir.cleanup()
+
+    for ddload in ddloads:
+        transoutput.codesystems['DD'][ddload.url] = ddload.reference()
+    transoutput.valueset['dd'] = vsddload.reference()
+    transoutput.valueset['cui'] = vscuiload.reference()
+    transoutput.conceptmap_shards['dd'] = [cmload.reference() for cmload in cmddloads]
+    transoutput.conceptmap_shards['cui'] = [cmload.reference() for cmload in cmcuiloads]
+    transoutput.conceptmap['dd'] = transoutput.conceptmap_shards['dd'][0]
+    transoutput.conceptmap['cui'] = transoutput.conceptmap_shards['cui'][0]
 
 
     return transoutput
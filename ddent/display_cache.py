@@ -0,0 +1,105 @@
+"""
+Persistent cache for the concepts returned by the terminology services (UTS,
+RxNav and BioPortal) so that codes we've already resolved don't require a
+network round trip in subsequent runs.
+
+The cache is shared by all of the external systems, with entries keyed by the
+system's URL and the code. Entries expire after ttl seconds. The placeholder
+concepts returned when a service can't find a name for a code are cached as
+well, but with a much shorter TTL so that they are retried periodically.
+"""
+
+import sqlite3
+import json
+import time
+from threading import Lock
+
+from ddent.metrics import metrics
+
+# Names don't change often, so 30 days should be fine for real concepts
+DEFAULT_TTL = 30 * 24 * 60 * 60
+
+# Failed lookups will be retried after a day
+DEFAULT_NEGATIVE_TTL = 24 * 60 * 60
+
+# These are the displays the API wrappers return when they don't find a name
+_negative_displays = ("No Matching Concept Found", "No Name Found")
+
+def is_negative(concept):
+    return concept['display'].startswith(_negative_displays)
+
+class DisplayCache:
+    def __init__(self, filename, ttl=DEFAULT_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL, clock=time.time):
+        self.filename = filename
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock              # Seconds since the epoch, as time.time
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+        self.lock = Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS concepts (
+                                system TEXT,
+                                code TEXT,
+                                concept TEXT,
+                                negative INTEGER,
+                                stored REAL,
+                                PRIMARY KEY (system, code))""")
+        self.db.commit()
+
+    def get(self, system, code):
+        """Return the cached concept for the system/code if it hasn't expired"""
+        with self.lock:
+            row = self.db.execute("SELECT concept, negative, stored FROM concepts WHERE system=? AND code=?",
+                                    (system, code)).fetchone()
+
+            if row is not None:
+                concept, negative, stored = row
+                ttl = self.ttl
+                if negative:
+                    ttl = self.negative_ttl
+
+                if self.clock() - stored < ttl:
+                    if negative:
+                        self.negative_hits += 1
+                    else:
+                        self.hits += 1
+                    metrics().cache("display_cache", True)
+                    return json.loads(concept)
+            self.misses += 1
+        metrics().cache("display_cache", False)
+        return None
+
+    def put(self, system, code, concept):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO concepts VALUES (?, ?, ?, ?, ?)",
+                            (system, code, json.dumps(concept), int(is_negative(concept)), self.clock()))
+            self.db.commit()
+
+    def hit_rate(self):
+        lookups = self.hits + self.negative_hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return (self.hits + self.negative_hits) / lookups
+
+    def report(self):
+        return f"Display Cache {self.filename}: {self.hits} hits, {self.negative_hits} negative hits, {self.misses} misses ({self.hit_rate():.1%})"
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+_display_cache = None
+def display_cache(filename=None, ttl=DEFAULT_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL):
+    """Return the display cache if one has been opened. Providing a filename
+    will open (or create) the cache used by all of the external systems"""
+    global _display_cache
+
+    if filename is not None:
+        _display_cache = DisplayCache(filename, ttl=ttl, negative_ttl=negative_ttl)
+    return _display_cache
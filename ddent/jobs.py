@@ -0,0 +1,210 @@
+"""
+Persistent job queue for ingesting many dbGaP studies in one go.
+
+The state of every study and each of its tables is recorded in a local SQLite
+file, so a batch that dies part of the way through can simply be restarted.
+Studies that were completed are skipped (unless they are requeued) and the
+tables that were already downloaded are pulled from the queue rather than
+from dbGaP.
+
+Only the downloads are resumed table by table. The NLP and FHIR loads work on
+the study as a whole (its ValueSets and ConceptMaps cover every table), so an
+interrupted study goes through them again in full. The NLP cache and the
+ingest manifest are what keep that from repeating the expensive work.
+
+Study states:   pending => running => done | failed
+Table states:   pending => downloaded => loaded | failed
+"""
+
+import json
+import sqlite3
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from ddent.dbgap import extract_xmls_for_id, transform_to_codesystem, DEFAULT_WORKERS
+from ddent.ddent import transform_dd_codesystem
+from ddent.metrics import metrics, emit
+
+class JobQueue:
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS studies (
+                                accession TEXT PRIMARY KEY,
+                                title TEXT,
+                                state TEXT,
+                                error TEXT,
+                                variables INTEGER,
+                                started REAL,
+                                finished REAL,
+                                added INTEGER)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS tables (
+                                accession TEXT,
+                                xml_url TEXT,
+                                position INTEGER,
+                                table_name TEXT,
+                                table_desc TEXT,
+                                state TEXT,
+                                codesystem TEXT,
+                                PRIMARY KEY (accession, xml_url))""")
+        self.db.commit()
+
+    def _execute(self, sql, params=()):
+        with self.lock:
+            cursor = self.db.execute(sql, params)
+            rows = cursor.fetchall()
+            self.db.commit()
+        return rows
+
+    def add_study(self, accession, title, requeue=False):
+        """Queue the study. Studies that previously failed are queued again,
+        but those that are already done are left alone (returning False)
+        unless requeue is set, in which case their tables are downloaded
+        afresh as well"""
+        with self.lock:
+            row = self.db.execute("SELECT state FROM studies WHERE accession=?", (accession,)).fetchone()
+            if row is None:
+                added = self.db.execute("SELECT COUNT(*) FROM studies").fetchone()[0]
+                self.db.execute("INSERT INTO studies VALUES (?, ?, 'pending', NULL, 0, NULL, NULL, ?)", (accession, title, added))
+            elif row[0] == 'failed':
+                self.db.execute("UPDATE studies SET state='pending', error=NULL, title=? WHERE accession=?", (title, accession))
+            elif row[0] == 'done':
+                if not requeue:
+                    return False
+                self.db.execute("UPDATE studies SET state='pending', error=NULL, title=? WHERE accession=?", (title, accession))
+                self.db.execute("DELETE FROM tables WHERE accession=?", (accession,))
+            self.db.commit()
+        return True
+
+    def recover(self):
+        """Anything left running belongs to a process that is no longer around"""
+        self._execute("UPDATE studies SET state='pending' WHERE state='running'")
+
+    def claim_study(self):
+        """Mark the next pending study as running and return (accession, title),
+        or None if there is nothing left to do"""
+        with self.lock:
+            row = self.db.execute("SELECT accession, title FROM studies WHERE state='pending' ORDER BY added LIMIT 1").fetchone()
+            if row is not None:
+                self.db.execute("UPDATE studies SET state='running', started=? WHERE accession=?", (time.time(), row[0]))
+                self.db.commit()
+        return row
+
+    def study_done(self, accession, variables):
+        self._execute("UPDATE studies SET state='done', variables=?, finished=? WHERE accession=?", (variables, time.time(), accession))
+        self._execute("UPDATE tables SET state='loaded' WHERE accession=? AND state='downloaded'", (accession,))
+
+    def study_failed(self, accession, error):
+        self._execute("UPDATE studies SET state='failed', error=?, finished=? WHERE accession=?", (error, time.time(), accession))
+
+    def has_tables(self, accession):
+        return len(self._execute("SELECT 1 FROM tables WHERE accession=? LIMIT 1", (accession,))) > 0
+
+    def add_tables(self, accession, xmls):
+        with self.lock:
+            for position, (xml_url, (table_name, table_desc)) in enumerate(xmls.items()):
+                self.db.execute("INSERT OR IGNORE INTO tables VALUES (?, ?, ?, ?, ?, 'pending', NULL)",
+                                (accession, xml_url, position, table_name, table_desc))
+            self.db.commit()
+
+    def pending_tables(self, accession):
+        """Returns [(xml_url, table_name, table_desc)] for the tables that still need to be downloaded"""
+        return self._execute("SELECT xml_url, table_name, table_desc FROM tables WHERE accession=? AND state IN ('pending', 'failed') ORDER BY position", (accession,))
+
+    def table_downloaded(self, accession, xml_url, codesystem):
+        self._execute("UPDATE tables SET state='downloaded', codesystem=? WHERE accession=? AND xml_url=?", (json.dumps(codesystem), accession, xml_url))
+
+    def table_failed(self, accession, xml_url):
+        self._execute("UPDATE tables SET state='failed' WHERE accession=? AND xml_url=?", (accession, xml_url))
+
+    def codesystems(self, accession):
+        """Return the CodeSystems for all of the study's downloaded tables in their original order"""
+        rows = self._execute("SELECT codesystem FROM tables WHERE accession=? AND state IN ('downloaded', 'loaded') ORDER BY position", (accession,))
+        return [json.loads(row[0]) for row in rows]
+
+    def summary(self):
+        """Returns {state: (studies, variables)}"""
+        rows = self._execute("SELECT state, COUNT(*), COALESCE(SUM(variables), 0) FROM studies GROUP BY state")
+        return {state: (count, variables) for state, count, variables in rows}
+
+    def failures(self):
+        return self._execute("SELECT accession, error FROM studies WHERE state='failed' ORDER BY added")
+
+def ingest_study(queue, accession, title, nlp, fhirclient, download_workers=DEFAULT_WORKERS, desc="Study Description TBD", **transform_args):
+    """Download whatever tables we don't already have for the study and run
+    the DDENT transformation over all of them. Returns the number of variables"""
+    if not queue.has_tables(accession):
+        xmls = extract_xmls_for_id(accession, workers=download_workers)
+        if len(xmls) == 0:
+            raise ValueError(f"There was a problem retrieving the data dictionaries for {accession}")
+        queue.add_tables(accession, xmls)
+
+    def download(table):
+        xml_url, table_name, table_desc = table
+        print(xml_url)
+        codesystem = transform_to_codesystem(xml_url, table_name, table_desc)
+        if codesystem is None:
+            queue.table_failed(accession, xml_url)
+        else:
+            queue.table_downloaded(accession, xml_url, codesystem)
+
+    with ThreadPoolExecutor(max_workers=download_workers) as executor:
+        list(executor.map(download, queue.pending_tables(accession)))
+
+    codesystems = queue.codesystems(accession)
+    if len(codesystems) == 0:
+        raise ValueError(f"None of the data dictionaries for {accession} could be retrieved")
+
+    transform_dd_codesystem(accession, title, desc, codesystems, nlp, fhirclient, **transform_args)
+    return sum(len(codesystem['concept']) for codesystem in codesystems)
+
+def run_batch(queue, nlp, fhirclient, workers=1, **ingest_args):
+    """Work through all of the pending studies in the queue, workers studies
+    at a time. Returns the number of variables ingested"""
+    queue.recover()
+    start = time.time()
+    totals = {"studies": 0, "variables": 0}
+    totals_lock = Lock()
+
+    def worker():
+        while True:
+            study = queue.claim_study()
+            if study is None:
+                return
+            accession, title = study
+            print(f"Ingesting {accession}")
+            study_start = time.time()
+            try:
+                variables = ingest_study(queue, accession, title, nlp, fhirclient, **ingest_args)
+                queue.study_done(accession, variables)
+                metrics().study_done(accession, variables, time.time() - study_start)
+                with totals_lock:
+                    totals['studies'] += 1
+                    totals['variables'] += variables
+            except (Exception, SystemExit) as e:
+                # One bad study shouldn't take the rest of the batch down with it
+                traceback.print_exc()
+                queue.study_failed(accession, f"{type(e).__name__}: {e}")
+                metrics().incr("study_failures")
+            emit()
+
+            elapsed = time.time() - start
+            print(f"{totals['studies']} studies, {totals['variables']} variables in {elapsed:.1f}s ({totals['variables']/elapsed:.1f} variables/s)")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(worker) for i in range(workers)]:
+            future.result()
+
+    elapsed = time.time() - start
+    print(f"Batch complete: {totals['studies']} studies and {totals['variables']} variables ingested in {elapsed:.1f}s")
+    if elapsed > 0:
+        print(f"\t{totals['studies'] / elapsed * 3600:.1f} studies/hour, {totals['variables'] / elapsed:.1f} variables/s")
+    for state, (count, variables) in sorted(queue.summary().items()):
+        print(f"\t{state}: {count} studies ({variables} variables)")
+    for accession, error in queue.failures():
+        print(f"\tFAILED {accession}: {error}")
+    return totals['variables']
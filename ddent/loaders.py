@@ -0,0 +1,321 @@
+"""
+Strategies for getting a study's resources onto the FHIR server.
+
+A loader accepts resources via add(), which returns a LoadResult, and
+finish(), after which each LoadResult has the id the server assigned. The
+DirectLoader loads each resource as soon as it is added, the ParallelLoader
+hands them to an UploadExecutor to be loaded in the background and the
+BundleLoader gathers the resources into transaction (or batch) Bundles,
+sending each one as soon as it is full.
+
+Once a resource has been loaded, its LoadResult lets go of it and keeps just
+the url and id, so a study's resources (the ConceptMap shards especially)
+aren't all held in memory until the end of the study.
+"""
+
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pprint import pformat
+from threading import BoundedSemaphore
+from urllib.parse import quote, urlsplit
+
+import requests
+
+from ddent.metrics import metrics
+
+# Keep each bundle comfortably under the request limits of most FHIR servers
+DEFAULT_BUNDLE_SIZE = 20 * 1024 * 1024
+
+DEFAULT_UPLOAD_WORKERS = 4
+
+# Responses which mean the server didn't get around to handling the request.
+# Other 5xx are not retried, since the resource may well have been created
+_retry_statuses = [429, 502, 503, 504]
+
+class LoadError(Exception):
+    """The FHIR server refused to accept one of our resources"""
+    def __init__(self, resource_type, resource, result):
+        self.resource_type = resource_type
+        self.resource = resource
+        self.result = result
+        super().__init__(f"{resource_type} {resource['url']} was not loaded ({result['status_code']})")
+
+class BundleError(Exception):
+    """One or more of the entries in a bundle were rejected"""
+    def __init__(self, failures):
+        self.failures = failures
+        super().__init__(f"{len(failures)} resources were not loaded: " + ", ".join(failure.url for failure in failures))
+
+def load_resource(fhirclient, resource_type, resource):
+    metrics().uploaded(resource_type, len(json.dumps(resource)))
+    with metrics().request("fhir"):
+        result = fhirclient.load(resource_type, resource)
+    print(f"{resource_type} {resource['url']}")
+    if result['status_code'] != 201:
+        metrics().incr("request_errors", service="fhir")
+        print(pformat(resource))
+        print(pformat(result))
+        raise LoadError(resource_type, resource, result)
+
+    return result
+
+class UploadExecutor:
+    """Sits in front of the FHIR client, retrying requests that the server
+    was too busy to handle and running loads on a bounded pool of workers.
+
+    Provides load, post and patch so it can be passed anywhere a fhirclient
+    is expected. submit() runs the load in the background, but will block
+    once max_pending loads are waiting, which keeps whoever is producing the
+    resources (NLP, etc) from getting too far ahead of the server"""
+    def __init__(self, fhirclient, workers=DEFAULT_UPLOAD_WORKERS, max_pending=None, retries=3, backoff=1.0):
+        self.fhirclient = fhirclient
+        self.retries = retries
+        self.backoff = backoff
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+        if max_pending is None:
+            max_pending = workers * 2
+        self.slots = BoundedSemaphore(max_pending)
+
+        self.uploaded = 0
+        self.retried = 0
+        self.busy_time = 0.0
+
+    def _retry(self, call, *args):
+        attempt = 0
+        start = time.monotonic()
+        while True:
+            try:
+                result = call(*args)
+                if result['status_code'] not in _retry_statuses or attempt >= self.retries:
+                    break
+                reason = result['status_code']
+            except requests.exceptions.ConnectionError as e:
+                if attempt >= self.retries:
+                    raise
+                reason = e
+
+            delay = self.backoff * (2 ** attempt)
+            print(f"FHIR server responded with {reason}. Trying again in {delay:.1f}s")
+            self.retried += 1
+            attempt += 1
+            time.sleep(delay)
+
+        self.uploaded += 1
+        self.busy_time += time.monotonic() - start
+        return result
+
+    def load(self, resource_type, resource):
+        return self._retry(self.fhirclient.load, resource_type, resource)
+
+    def post(self, resource_type, resource):
+        return self._retry(self.fhirclient.post, resource_type, resource)
+
+    def patch(self, resource_type, id, ops):
+        """Returns None if the underlying client can't patch, the same as
+        ExternalSystem.patch_current_version does"""
+        patch = getattr(self.fhirclient, "patch", None)
+        if patch is None:
+            return None
+        return self._retry(patch, resource_type, id, ops)
+
+    def submit(self, fn, *args):
+        """Run fn(*args) on one of the workers, returning the Future"""
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(fn, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda f: self.slots.release())
+        return future
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+    def report(self):
+        return f"Uploads: {self.uploaded} requests ({self.retried} retried), {self.busy_time:.1f}s spent waiting on the FHIR server"
+
+class LoadResult:
+    def __init__(self, resource_type, resource):
+        self.resource_type = resource_type
+        self.resource = resource    # Until it has been loaded
+        self.url = resource['url']
+        self.id = None
+        self.status_code = None
+        self.error = None
+        self.future = None
+        self.size = None            # Serialized size, once we know it
+
+    def loaded(self, status_code, response):
+        """Record the id the server assigned (if it said) and drop the resource"""
+        self.status_code = status_code
+        if isinstance(response, dict):
+            self.id = response.get('id')
+        self.resource = None
+
+    def reference(self):
+        return {"resourceType": self.resource_type, "url": self.url, "id": self.id}
+
+class DirectLoader:
+    """Load each resource as soon as we get it"""
+    def __init__(self, fhirclient):
+        self.fhirclient = fhirclient
+
+    def add(self, resource_type, resource):
+        result = LoadResult(resource_type, resource)
+        response = load_resource(self.fhirclient, resource_type, resource)
+        result.loaded(response['status_code'], response['response'])
+        return result
+
+    def finish(self):
+        pass
+
+class ParallelLoader:
+    """Load each resource in the background using an UploadExecutor. The
+    responses are available once finish() returns"""
+    def __init__(self, uploader):
+        self.uploader = uploader
+        self.results = []
+
+    def _load(self, result):
+        response = load_resource(self.uploader, result.resource_type, result.resource)
+        result.loaded(response['status_code'], response['response'])
+
+    def add(self, resource_type, resource):
+        result = LoadResult(resource_type, resource)
+        result.future = self.uploader.submit(self._load, result)
+        self.results.append(result)
+        return result
+
+    def finish(self):
+        """Wait for everything to be loaded, raising the first error we hit
+        (if any) once all of the loads have completed"""
+        results = self.results
+        self.results = []
+
+        errors = []
+        for result in results:
+            error = result.future.exception()
+            if error is not None:
+                result.error = str(error)
+                errors.append(error)
+        if len(errors) > 0:
+            raise errors[0]
+
+def _outcome_details(outcome):
+    """Pull the diagnostics out of an OperationOutcome, if that's what we got"""
+    if isinstance(outcome, dict) and outcome.get('resourceType') == 'OperationOutcome':
+        return "; ".join(issue.get('diagnostics', issue.get('code', '')) for issue in outcome.get('issue', []))
+    return pformat(outcome)
+
+def location_id(location, resource_type):
+    """The id from a response's location, which may be relative
+    (CodeSystem/123/_history/1) or absolute (http://host/fhir/CodeSystem/123)"""
+    segments = [segment for segment in urlsplit(location).path.split("/_history/")[0].split("/") if segment != ""]
+    if resource_type in segments:
+        idx = len(segments) - 1 - segments[::-1].index(resource_type)
+        if idx + 1 < len(segments):
+            return segments[idx + 1]
+    if len(segments) > 0:
+        return segments[-1]
+    return None
+
+class BundleLoader:
+    """Gather the resources into as few bundles as possible, no larger than
+    max_bytes. bundle_type can be transaction, where the server applies each
+    bundle all or nothing, or batch, where each entry stands on its own.
+
+    Each bundle is sent as soon as the next resource won't fit in it, and the
+    rest go when finish() is called"""
+    def __init__(self, fhirclient, bundle_type="transaction", max_bytes=DEFAULT_BUNDLE_SIZE):
+        self.fhirclient = fhirclient
+        self.bundle_type = bundle_type
+        self.max_bytes = max_bytes
+        self.chunk = []             # [(result, entry)] for the bundle being filled
+        self.chunk_size = 0
+        self.failures = []
+
+    def add(self, resource_type, resource):
+        """Any single entry larger than max_bytes gets a bundle of its own"""
+        result = LoadResult(resource_type, resource)
+        entry = self.bundle_entry(result)
+        result.size = len(json.dumps(entry))
+
+        if len(self.chunk) > 0 and self.chunk_size + result.size > self.max_bytes:
+            self.flush()
+        self.chunk.append((result, entry))
+        self.chunk_size += result.size
+        return result
+
+    def flush(self):
+        chunk = self.chunk
+        self.chunk = []
+        self.chunk_size = 0
+        if len(chunk) > 0:
+            self.send(chunk)
+            self.failures += [result for result, entry in chunk if result.error is not None]
+
+    def bundle_entry(self, result):
+        # Conditional update on the canonical URL, so that reloading a study
+        # replaces the existing resources rather than duplicating them
+        return {
+            "resource": result.resource,
+            "request": {
+                "method": "PUT",
+                "url": f"{result.resource_type}?url={quote(result.resource['url'], safe='')}"
+            }
+        }
+
+    def send(self, chunk):
+        bundle = {
+            "resourceType": "Bundle",
+            "type": self.bundle_type,
+            "entry": [entry for result, entry in chunk]
+        }
+        print(f"Loading {self.bundle_type} bundle with {len(chunk)} entries")
+        for result, entry in chunk:
+            metrics().uploaded(result.resource_type, result.size)
+        with metrics().request("fhir_bundle"):
+            response = self.fhirclient.post("", bundle)
+
+        if response['status_code'] >= 300:
+            # For transactions, the whole bundle fails together
+            for result, entry in chunk:
+                result.status_code = response['status_code']
+                result.error = _outcome_details(response['response'])
+            return
+
+        response_entries = response['response'].get('entry', [])
+        for idx, (result, entry) in enumerate(chunk):
+            if idx >= len(response_entries):
+                result.status_code = response['status_code']
+                result.error = "No response entry returned by the server"
+                continue
+
+            entry_response = response_entries[idx].get('response', {})
+            status_code = int(entry_response.get('status', '500').split()[0])
+            if status_code >= 300:
+                result.status_code = status_code
+                result.error = _outcome_details(entry_response.get('outcome'))
+            else:
+                # Servers don't typically return the resource itself, but the
+                # location includes the id it was assigned
+                response = response_entries[idx].get('resource', {})
+                location = entry_response.get('location')
+                if location and 'id' not in response:
+                    response = {"id": location_id(location, result.resource_type)}
+                result.loaded(status_code, response)
+
+    def finish(self):
+        """Send whatever hasn't been sent yet. Raises a BundleError if any of
+        the entries were rejected, after reporting each of them"""
+        self.flush()
+        failures = self.failures
+        self.failures = []
+
+        for failure in failures:
+            print(f"{failure.resource_type} {failure.url} failed ({failure.status_code}): {failure.error}")
+        if len(failures) > 0:
+            raise BundleError(failures)
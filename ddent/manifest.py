@@ -0,0 +1,78 @@
+"""
+Record of what was extracted for each variable during previous ingests.
+
+Each variable is fingerprinted by its code, display and definition, with the
+version suffixes stripped from the code so that a variable which is unchanged
+between phsNNN.v1 and phsNNN.v2 matches itself. When the fingerprint matches,
+the NLP results recorded for the variable can be carried forward rather than
+running the definition through NLP again.
+"""
+
+import json
+import re
+import sqlite3
+from hashlib import sha1
+from threading import Lock
+
+from ddent.nlp import NlpResult, normalize_text
+
+_version_suffix = re.compile(r'\.v[0-9]+(\.p[0-9]+)?$')
+
+def unversioned(accession):
+    """phs000888.v1.p1 => phs000888, phv00054119.v1.p1 => phv00054119"""
+    return _version_suffix.sub("", accession)
+
+def fingerprint(entry):
+    definition = entry.get('definition') or ""
+    content = "\0".join([unversioned(entry['code']), entry.get('display') or "", normalize_text(definition)])
+    return sha1(content.encode("utf-8")).hexdigest()
+
+class IngestManifest:
+    def __init__(self, filename):
+        self.filename = filename
+        self.reused = 0
+        self.changed = 0
+
+        self.lock = Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS variables (
+                                study TEXT,
+                                code TEXT,
+                                fingerprint TEXT,
+                                results TEXT,
+                                PRIMARY KEY (study, code))""")
+        self.db.commit()
+
+    def carry_forward(self, study_id, entries):
+        """Return a list with the previously recorded NlpResults for each of
+        the entries whose fingerprint is unchanged and None for the rest"""
+        study = unversioned(study_id)
+        carried = []
+
+        with self.lock:
+            for entry in entries:
+                row = self.db.execute("SELECT fingerprint, results FROM variables WHERE study=? AND code=?",
+                                        (study, unversioned(entry['code']))).fetchone()
+
+                if row is not None and row[0] == fingerprint(entry):
+                    source_text = normalize_text(entry.get('definition') or "")
+                    carried.append([NlpResult.from_dict(result, source_text) for result in json.loads(row[1])])
+                    self.reused += 1
+                else:
+                    carried.append(None)
+                    self.changed += 1
+        return carried
+
+    def record(self, study_id, entries, results):
+        """Save the NlpResults for each of the entries"""
+        study = unversioned(study_id)
+
+        with self.lock:
+            for entry, cuis in zip(entries, results):
+                self.db.execute("INSERT OR REPLACE INTO variables VALUES (?, ?, ?, ?)",
+                                (study, unversioned(entry['code']), fingerprint(entry), json.dumps([cui.to_dict() for cui in cuis])))
+            self.db.commit()
+
+    def report(self):
+        return f"Manifest {self.filename}: {self.reused} variables carried forward, {self.changed} new or changed"
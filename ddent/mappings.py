@@ -0,0 +1,120 @@
+"""
+Compact index of the variable <=> CUI mappings used to build a study's
+ConceptMaps.
+
+The (table URL, CUI system) groups, variable codes and CUIs are each
+interned to integers as the mappings are added, and the edges themselves are
+kept in flat arrays. When the ConceptMaps are built, the edges are sorted
+once per direction into CSR (compressed sparse row) form:
+
+    group_start[g] .. group_start[g+1]  => rows belonging to group g
+    row_src[r]                          => source (variable or CUI) of row r
+    row_start[r] .. row_start[r+1]      => targets of row r in cols
+
+where each group is a (table, CUI system) pair, just like the groups within
+the ConceptMaps. This keeps a study with hundreds of thousands of variables
+down to a handful of integer arrays rather than nested dicts of sets.
+"""
+
+from array import array
+
+_mask = 0xffffffff
+
+class Interner:
+    """Assigns each distinct value a sequential integer id"""
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+
+    def __call__(self, value):
+        id = self.ids.get(value)
+        if id is None:
+            id = len(self.values)
+            self.ids[value] = id
+            self.values.append(value)
+        return id
+
+    def __getitem__(self, id):
+        return self.values[id]
+
+    def __len__(self):
+        return len(self.values)
+
+class _Csr:
+    def __init__(self, groups, sources, targets):
+        # Packing each edge into a single int lets us sort and drop any
+        # duplicates in one go
+        keys = sorted(set((group << 64) | (source << 32) | target for group, source, target in zip(groups, sources, targets)))
+
+        self.group_start = array('L')
+        self.row_src = array('L')
+        self.row_start = array('L')
+        self.cols = array('L')
+
+        last_group = None
+        last_source = None
+        for key in keys:
+            group = key >> 64
+            source = (key >> 32) & _mask
+            if group != last_group:
+                self.group_start.append(len(self.row_src))
+                last_group = group
+                last_source = None
+            if source != last_source:
+                self.row_src.append(source)
+                self.row_start.append(len(self.cols))
+                last_source = source
+            self.cols.append(key & _mask)
+        self.group_start.append(len(self.row_src))
+        self.row_start.append(len(self.cols))
+
+    def rows(self, group):
+        """Yields (source, targets) for each row in the group"""
+        for row in range(self.group_start[group], self.group_start[group + 1]):
+            yield self.row_src[row], self.cols[self.row_start[row]:self.row_start[row + 1]]
+
+class MappingIndex:
+    def __init__(self):
+        self.groups = Interner()        # (table uri, system)
+        self.codes = Interner()
+        self.cuis = Interner()
+
+        self.edge_group = array('L')
+        self.edge_code = array('L')
+        self.edge_cui = array('L')
+
+        self._forward = None
+        self._reverse = None
+
+    def add(self, table_uri, system, code, cui):
+        """Record that the variable, code, from table_uri maps to cui from the CUI system"""
+        self.edge_group.append(self.groups((table_uri, system)))
+        self.edge_code.append(self.codes(code))
+        self.edge_cui.append(self.cuis(cui))
+        self._forward = None
+        self._reverse = None
+
+    def __len__(self):
+        return len(self.edge_group)
+
+    def dd_to_cui(self):
+        """Yields (table_uri, system, elements) for each group, where elements
+        yields (variable code, [cuis])"""
+        if self._forward is None:
+            self._forward = _Csr(self.edge_group, self.edge_code, self.edge_cui)
+
+        for group in range(len(self.groups)):
+            table_uri, system = self.groups[group]
+            elements = ((self.codes[code], [self.cuis[cui] for cui in cuis]) for code, cuis in self._forward.rows(group))
+            yield table_uri, system, elements
+
+    def cui_to_dd(self):
+        """Yields (table_uri, system, elements) for each group, where elements
+        yields (cui, [variable codes])"""
+        if self._reverse is None:
+            self._reverse = _Csr(self.edge_group, self.edge_cui, self.edge_code)
+
+        for group in range(len(self.groups)):
+            table_uri, system = self.groups[group]
+            elements = ((self.cuis[cui], [self.codes[code] for code in codes]) for cui, codes in self._reverse.rows(group))
+            yield table_uri, system, elements
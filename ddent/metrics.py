@@ -0,0 +1,264 @@
+"""
+Counters, latency histograms and cache hit rates for the ingest pipeline.
+
+A single registry is shared by the whole process. The dbGaP, NLP, terminology
+and FHIR code record what they did as they go:
+
+    counters    - Things that happened (requests, failures, variables, ...)
+    histograms  - How long each stage and each type of external call took
+    caches      - Hits and misses for each of the caches
+    uploads     - Bytes (and resources) sent to the FHIR server per type
+
+At the end of each study, emit() rewrites the JSON run report and, if one
+was requested, the Prometheus text file (suitable for node_exporter's
+textfile collector). See metrics_output().
+"""
+
+import json
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime
+from threading import Lock
+
+# Upper bounds (in seconds) for the latency histograms. Covers everything
+# from an in-process lookup to a very large bundle
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def _label_text(key):
+    return ",".join(f"{name}={value}" for name, value in key)
+
+def _prometheus_labels(key, **extra):
+    labels = list(key) + list(extra.items())
+    if len(labels) == 0:
+        return ""
+    values = [(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for name, value in labels]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in values) + "}"
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)      # The last is everything over the largest bucket
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def cumulative(self):
+        """[(upper bound, observations <= bound)], ending with +Inf"""
+        total = 0
+        result = []
+        for bound, count in zip(list(self.buckets) + [float("inf")], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile (the max if it's
+        beyond the largest bucket)"""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return round(min(bound, self.max), 6)
+        return round(self.max, 6)
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "mean": round(self.sum / self.count, 6) if self.count > 0 else 0.0,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "max": round(self.max, 6)
+        }
+
+class Metrics:
+    def __init__(self):
+        self.lock = Lock()
+        self.started = time.time()
+        self.counters = {}          # (name, labels) => value
+        self.histograms = {}        # (name, labels) => Histogram
+        self.caches = {}            # cache => [hits, misses]
+        self.uploads = {}           # resource type => [resources, bytes]
+        self.studies = []           # per study summaries, in the order they finished
+
+    def incr(self, name, amount=1, **labels):
+        key = (name, _label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        key = (name, _label_key(labels))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the time spent in the with block, even if it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def stage(self, stage):
+        return self.timer("stage_seconds", stage=stage)
+
+    def request(self, service):
+        """Time a call to one of the external services"""
+        return self.timer("request_seconds", service=service)
+
+    def cache(self, cache, hit):
+        with self.lock:
+            counts = self.caches.setdefault(cache, [0, 0])
+            counts[0 if hit else 1] += 1
+
+    def uploaded(self, resource_type, size, resources=1):
+        with self.lock:
+            totals = self.uploads.setdefault(resource_type, [0, 0])
+            totals[0] += resources
+            totals[1] += size
+
+    def study_done(self, accession, variables, seconds):
+        self.incr("studies")
+        self.incr("variables", variables)
+        with self.lock:
+            self.studies.append({
+                "accession": accession,
+                "variables": variables,
+                "seconds": round(seconds, 3),
+                "variables_per_second": round(variables / seconds, 3) if seconds > 0 else 0.0
+            })
+
+    def variables_per_second(self):
+        elapsed = time.time() - self.started
+        if elapsed <= 0:
+            return 0.0
+        return self.counters.get(("variables", ()), 0) / elapsed
+
+    def snapshot(self):
+        """Everything recorded so far, as a JSON serializable dict"""
+        with self.lock:
+            counters = {}
+            for (name, key), value in sorted(self.counters.items()):
+                if len(key) == 0:
+                    counters[name] = value
+                else:
+                    counters.setdefault(name, {})[_label_text(key)] = value
+
+            histograms = {}
+            for (name, key), histogram in sorted(self.histograms.items()):
+                histograms.setdefault(name, {})[_label_text(key) or "all"] = histogram.to_dict()
+
+            caches = {}
+            for cache, (hits, misses) in sorted(self.caches.items()):
+                caches[cache] = {
+                    "hits": hits,
+                    "misses": misses,
+                    "hit_rate": round(hits / (hits + misses), 4) if hits + misses > 0 else 0.0
+                }
+
+            uploads = {resource_type: {"resources": resources, "bytes": size} for resource_type, (resources, size) in sorted(self.uploads.items())}
+
+            return {
+                "started": datetime.fromtimestamp(self.started).isoformat(timespec="seconds"),
+                "elapsed": round(time.time() - self.started, 3),
+                "variables_per_second": round(self.variables_per_second(), 3),
+                "counters": counters,
+                "latency": histograms,
+                "caches": caches,
+                "uploads": uploads,
+                "studies": list(self.studies)
+            }
+
+    def prometheus(self):
+        """The metrics in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            names = sorted(set(name for name, key in self.counters))
+            for name in names:
+                lines.append(f"# TYPE ddent_{name}_total counter")
+                for (counter, key), value in sorted(self.counters.items()):
+                    if counter == name:
+                        lines.append(f"ddent_{name}_total{_prometheus_labels(key)} {value}")
+
+            names = sorted(set(name for name, key in self.histograms))
+            for name in names:
+                lines.append(f"# TYPE ddent_{name} histogram")
+                for (histogram_name, key), histogram in sorted(self.histograms.items()):
+                    if histogram_name != name:
+                        continue
+                    for bound, total in histogram.cumulative():
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append(f"ddent_{name}_bucket{_prometheus_labels(key, le=le)} {total}")
+                    lines.append(f"ddent_{name}_sum{_prometheus_labels(key)} {histogram.sum}")
+                    lines.append(f"ddent_{name}_count{_prometheus_labels(key)} {histogram.count}")
+
+            if len(self.caches) > 0:
+                lines.append("# TYPE ddent_cache_hits_total counter")
+                for cache, (hits, misses) in sorted(self.caches.items()):
+                    lines.append(f"ddent_cache_hits_total{_prometheus_labels((), cache=cache)} {hits}")
+                lines.append("# TYPE ddent_cache_misses_total counter")
+                for cache, (hits, misses) in sorted(self.caches.items()):
+                    lines.append(f"ddent_cache_misses_total{_prometheus_labels((), cache=cache)} {misses}")
+
+            if len(self.uploads) > 0:
+                lines.append("# TYPE ddent_uploaded_resources_total counter")
+                for resource_type, (resources, size) in sorted(self.uploads.items()):
+                    lines.append(f"ddent_uploaded_resources_total{_prometheus_labels((), resource_type=resource_type)} {resources}")
+                lines.append("# TYPE ddent_uploaded_bytes_total counter")
+                for resource_type, (resources, size) in sorted(self.uploads.items()):
+                    lines.append(f"ddent_uploaded_bytes_total{_prometheus_labels((), resource_type=resource_type)} {size}")
+
+        lines.append("# TYPE ddent_variables_per_second gauge")
+        lines.append(f"ddent_variables_per_second {self.variables_per_second()}")
+        return "\n".join(lines) + "\n"
+
+    def report(self):
+        snapshot = self.snapshot()
+        counters = snapshot['counters']
+        return f"Metrics: {counters.get('studies', 0)} studies, {counters.get('variables', 0)} variables in {snapshot['elapsed']:.1f}s ({snapshot['variables_per_second']:.1f} variables/s)"
+
+def _write(filename, text):
+    """Replace the file in one go so nobody (e.g. node_exporter) ever reads a
+    partially written one"""
+    partial = f"{filename}.partial"
+    with open(partial, 'wt') as f:
+        f.write(text)
+    os.replace(partial, filename)
+
+_metrics = Metrics()
+def metrics():
+    return _metrics
+
+_report_file = None
+_prometheus_file = None
+_emit_lock = Lock()             # Concurrent studies may finish at the same time
+
+def metrics_output(report=None, prometheus=None):
+    """Set the files emit() writes the JSON run report and the Prometheus
+    metrics to. Either can be None to skip it"""
+    global _report_file, _prometheus_file
+
+    _report_file = report
+    _prometheus_file = prometheus
+
+def emit():
+    with _emit_lock:
+        if _report_file is not None:
+            _write(_report_file, json.dumps(_metrics.snapshot(), indent=2))
+        if _prometheus_file is not None:
+            _write(_prometheus_file, _metrics.prometheus())
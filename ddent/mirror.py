@@ -0,0 +1,189 @@
+"""
+Local mirror of the dbGaP pages and data dictionaries.
+
+Bodies are stored gzipped on disk under the sha256 of their content, so the
+same dictionary referenced by multiple URLs is only stored once. An SQLite
+index maps each URL to its content along with the ETag/Last-Modified headers
+needed to revalidate it.
+
+Anything whose URL includes a versioned accession (phsNNNNNN.vN.pN) is treated
+as immutable and served straight from the mirror once we have it. Everything
+else is revalidated with a conditional request, falling back to the mirrored
+copy if the server can't be reached. In offline mode, nothing is requested at
+all and only mirrored content is available.
+"""
+
+import gzip
+import io
+import os
+import re
+import sqlite3
+import tempfile
+import time
+from hashlib import sha256
+from pathlib import Path
+from threading import Lock
+
+import requests
+
+from ddent.metrics import metrics
+
+_versioned_accession = re.compile(r'phs[0-9]+\.v[0-9]+\.p[0-9]+')
+
+# Size of the blocks we read from the server while writing to disk
+_chunk_size = 1024 * 1024
+
+def is_immutable(url):
+    return _versioned_accession.search(url) is not None
+
+class MirrorResponse:
+    """Provides the bits of a requests Response that the dbGaP functions use,
+    for content that is served from the mirror"""
+    def __init__(self, url, filename, status_code=200):
+        self.url = url
+        self.filename = filename
+        self.status_code = status_code
+        self._content = None
+
+    @property
+    def raw(self):
+        """File-like object for the (decompressed) body"""
+        if self.filename is None:
+            return io.BytesIO(b"")
+        return gzip.open(self.filename, 'rb')
+
+    @property
+    def content(self):
+        if self._content is None:
+            with self.raw as f:
+                self._content = f.read()
+        return self._content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+class Mirror:
+    def __init__(self, root, offline=False):
+        self.root = Path(root)
+        self.offline = offline
+        self.objects = self.root / "objects"
+        self.objects.mkdir(parents=True, exist_ok=True)
+
+        self.hits = 0
+        self.revalidated = 0
+        self.downloads = 0
+        self.stale = 0
+
+        self.lock = Lock()
+        self.db = sqlite3.connect(self.root / "index.db", check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS urls (
+                                url TEXT PRIMARY KEY,
+                                digest TEXT,
+                                etag TEXT,
+                                last_modified TEXT,
+                                fetched REAL)""")
+        self.db.commit()
+
+    def object_path(self, digest):
+        return self.objects / digest[0:2] / f"{digest}.gz"
+
+    def _entry(self, url):
+        with self.lock:
+            return self.db.execute("SELECT digest, etag, last_modified FROM urls WHERE url=?", (url,)).fetchone()
+
+    def _cached(self, url, digest):
+        return MirrorResponse(url, self.object_path(digest))
+
+    def _store(self, url, response):
+        """Write the body to the mirror, compressing and hashing as we go"""
+        hasher = sha256()
+        fd, tmpname = tempfile.mkstemp(dir=self.objects, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+                    for chunk in response.iter_content(_chunk_size):
+                        hasher.update(chunk)
+                        gz.write(chunk)
+
+            digest = hasher.hexdigest()
+            path = self.object_path(digest)
+            if not path.exists():
+                path.parent.mkdir(exist_ok=True)
+                os.replace(tmpname, path)
+        finally:
+            # Whatever was written of a download that failed part way through
+            # (or a duplicate of content we already have)
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO urls VALUES (?, ?, ?, ?, ?)",
+                            (url, digest, response.headers.get('ETag'), response.headers.get('Last-Modified'), time.time()))
+            self.db.commit()
+        return digest
+
+    def get(self, url, fetch):
+        """Return the response for url, using fetch(url, headers=..., stream=True)
+        to retrieve it only when the mirror can't provide it"""
+        entry = self._entry(url)
+
+        if entry is not None and (self.offline or is_immutable(url)):
+            self.hits += 1
+            metrics().cache("dbgap_mirror", True)
+            return self._cached(url, entry[0])
+
+        if self.offline:
+            print(f"{url} is not available in the mirror")
+            metrics().cache("dbgap_mirror", False)
+            return MirrorResponse(url, None, status_code=504)
+
+        headers = {}
+        if entry is not None:
+            digest, etag, last_modified = entry
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        try:
+            response = fetch(url, headers=headers, stream=True)
+        except requests.exceptions.RequestException as e:
+            if entry is None:
+                raise
+            print(f"Unable to revalidate {url} ({e}). Using the mirrored copy")
+            self.stale += 1
+            metrics().cache("dbgap_mirror", True)
+            return self._cached(url, entry[0])
+
+        if response.status_code == 304 and entry is not None:
+            self.revalidated += 1
+            metrics().cache("dbgap_mirror", True)
+            with self.lock:
+                self.db.execute("UPDATE urls SET fetched=? WHERE url=?", (time.time(), url))
+                self.db.commit()
+            return self._cached(url, entry[0])
+
+        if response.status_code == 200:
+            self.downloads += 1
+            metrics().cache("dbgap_mirror", False)
+            return self._cached(url, self._store(url, response))
+
+        if entry is not None and response.status_code >= 500:
+            self.stale += 1
+            metrics().cache("dbgap_mirror", True)
+            return self._cached(url, entry[0])
+        return response
+
+    def report(self):
+        return f"Mirror {self.root}: {self.hits} served from mirror, {self.revalidated} revalidated, {self.downloads} downloaded, {self.stale} stale"
+
+_mirror = None
+def dbgap_mirror(root=None, offline=False):
+    """Return the mirror if one has been opened. Providing root will open (or
+    create) the mirror used by all of the dbGaP functions"""
+    global _mirror
+
+    if root is not None:
+        _mirror = Mirror(root, offline=offline)
+    return _mirror
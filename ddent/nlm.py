@@ -2,11 +2,15 @@
 
 import re
 from datetime import datetime, timedelta
-import requests
 from pprint import pformat
 import csv
+from queue import Queue, Empty
+from threading import Thread, Lock
+import time
+import warnings
 
-import pdb
+from ddent.sessions import pooled_session
+from ddent.metrics import metrics
 
 _nlm_api_key_url = "https://utslogin.nlm.nih.gov/cas/v1/api-key"
 _nlm_service_ticket_url = "https://utslogin.nlm.nih.gov/cas/v1/tickets/"
@@ -15,6 +19,13 @@ _nlm_fhir_srvr_url = "https://cts.nlm.nih.gov/fhir/r4/"
 # For now, just use this as a var. Once we get the details worked out, 
 # we can move it into a private area
 
+# Service tickets are single use and expire after 5 minutes. We'll toss any
+# prefetched tickets that are getting close to that
+_service_ticket_lifetime = 240
+
+# Number of service tickets kept ready for the next lookups
+DEFAULT_TICKET_POOL_SIZE = 8
+
 tgt_extractor = re.compile(r'action="https://utslogin.nlm.nih.gov/cas/v1/api-key/(TGT-[0-9a-zA-Z-]+)')
 
 _nlm_error_file = None
@@ -37,6 +48,13 @@ def nlm_error_log(fn=None):
     
     return _nlm_error_log
 
+class UtsResponseWarning(UserWarning):
+    """UTS answered, but not with anything we recognize"""
+    def __init__(self, cui, content):
+        self.cui = cui
+        self.content = content
+        super().__init__(f"Unexpected UTS response for {cui}: {pformat(content)}")
+
 class NlmApi:
     # We are defaulting to the 8 hours which applies to the TGT
     class Ticket:
@@ -46,35 +64,91 @@ class NlmApi:
 
         def valid(self):
             return datetime.now() < self.expires
-    def __init__(self, apikey):
+    def __init__(self, apikey, ticket_pool_size=DEFAULT_TICKET_POOL_SIZE):
         self.key = apikey
         self.tgt = None
+        self.tgt_lock = Lock()
+        self.session = pooled_session()
 
-    def get_tgt(self):
-        if self.tgt is None or not self.tgt.valid():
-            response = requests.post(_nlm_api_key_url, 
-                                        data={"apikey":self.key}, 
-                                        headers={'content-type': 'application/x-www-form-urlencoded'})
+        # Service tickets are fetched ahead of time by a background thread
+        # so that each lookup only requires the one request
+        self.tickets = Queue(maxsize=ticket_pool_size)
+        self.ticket_pool_size = ticket_pool_size
+        self.ticket_thread = None
+        self.ticket_lock = Lock()                   # Only the one thread gets started
 
-            if response.status_code == 201:
-                body = response.text
-                match = tgt_extractor.search(body)
-                if match:
-                    self.tgt = NlmApi.Ticket(match.groups()[0])
+    def get_tgt(self):
+        with self.tgt_lock:
+            if self.tgt is None or not self.tgt.valid():
+                response = self.session.post(_nlm_api_key_url, 
+                                            data={"apikey":self.key}, 
+                                            headers={'content-type': 'application/x-www-form-urlencoded'})
+
+                if response.status_code == 201:
+                    body = response.text
+                    match = tgt_extractor.search(body)
+                    if match:
+                        self.tgt = NlmApi.Ticket(match.groups()[0])
 
         return self.tgt 
 
-    def _get(self, endpt):
+    def request_service_ticket(self):
+        """Returns (ticket, response) where ticket will be None if UTS refused
+        to issue one"""
         tgt = self.get_tgt()
 
         ticket_url = f"{_nlm_service_ticket_url}{tgt.ticket}"
-        response = requests.post(ticket_url, 
-                                    data={'service': 'http://umlsks.nlm.nih.gov'}, 
-                                    headers={'content-type': 'application/x-www-form-urlencoded'})
+        with metrics().request("uts_ticket"):
+            response = self.session.post(ticket_url, 
+                                        data={'service': 'http://umlsks.nlm.nih.gov'}, 
+                                        headers={'content-type': 'application/x-www-form-urlencoded'})
         if response.status_code == 200:
             # And the response text should be the key
-            ticket = response.text 
-            return requests.get(f"{endpt}?ticket={ticket}")
+            return (response.text, response)
+        metrics().incr("request_errors", service="uts_ticket")
+        return (None, response)
+
+    def _prefetch_tickets(self):
+        """Keep the ticket queue topped off. put blocks while the queue is full"""
+        while True:
+            try:
+                ticket, response = self.request_service_ticket()
+            except Exception as e:
+                ticket = None
+                print(f"Unable to prefetch a service ticket: {e}")
+
+            if ticket is None:
+                # Don't hammer UTS if it's unhappy with us
+                time.sleep(5)
+            else:
+                self.tickets.put((ticket, time.time()))
+
+    def get_service_ticket(self):
+        if self.ticket_pool_size > 0 and self.ticket_thread is None:
+            with self.ticket_lock:
+                if self.ticket_thread is None:
+                    self.ticket_thread = Thread(target=self._prefetch_tickets, daemon=True)
+                    self.ticket_thread.start()
+
+        try:
+            while True:
+                ticket, fetched = self.tickets.get_nowait()
+                if time.time() - fetched < _service_ticket_lifetime:
+                    return (ticket, None)
+        except Empty:
+            pass
+
+        # The prefetch couldn't keep up (or we aren't prefetching at all)
+        return self.request_service_ticket()
+
+    def _get(self, endpt):
+        ticket, response = self.get_service_ticket()
+        if ticket is not None:
+            with metrics().request("uts"):
+                response = self.session.get(f"{endpt}?ticket={ticket}")
+            if response.status_code >= 300:
+                metrics().incr("request_errors", service="uts")
+            return response
         print(response.text)
         return response
 
@@ -97,7 +171,10 @@ class NlmApi:
     def get_rxnorm(self, id, source):
         url = f"https://rxnav.nlm.nih.gov/REST/rxcui/{id}.json"
         print(f"The URL: {url}")
-        response = requests.get(url)
+        with metrics().request("rxnav"):
+            response = self.session.get(url)
+        if response.status_code != 200:
+            metrics().incr("request_errors", service="rxnav")
         if response.status_code == 200:
             content = response.json()
 
@@ -124,8 +201,15 @@ class NlmApi:
         try:
             content = response.json()
             if 'name' not in content['result']:
-                print(pformat(content))
-                pdb.set_trace()
+                # This runs on the NLP and resolution workers, so one odd
+                # response mustn't hold the rest of the batch up
+                warnings.warn(UtsResponseWarning(cui, content), stacklevel=2)
+                nlm_error_write(source, 'UMLS', cui)
+                return {
+                    "system": "http://terminology.hl7.org/CodeSystem/umls",
+                    "code": cui,
+                    "display": f"No Matching Concept Found For '{source}'"
+                }
             cui_name = content['result']['name']
             #print(f"The name for {cui}: {cui_name}")
 
@@ -4,21 +4,53 @@ Provide a common interface for different NLP systems.
 
 from pathlib import Path
 from importlib import import_module
-from collections import defaultdict
+from collections.abc import Mapping
+from threading import Lock
+from copy import copy
+from concurrent.futures import ThreadPoolExecutor
 import sys
 import requests
 
+from ddent.nlp.cache import nlp_cache, probe_cache
+from ddent.metrics import metrics
+
 import pdb
 
+# A dead endpoint shouldn't hold up startup for long. The connection is what
+# matters, but a server that takes ages to answer isn't much use either
+PROBE_CONNECT_TIMEOUT = 1.0
+PROBE_READ_TIMEOUT = 3.0
+
+def normalize_text(text):
+    """Collapse runs of whitespace so that trivially different definitions
+    are submitted (and cached) as the same text"""
+    return " ".join(text.split())
+
+def canonical_text(text):
+    """Key used to group definitions which only differ by whitespace or case. 
+    Texts whose lowercase form changes length are left as is, since the NLP 
+    locations can't be shared between them"""
+    text = normalize_text(text)
+    canonical = text.lower()
+    if len(canonical) != len(text):
+        return text
+    return canonical
+
 def camelize(val):
     """Convert a snake-case filename to it's CameCase object name"""
     return val.title().replace("_", "")
 
-# Cache the NLP modules in case we need to generate more than one
-_modules = None
+# Configuration the modules are created with
+_config = {}
+
+# module id => NLP module, for the modules that have been loaded so far
+_modules = {}
+
+# sorted list of modules which were found to be "live". None until the 
+# modules have been probed
+_active_modules = None
 
-# sorted list of modules which were found to be "live" 
-_active_modules = []
+_modules_lock = Lock()
 
 _default_module = None
 
@@ -30,58 +62,153 @@ def default_nlp_module(pref=None):
     
     return _default_module
 
-def get_extraction_modules(config):
-    """Return the available auth modules, scanning the fhir_auth directory if necessary to find all modules."""
-    global _modules, _active_modules
+def module_ids():
+    """The ids of the NLP modules, i.e. the nlp_*.py filenames, found without
+    importing any of them"""
+    return sorted(module.stem for module in Path(__file__).parent.glob("nlp_*.py"))
 
-    # We'll cache the scan to avoid having to redo this work over again
-    if _modules is None:
-        _modules = {}
-        # Discover all of the authentication modules
-        mod_dir = Path(__file__).parent
+def load_module(module_id):
+    """Import and create the module the first time it is asked for"""
+    with _modules_lock:
+        if module_id not in _modules:
+            mod = import_module(f"ddent.nlp.{module_id}")
 
-        module_ratings = defaultdict(list)
+            # The class is presumed to be the camelcase version of the filename 
+            _modules[module_id] = getattr(mod, camelize(module_id))(_config)
+        return _modules[module_id]
 
-        module_files = mod_dir.glob("nlp_*.py")
-        for module in module_files:
-            # IDs are just the name of the module's filename without path or extension
-            module_id = module.stem
-            module_name = f"ddent.nlp.{module_id}"
-            mod = import_module(module_name)
+class NlpModules(Mapping):
+    """module id => NLP module. Modules are only imported when they are used"""
+    def __getitem__(self, module_id):
+        if module_id not in module_ids():
+            raise KeyError(module_id)
+        return load_module(module_id)
 
-            # The class is presumed to be the camelcase version of the filename 
-            # TODO Decide if its better to drop the Auth from those camel case classnames?
-            module_class_name = camelize(module_id)
-            auth_class = getattr(mod, module_class_name)
+    def __iter__(self):
+        return iter(module_ids())
 
-            # Add the class to the cache so that we can instantiate it if need be
-            nlp_module = auth_class(config)
-            _modules[module_id] = nlp_module
+    def __len__(self):
+        return len(module_ids())
 
-            if nlp_module.is_live():
-                module_ratings[nlp_module.rating].append(nlp_module)
-        
-        for rating in sorted(module_ratings.keys())[::-1]:
-            _active_modules += module_ratings[rating]
+def get_extraction_modules(config=None):
+    """Return the available NLP modules. Providing config (re)configures them,
+    which replaces any modules that were already loaded"""
+    global _config, _active_modules
+
+    if config is not None:
+        with _modules_lock:
+            _config = config
+            _modules.clear()
+            _active_modules = None
+    return NlpModules()
+
+def active_modules():
+    """The live modules, highest rated first. The first time through, every
+    module is loaded and they are all probed at once"""
+    global _active_modules
+
+    if _active_modules is None:
+        modules = [load_module(module_id) for module_id in module_ids()]
+        with ThreadPoolExecutor(max_workers=max(len(modules), 1)) as executor:
+            live = list(executor.map(lambda module: module.is_live(), modules))
+
+        _active_modules = sorted([module for module, is_live in zip(modules, live) if is_live], key=lambda module: module.get_rating(), reverse=True)
 
         # Go ahead and set the default to be the first active module with 
         # the highest rating
-        default_nlp_module(_active_modules[0])
-
-    return _modules
+        if len(_active_modules) > 0:
+            default_nlp_module(_active_modules[0])
+    return _active_modules
 
 def get_nlp(nlp_id = None):
-    """return an apprpriate authorization object based on the details inside cfg"""   
-    global _modules
+    """Return the NLP module with the given id or, by default, the highest 
+    rated one that is live. Only the module asked for is loaded"""
+    if nlp_id is not None:
+        return get_extraction_modules().get(nlp_id)
 
-    if len(_active_modules) < 1:
+    if len(active_modules()) < 1:
         print(f"Houston, we have a problem. There are no valid NLP servers available")
         sys.exit(1)
 
-    if nlp_id is None:
-        return _active_modules[0]
+    return _active_modules[0]
+
+def extract_cuis(nlp_module, texts, workers=1, dedupe=True, resolve=True, batch_size=None):
+    """Run each of the texts through the NLP module, returning a list of 
+    NlpResult lists in the same order as texts. Empty texts are not submitted. 
+
+    workers is the number of requests that will be in flight at one time. The
+    NLP work is mostly waiting on the remote server, so threads are sufficient
+
+    When dedupe is true, texts which differ only by whitespace or case are 
+    submitted once and the results are shared by all of the copies
+
+    When resolve is false, the concepts will not be identified (see 
+    ddent.terminologies.resolve_concepts)
+
+    When batch_size is greater than one, the texts are submitted batch_size at
+    a time using the module's get_cuis_batch, with workers batches in flight.
+    By default, the module's own batch size (get_batch_size) is used"""
+    def get_cuis(text):
+        if text is None or text.strip() == "":
+            return []
+        return nlp_module.get_cuis(text, resolve=resolve)
+
+    def get_cuis_batch(batch):
+        return nlp_module.get_cuis_batch([text or "" for text in batch], resolve=resolve)
+
+    if not dedupe:
+        unique_texts = texts
+        text_index = list(range(len(texts)))
+    else:
+        unique_texts = []
+        text_index = []
+        groups = {}             # canonical text => index into unique_texts
+        for text in texts:
+            if text is None or text.strip() == "":
+                key = ""
+            else:
+                key = canonical_text(text)
+
+            if key not in groups:
+                groups[key] = len(unique_texts)
+                unique_texts.append(text)
+            text_index.append(groups[key])
+
+        # Empty definitions aren't submitted, so they don't count either way
+        submitted = len(texts) - text_index.count(groups.get("", -1))
+        unique = len(unique_texts) - int("" in groups)
+        if submitted > 0:
+            print(f"NLP: {submitted} definitions, {unique} unique ({1 - unique/submitted:.1%} deduplicated)")
+
+    if batch_size is None:
+        batch_size = nlp_module.get_batch_size()
 
-    return get_extraction_modules().get(nlp_id)
+    if batch_size > 1:
+        batches = [unique_texts[i:i + batch_size] for i in range(0, len(unique_texts), batch_size)]
+        if workers is None or workers < 2:
+            batch_results = [get_cuis_batch(batch) for batch in batches]
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                batch_results = list(executor.map(get_cuis_batch, batches))
+        unique_results = [cuis for batch in batch_results for cuis in batch]
+    elif workers is None or workers < 2:
+        unique_results = [get_cuis(text) for text in unique_texts]
+    else:
+        # map returns the results in submission order regardless of which 
+        # request actually finished first
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            unique_results = list(executor.map(get_cuis, unique_texts))
+
+    results = []
+    for text, idx in zip(texts, text_index):
+        cuis = unique_results[idx]
+
+        # Copies that differ in case from the text we actually submitted
+        # need their own results so that the matched text is correct
+        if len(cuis) > 0 and normalize_text(text) != cuis[0].source_text:
+            cuis = [cui.rebase(normalize_text(text)) for cui in cuis]
+        results.append(cuis)
+    return results
 
 class NlpResult:
     def __init__(self, concept, loc_start, loc_end, source_text, semantics=None, assertion=None, entity=None, probability=None):#          concept, entry, source_text):
@@ -99,6 +226,30 @@ class NlpResult:
     def system(self):
         return self.concept['system']
 
+    def to_dict(self):
+        """Everything but the source text, which is expected to be saved elsewhere"""
+        return {
+            "concept": self.concept,
+            "loc_start": self.start_loc,
+            "loc_end": self.end_loc,
+            "semantics": self.semantics,
+            "assertion": self.assertion,
+            "entity": self.entity,
+            "probability": self.concept_prob
+        }
+
+    @classmethod
+    def from_dict(cls, data, source_text):
+        return cls(source_text=source_text, **data)
+
+    def rebase(self, source_text):
+        """Return a copy of the result for a source text that differs only in
+        case (i.e. the locations are still valid)"""
+        result = copy(self)
+        result.source_text = source_text
+        result.matched_text = source_text[int(self.start_loc):int(self.end_loc)]
+        return result
+
     def definition(self):
         entries = ["<ul>"]
 
@@ -123,19 +274,113 @@ class NlpBase:
     def get_rating(self):
         return self.rating
 
-    def get_cuis(self, text):
+    def get_batch_size(self):
+        """Number of texts extract_cuis submits at a time unless told otherwise"""
+        return 1
+
+    def module_id(self):
+        """The id used by get_extraction_modules, i.e. the module's filename"""
+        return type(self).__module__.split(".")[-1]
+
+    def get_cuis(self, text, resolve=True):
+        """Return the list of NlpResults for text. The raw response from the 
+        NLP system will be pulled from the NLP cache when possible. 
+
+        If resolve is false, the concepts will only contain system and code and
+        must be identified afterward"""
+        text = normalize_text(text)
+        cache = nlp_cache()
+
+        payload = None
+        if cache is not None:
+            payload = cache.get(self.module_id(), self.endpoint, text)
+
+        if payload is None:
+            with metrics().request(self.module_id()):
+                payload = self.extract(text)
+            if payload is None:
+                metrics().incr("request_errors", service=self.module_id())
+                return []
+
+            if cache is not None:
+                cache.put(self.module_id(), self.endpoint, text, payload)
+        return self.build_results(payload, text, resolve=resolve)
+
+    def get_cuis_batch(self, texts, resolve=True):
+        """Return a list of NlpResult lists, one for each of the texts. Anything
+        not in the NLP cache is submitted using extract_batch, so modules that
+        can handle several texts in one request only pay for one round trip"""
+        texts = [normalize_text(text) for text in texts]
+        cache = nlp_cache()
+
+        payloads = [None] * len(texts)
+        for idx, text in enumerate(texts):
+            if cache is not None and text != "":
+                payloads[idx] = cache.get(self.module_id(), self.endpoint, text)
+
+        missing = [idx for idx, text in enumerate(texts) if payloads[idx] is None and text != ""]
+        if len(missing) > 0:
+            with metrics().request(self.module_id()):
+                extracted = self.extract_batch([texts[idx] for idx in missing])
+
+            for idx, payload in zip(missing, extracted):
+                if payload is None:
+                    metrics().incr("request_errors", service=self.module_id())
+                    continue
+                payloads[idx] = payload
+                if cache is not None:
+                    cache.put(self.module_id(), self.endpoint, texts[idx], payload)
+
+        return [[] if payload is None else self.build_results(payload, text, resolve=resolve) for text, payload in zip(texts, payloads)]
+
+    def extract(self, text):
+        """Submit the text to the NLP system and return the raw response, which
+        must be JSON serializable. None indicates that the request failed"""
+        pass
+
+    def extract_batch(self, texts):
+        """Return the raw responses for each of the texts, as extract would.
+        Modules which can't submit several texts at once just use extract"""
+        return [self.extract(text) for text in texts]
+
+    def build_results(self, payload, text, resolve=True):
+        """Transform the raw response from extract into a list of NlpResults"""
+        return []
+
+    def close(self):
+        """Release anything the module is holding on to (e.g. worker processes)"""
         pass
 
     def is_live(self):
-        if self.endpoint:
-            try:
-                response = requests.get(self.endpoint, timeout=6.0)
-                # It doesn't really matter what the response is as long as it doesn't
-                # fail to connect
-                return True
-            except:
-                print(f"No meaningful response from: {self.endpoint}")
-                pass
-        print(f"No endpoint configured for the module {type(self).__name__}")
-        return False
+        """Whether the module's endpoint is up. Probe results are kept in the
+        probe cache (if one has been opened) for a little while, so that 
+        starting another worker doesn't have to probe again"""
+        if not self.endpoint:
+            print(f"No endpoint configured for the module {type(self).__name__}")
+            return False
+        return self.endpoint_live(self.endpoint)
+
+    def endpoint_live(self, endpoint):
+        """is_live for one particular endpoint (modules may have several)"""
+        cache = probe_cache()
+        live = None
+        if cache is not None:
+            live = cache.get(endpoint)
+
+        if live is None:
+            live = self.probe(endpoint)
+            if cache is not None:
+                cache.put(endpoint, live)
+        return live
 
+    def probe(self, endpoint=None):
+        if endpoint is None:
+            endpoint = self.endpoint
+        try:
+            requests.get(endpoint, timeout=(PROBE_CONNECT_TIMEOUT, PROBE_READ_TIMEOUT))
+            # It doesn't really matter what the response is as long as it doesn't
+            # fail to connect
+            return True
+        except requests.exceptions.RequestException:
+            print(f"No meaningful response from: {endpoint}")
+            return False
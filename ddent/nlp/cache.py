@@ -0,0 +1,210 @@
+"""
+Persistent caches for the NLP modules: the raw responses they return and
+whether their endpoints are up.
+
+Entries are keyed by the NLP module, its endpoint and the (normalized) text
+that was submitted, so sibling versions of a study, or simply rerunning the
+same study, don't have to go back to the NLP server for definitions that have
+already been seen. The cache is a single SQLite file and is trimmed back,
+least recently used first, whenever the payloads exceed max_size bytes.
+
+The probe cache remembers which endpoints answered their liveness probe for a
+short while, so that starting the CLI or another worker doesn't have to wait
+on the probes again.
+"""
+
+import os
+import sqlite3
+import json
+import time
+from hashlib import sha1
+from threading import Lock
+
+from ddent.metrics import metrics
+
+# 1GB worth of payloads before we start evicting older entries
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+# Liveness probes are trusted for 5 minutes, but an endpoint that was down is
+# given another chance sooner
+DEFAULT_PROBE_TTL = 5 * 60
+DEFAULT_DEAD_PROBE_TTL = 30
+
+# When we do evict, we'll clear out a bit more than necessary so that we
+# aren't evicting on every subsequent write
+_eviction_target = 0.9
+
+# Hits only update the entry's last use in memory. They are written out this
+# many at a time (or with the next put, eviction or close), so a warm cache
+# doesn't commit on every lookup
+_touch_batch = 1000
+
+class NlpCache:
+    def __init__(self, filename, max_size=DEFAULT_MAX_SIZE):
+        self.filename = filename
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.touched = {}           # key => last used, not yet written
+
+        # The NLP workers will be hitting the cache from multiple threads
+        self.lock = Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS nlp_results (
+                                key TEXT PRIMARY KEY,
+                                module TEXT,
+                                endpoint TEXT,
+                                text TEXT,
+                                payload TEXT,
+                                size INTEGER,
+                                last_used REAL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS nlp_results_last_used ON nlp_results(last_used)")
+        self.db.commit()
+
+        self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM nlp_results").fetchone()[0]
+
+    @classmethod
+    def key(cls, module, endpoint, text):
+        return sha1(f"{module}\0{endpoint}\0{text}".encode("utf-8")).hexdigest()
+
+    def get(self, module, endpoint, text):
+        """Return the payload previously stored for the text, or None"""
+        key = NlpCache.key(module, endpoint, text)
+
+        with self.lock:
+            row = self.db.execute("SELECT payload FROM nlp_results WHERE key=?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                metrics().cache("nlp_cache", False)
+                return None
+
+            self.hits += 1
+            metrics().cache("nlp_cache", True)
+            self.touched[key] = time.time()
+            if len(self.touched) >= _touch_batch:
+                self._write_touched()
+                self.db.commit()
+        return json.loads(row[0])
+
+    def _write_touched(self):
+        """Record the last use of the entries hit since the last write. Caller
+        is expected to hold the lock (and commit)"""
+        if len(self.touched) > 0:
+            self.db.executemany("UPDATE nlp_results SET last_used=? WHERE key=?", [(used, key) for key, used in self.touched.items()])
+            self.touched = {}
+
+    def put(self, module, endpoint, text, payload):
+        key = NlpCache.key(module, endpoint, text)
+        data = json.dumps(payload)
+        size = len(data)
+
+        with self.lock:
+            previous = self.db.execute("SELECT size FROM nlp_results WHERE key=?", (key,)).fetchone()
+            if previous is not None:
+                self.size -= previous[0]
+
+            self.db.execute("INSERT OR REPLACE INTO nlp_results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (key, module, endpoint, text, data, size, time.time()))
+            self.touched.pop(key, None)
+            self._write_touched()
+            self.size += size
+
+            if self.size > self.max_size:
+                self._evict()
+            self.db.commit()
+
+    def _evict(self):
+        """Drop the least recently used entries until we are safely under max_size.
+        Caller is expected to hold the lock"""
+        target = self.max_size * _eviction_target
+        rows = self.db.execute("SELECT key, size FROM nlp_results ORDER BY last_used")
+
+        evicted = []
+        for key, size in rows:
+            if self.size <= target:
+                break
+            evicted.append((key,))
+            self.size -= size
+        rows.close()
+
+        self.db.executemany("DELETE FROM nlp_results WHERE key=?", evicted)
+        self.evictions += len(evicted)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return self.hits / lookups
+
+    def report(self):
+        return f"NLP Cache {self.filename}: {self.hits} hits, {self.misses} misses ({self.hit_rate():.1%}), {self.evictions} evicted, {self.size} bytes"
+
+    def close(self):
+        with self.lock:
+            self._write_touched()
+            self.db.commit()
+            self.db.close()
+
+_nlp_cache = None
+def nlp_cache(filename=None, max_size=DEFAULT_MAX_SIZE):
+    """Return the NLP cache if one has been opened. Providing a filename will
+    open (or create) the cache to be used by all NLP modules"""
+    global _nlp_cache
+
+    if filename is not None:
+        _nlp_cache = NlpCache(filename, max_size=max_size)
+    return _nlp_cache
+
+class ProbeCache:
+    """Liveness probe results kept in a small JSON file"""
+    def __init__(self, filename, ttl=DEFAULT_PROBE_TTL, dead_ttl=DEFAULT_DEAD_PROBE_TTL):
+        self.filename = filename
+        self.ttl = ttl
+        self.dead_ttl = dead_ttl
+        self.lock = Lock()
+
+        self.probes = {}            # endpoint => [live, time probed]
+        try:
+            with open(filename, 'rt') as f:
+                self.probes = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def get(self, endpoint):
+        """Return whether the endpoint was live when last probed, or None if
+        that was too long ago to trust"""
+        with self.lock:
+            probe = self.probes.get(endpoint)
+        if probe is None:
+            return None
+
+        live, probed = probe
+        ttl = self.ttl
+        if not live:
+            ttl = self.dead_ttl
+        if time.time() - probed < ttl:
+            return live
+        return None
+
+    def put(self, endpoint, live):
+        with self.lock:
+            self.probes[endpoint] = [live, time.time()]
+
+            # Other workers may be reading the file, so replace it in one go
+            partial = f"{self.filename}.{os.getpid()}.partial"
+            with open(partial, 'wt') as f:
+                json.dump(self.probes, f)
+            os.replace(partial, self.filename)
+
+_probe_cache = None
+def probe_cache(filename=None, ttl=DEFAULT_PROBE_TTL, dead_ttl=DEFAULT_DEAD_PROBE_TTL):
+    """Return the probe cache if one has been opened. Providing a filename 
+    will open (or create) it"""
+    global _probe_cache
+
+    if filename is not None:
+        _probe_cache = ProbeCache(filename, ttl=ttl, dead_ttl=dead_ttl)
+    return _probe_cache
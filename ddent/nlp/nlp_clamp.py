@@ -1,43 +1,159 @@
 from ddent.nlp import NlpBase, NlpResult
 from ddent.terminologies import match_terms
 
+from ddent.nlp.pool import EndpointPool, EndpointFailure
+
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
 import requests
 
 DEFAULT_ENDPOINT='http://localhost:8080'
 
+# (connect, read) seconds. Without a read timeout, an instance that hangs
+# would never be failed over
+DEFAULT_TIMEOUT = (5.0, 120.0)
+
+# Goes between the texts packed into a single request. CLAMP treats the blank
+# line as a sentence break, so concepts don't run from one text into the next
+BATCH_SEPARATOR = "\n\n"
+
+# The texts go in the query string, so keep each request comfortably under
+# the URL limits of the servlet container CLAMP runs in. The limit is on the
+# encoded request, so this is measured in UTF-8 bytes rather than characters
+MAX_BATCH_BYTES = 4000
+
+_separator_bytes = len(BATCH_SEPARATOR.encode("utf-8"))
+
+def _results(response):
+    """The results from a CLAMP response. Errors on CLAMP's end are the
+    instance's problem, so another instance can be tried. Anything else is
+    down to the text and gets None"""
+    if response.status_code >= 500:
+        raise EndpointFailure(f"HTTP {response.status_code}")
+    if response.status_code >= 300:
+        return None
+    return response.json()['Results']
+
 class NlpClamp(NlpBase):
     def __init__(self, config):
         self.endpoint = DEFAULT_ENDPOINT
         self.rating = 100 
+        self.timeout = DEFAULT_TIMEOUT
+        endpoints = DEFAULT_ENDPOINT
 
         if 'CLAMP' in config:
-            self.endpoint = config['CLAMP'].get(DEFAULT_ENDPOINT)
+            # The endpoint may be a list of interchangeable CLAMP instances,
+            # which the requests are spread across
+            endpoints = config['CLAMP'].get('endpoint', DEFAULT_ENDPOINT)
 
             # By default, we'll assign CLAMP a reasonably high rating so 
             # that it's easy to sort alternates above or below it
-            self.rating = config['CLAMP'].get(100)
+            self.rating = config['CLAMP'].get('rating', 100)
+            self.timeout = config['CLAMP'].get('timeout', DEFAULT_TIMEOUT)
         else:
             print("No CLAMP settings found in configuration. Using default settings.")
-    def get_cuis(self, text):
+
+        self.instances = EndpointPool(endpoints)
+
+        # The instances are expected to run the same pipeline, so the first
+        # one stands in for all of them in the NLP cache
+        self.endpoint = self.instances.urls[0]
+
+    def is_live(self):
+        """Probe all of the instances at once. The dead ones are ejected from
+        the pool, and CLAMP is live as long as any of them are"""
+        urls = self.instances.urls
+        with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+            live = list(executor.map(self.endpoint_live, urls))
+
+        for url, endpoint_live in zip(urls, live):
+            if not endpoint_live and len(urls) > 1:
+                self.instances.eject(url)
+        return any(live)
+
+    def extract(self, text):
+        def request(endpoint):
+            return _results(requests.get(f"{endpoint}/getJson", params={"text": text}, timeout=self.timeout))
+        return self.instances.request(request)
+
+    def extract_batch(self, texts):
+        payloads = []
+        for group in self.pack(texts):
+            payloads += self.extract_packed(group)
+        return payloads
+
+    def pack(self, texts):
+        """Split the texts into groups that fit within MAX_BATCH_BYTES once they
+        are joined together. A text that is too long on its own goes by itself"""
+        group = []
+        size = 0
+        for text in texts:
+            text_size = len(text.encode("utf-8"))
+            if len(group) > 0 and size + _separator_bytes + text_size > MAX_BATCH_BYTES:
+                yield group
+                group = []
+                size = 0
+            if len(group) > 0:
+                size += _separator_bytes
+            group.append(text)
+            size += text_size
+
+        if len(group) > 0:
+            yield group
+
+    def extract_packed(self, texts):
+        """Submit the texts as a single document and divide CLAMP's results
+        among them, shifting the locations so that they are relative to the
+        text each result was found in. Results that span a separator are 
+        dropped"""
+        if len(texts) == 1:
+            return [self.extract(texts[0])]
+
+        starts = []
+        position = 0
+        for text in texts:
+            starts.append(position)
+            position += len(text) + len(BATCH_SEPARATOR)
+
+        def request(endpoint):
+            return _results(requests.get(f"{endpoint}/getJson", params={"text": BATCH_SEPARATOR.join(texts)}, timeout=self.timeout))
+
+        results = self.instances.request(request)
+        if results is None:
+            return [None] * len(texts)
+
+        payloads = [[] for text in texts]
+        for result in results:
+            idx = bisect_right(starts, int(result['Location_Start'])) - 1
+            start = int(result['Location_Start']) - starts[idx]
+            end = int(result['Location_End']) - starts[idx]
+            if idx < 0 or end > len(texts[idx]):
+                continue
+
+            result = dict(result)
+            result['Location_Start'] = start
+            result['Location_End'] = end
+            payloads[idx].append(result)
+        return payloads
+
+    def build_results(self, payload, text, resolve=True):
         cui_results = []
-        cuis = requests.get(f"{self.endpoint}/getJson?text={text}")
-        if cuis.status_code < 300:
-            for result in cuis.json()['Results']:
-                if 'CUI' in result and result['CUI'] is not None:
-                    cui_list = match_terms(result, text)
-
-                    for cui in cui_list:
-                        if cui is not None:
-                            cui_results.append(NlpResult(
-                                concept=cui, 
-                                source_text=text,
-                                loc_start=result['Location_Start'],
-                                loc_end=result['Location_End'],
-                                semantics=result['Semantics'],
-                                assertion=result['Assertion'],
-                                entity=result['Entity'],
-                                probability=result.get('Concept_Prob')
-                            ))
+        for result in payload:
+            if 'CUI' in result and result['CUI'] is not None:
+                cui_list = match_terms(result, text, resolve=resolve)
+
+                for cui in cui_list:
+                    if cui is not None:
+                        cui_results.append(NlpResult(
+                            concept=cui, 
+                            source_text=text,
+                            loc_start=result['Location_Start'],
+                            loc_end=result['Location_End'],
+                            semantics=result['Semantics'],
+                            assertion=result['Assertion'],
+                            entity=result['Entity'],
+                            probability=result.get('Concept_Prob')
+                        ))
         
         return cui_results
 
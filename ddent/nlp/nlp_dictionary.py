@@ -0,0 +1,286 @@
+"""
+In-process concept recognition using a local term list.
+
+Rather than sending each definition to an NLP server, the terms are compiled
+into an Aho-Corasick automaton over word tokens, so every term in the list is
+found in a single pass over the text. Matches are case insensitive and always
+cover whole words. Where matches overlap, the longest leftmost one wins.
+
+The term list is either a tab delimited file with a CUI, a term and
+(optionally) the semantic type on each line:
+
+    C0004096	asthma	T047
+    C0018810	heart rate	T201
+
+or a UMLS MRCONSO.RRF file, in which case all of the English strings are
+used (which takes a good deal of memory). Each CUI is displayed with its
+preferred term, i.e. the first one listed for it or, for MRCONSO, the
+preferred string, so nothing needs to be looked up remotely. Configure it
+with:
+
+    {"DICTIONARY": {"terms": "terms.tsv", "processes": 8, "rating": 50}}
+
+Batches (see NlpBase.get_cuis_batch) of at least MIN_POOL_BATCH texts are
+spread across processes worker processes. Unless the caller says otherwise,
+extract_cuis hands the module batches big enough for that.
+"""
+
+import csv
+import multiprocessing
+import os
+import re
+from pathlib import Path
+from threading import Lock
+
+from ddent.nlp import NlpBase, NlpResult
+from ddent.terminologies import match_terms, add_concept
+
+# Terms shorter than this (e.g. "of", "A") match far too much to be useful
+DEFAULT_MIN_LENGTH = 3
+
+# Smaller batches are cheaper to handle in process than to ship to the workers
+MIN_POOL_BATCH = 64
+
+_token = re.compile(r"[A-Za-z0-9]+")
+_umls_cui = re.compile(r"C[0-9]+")
+
+UMLS_URL = "http://terminology.hl7.org/CodeSystem/umls"
+
+def tokenize(text):
+    """[(lowercase token, start, end)]"""
+    return [(match.group(0).lower(), match.start(), match.end()) for match in _token.finditer(text)]
+
+def read_terms(filename):
+    """Yields (cui, term, semantics, rank) for each of the terms in the file.
+    Lower ranks are preferred, which for a term list is simply the order the
+    terms are listed in"""
+    if Path(filename).suffix.upper() == ".RRF":
+        from ddent.rrf import umls_names
+        for cui, rank, term in umls_names(filename):
+            yield (cui, term, None, rank)
+        return
+
+    with open(filename, "rt", encoding="utf-8", newline="") as f:
+        for line, row in enumerate(csv.reader(f, delimiter="\t", quoting=csv.QUOTE_NONE)):
+            if len(row) < 2 or row[0].startswith("#"):
+                continue
+            semantics = None
+            if len(row) > 2 and row[2].strip() != "":
+                semantics = row[2].strip()
+            yield (row[0].strip(), row[1], semantics, line)
+
+class TermAutomaton:
+    """Aho-Corasick automaton whose alphabet is the (lowercase) word tokens"""
+    def __init__(self, terms, min_length=DEFAULT_MIN_LENGTH):
+        self.goto = [{}]            # node => {token => node}
+        self.fail = [0]
+        self.depth = [0]            # number of tokens from the root
+        self.concepts = [None]      # node => ((cui, semantics), ...) for the terms ending there
+        self.match_link = [0]       # nearest node down the fail chain with concepts (0 for none)
+        self.terms = 0
+
+        for cui, term, semantics in terms:
+            if len(term) < min_length:
+                continue
+            tokens = [token for token, start, end in tokenize(term)]
+            if len(tokens) > 0:
+                self.add(tokens, cui, semantics)
+        self._link()
+
+    def add(self, tokens, cui, semantics):
+        node = 0
+        for token in tokens:
+            next_node = self.goto[node].get(token)
+            if next_node is None:
+                next_node = len(self.goto)
+                self.goto[node][token] = next_node
+                self.goto.append({})
+                self.fail.append(0)
+                self.depth.append(self.depth[node] + 1)
+                self.concepts.append(None)
+                self.match_link.append(0)
+            node = next_node
+
+        concept = (cui, semantics)
+        if self.concepts[node] is None:
+            self.concepts[node] = (concept,)
+            self.terms += 1
+        elif concept not in self.concepts[node]:
+            self.concepts[node] += (concept,)
+
+    def _link(self):
+        """Breadth first, so each node's fail node is linked before it is"""
+        queue = list(self.goto[0].values())
+        position = 0
+        while position < len(queue):
+            node = queue[position]
+            position += 1
+
+            for token, child in self.goto[node].items():
+                fail = self.fail[node]
+                while fail != 0 and token not in self.goto[fail]:
+                    fail = self.fail[fail]
+                if token in self.goto[fail]:
+                    fail = self.goto[fail][token]
+                self.fail[child] = fail if fail != child else 0
+
+                if self.concepts[self.fail[child]] is not None:
+                    self.match_link[child] = self.fail[child]
+                else:
+                    self.match_link[child] = self.match_link[self.fail[child]]
+                queue.append(child)
+
+    def matches(self, text):
+        """[(start, end, concepts)] for the longest, leftmost terms found in
+        the text, which don't overlap"""
+        tokens = tokenize(text)
+        found = []                  # (first token, last token, concepts)
+        node = 0
+        for idx, (token, start, end) in enumerate(tokens):
+            while node != 0 and token not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(token, 0)
+
+            match = node if self.concepts[node] is not None else self.match_link[node]
+            while match != 0:
+                found.append((idx - self.depth[match] + 1, idx, self.concepts[match]))
+                match = self.match_link[match]
+
+        found.sort(key=lambda item: (item[0], item[0] - item[1]))
+        result = []
+        covered = -1
+        for first, last, concepts in found:
+            if first > covered:
+                result.append((tokens[first][1], tokens[last][2], concepts))
+                covered = last
+        return result
+
+    def extract(self, text):
+        """The matches as a CLAMP style payload"""
+        payload = []
+        for start, end, concepts in self.matches(text):
+            for cui, semantics in concepts:
+                payload.append({
+                    "CUI": cui,
+                    "Location_Start": start,
+                    "Location_End": end,
+                    "Semantics": semantics,
+                    "Assertion": None,
+                    "Entity": None,
+                    "Concept_Prob": None
+                })
+        return payload
+
+# The automaton each of the pool's workers matches against
+_worker_automaton = None
+
+def _init_worker(automaton):
+    global _worker_automaton
+    _worker_automaton = automaton
+
+def _extract(text):
+    return _worker_automaton.extract(text)
+
+class NlpDictionary(NlpBase):
+    def __init__(self, config):
+        self.endpoint = None
+        self.terms = None
+        self.rating = 50
+        self.processes = os.cpu_count() or 1
+        self.min_length = DEFAULT_MIN_LENGTH
+        self.automaton = None
+        self.names = None           # cui => preferred term
+        self.pool = None
+        self.lock = Lock()
+
+        if 'DICTIONARY' in config:
+            settings = config['DICTIONARY']
+            self.terms = settings.get('terms')
+            # Below CLAMP by default, so it is only used when it's the only
+            # module available unless it is rated higher
+            self.rating = settings.get('rating', 50)
+            self.processes = settings.get('processes', self.processes)
+            self.min_length = settings.get('min_length', self.min_length)
+
+        if self.terms is not None and Path(self.terms).is_file():
+            # Cached payloads are only good for the version of the term list
+            # they were found with
+            self.endpoint = f"{Path(self.terms).resolve()}?{Path(self.terms).stat().st_mtime_ns}"
+
+    def is_live(self):
+        return self.endpoint is not None
+
+    def get_automaton(self):
+        """The automaton (and the preferred names) aren't built until needed"""
+        with self.lock:
+            if self.automaton is None:
+                best = {}           # cui => (rank, term)
+                def terms():
+                    for cui, term, semantics, rank in read_terms(self.terms):
+                        if cui not in best or rank < best[cui][0]:
+                            best[cui] = (rank, term)
+                        yield (cui, term, semantics)
+
+                self.automaton = TermAutomaton(terms(), min_length=self.min_length)
+                self.names = {cui: term for cui, (rank, term) in best.items()}
+                print(f"Dictionary NLP: {self.automaton.terms} terms loaded from {self.terms}")
+        return self.automaton
+
+    def get_names(self):
+        self.get_automaton()
+        return self.names
+
+    def get_batch_size(self):
+        """Enough for every process to get a few chunks of each batch"""
+        if self.processes < 2:
+            return 1
+        return MIN_POOL_BATCH * self.processes
+
+    def get_pool(self):
+        automaton = self.get_automaton()
+        with self.lock:
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(self.processes, initializer=_init_worker, initargs=(automaton,))
+        return self.pool
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def extract(self, text):
+        return self.get_automaton().extract(text)
+
+    def extract_batch(self, texts):
+        if self.processes < 2 or len(texts) < MIN_POOL_BATCH:
+            automaton = self.get_automaton()
+            return [automaton.extract(text) for text in texts]
+
+        chunksize = max(1, len(texts) // (self.processes * 4))
+        return self.get_pool().map(_extract, texts, chunksize=chunksize)
+
+    def concepts(self, result, text, resolve=True):
+        """UMLS CUIs are named after their preferred term. Anything else in the
+        term list is matched as it would be for CLAMP"""
+        names = self.get_names()
+        cui = result['CUI']
+        if _umls_cui.fullmatch(cui) and cui in names:
+            return [add_concept(UMLS_URL, cui, names[cui])]
+        return match_terms(result, text, resolve=resolve)
+
+    def build_results(self, payload, text, resolve=True):
+        results = []
+        for result in payload:
+            for concept in self.concepts(result, text, resolve=resolve):
+                results.append(NlpResult(
+                    concept=concept,
+                    source_text=text,
+                    loc_start=result['Location_Start'],
+                    loc_end=result['Location_End'],
+                    semantics=result['Semantics'],
+                    assertion=result['Assertion'],
+                    entity=result['Entity'],
+                    probability=result['Concept_Prob']
+                ))
+        return results
@@ -0,0 +1,158 @@
+"""
+Pool of interchangeable endpoints (e.g. several CLAMP instances) for an NLP
+module.
+
+Each request goes to the healthy endpoint expected to answer soonest, i.e.
+the one with the lowest (requests in flight + 1) * average latency, with
+ties going to the one with the fewest requests in flight. Endpoints that
+haven't answered anything yet are assumed to be as fast as the others are
+on average, so the first requests are spread across all of them. An
+endpoint that fails max_failures times in a row is ejected for eject_time
+seconds, doubling each time it is ejected again. Once that time is up it is
+readmitted on probation: a success restores it and a failure ejects it
+again straight away. A request that fails is retried on another endpoint.
+
+If every endpoint has been ejected, requests go to whichever is due to be
+readmitted first rather than failing outright.
+"""
+
+import time
+from threading import Lock
+
+from ddent.metrics import metrics
+
+DEFAULT_MAX_FAILURES = 3
+
+# Seconds an endpoint sits out the first time it's ejected
+DEFAULT_EJECT_TIME = 10.0
+
+# ...and the longest it will ever sit out
+MAX_EJECT_TIME = 300.0
+
+# Weight of the latest request in the average latency
+_latency_weight = 0.2
+
+# Latency assumed for every endpoint until one of them has answered. Only
+# the ratio matters, so any constant will do
+_initial_latency = 1.0
+
+class EndpointFailure(Exception):
+    """The endpoint didn't handle the request. Raised by the request
+    functions passed to EndpointPool.request"""
+
+class Endpoint:
+    def __init__(self, url):
+        self.url = url
+        self.in_flight = 0
+        self.latency = 0.0          # Moving average, in seconds
+        self.failures = 0           # In a row
+        self.ejections = 0          # In a row
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.errors = 0
+
+    def healthy(self, now):
+        return self.ejected_until <= now
+
+    def expected_wait(self, default_latency):
+        latency = self.latency if self.latency > 0 else default_latency
+        return ((self.in_flight + 1) * latency, self.in_flight)
+
+class EndpointPool:
+    def __init__(self, urls, max_failures=DEFAULT_MAX_FAILURES, eject_time=DEFAULT_EJECT_TIME):
+        if isinstance(urls, str):
+            urls = [urls]
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.max_failures = max_failures
+        self.eject_time = eject_time
+        self.lock = Lock()
+
+    @property
+    def urls(self):
+        return [endpoint.url for endpoint in self.endpoints]
+
+    def acquire(self, exclude=()):
+        """Pick the endpoint for the next request, skipping those in exclude
+        where possible. Returns None if there is nothing left to try"""
+        now = time.monotonic()
+        with self.lock:
+            candidates = [endpoint for endpoint in self.endpoints if endpoint.url not in exclude]
+            if len(candidates) == 0:
+                return None
+
+            healthy = [endpoint for endpoint in candidates if endpoint.healthy(now)]
+            if len(healthy) > 0:
+                measured = [endpoint.latency for endpoint in self.endpoints if endpoint.latency > 0]
+                default_latency = sum(measured) / len(measured) if len(measured) > 0 else _initial_latency
+                endpoint = min(healthy, key=lambda endpoint: endpoint.expected_wait(default_latency))
+            else:
+                endpoint = min(candidates, key=lambda endpoint: endpoint.ejected_until)
+            endpoint.in_flight += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def release(self, endpoint, seconds, ok):
+        with self.lock:
+            endpoint.in_flight -= 1
+            if ok:
+                endpoint.latency += _latency_weight * (seconds - endpoint.latency) if endpoint.latency > 0 else seconds
+                endpoint.failures = 0
+                endpoint.ejections = 0
+                return
+
+            endpoint.errors += 1
+            endpoint.failures += 1
+            # Endpoints on probation only get the one chance
+            if endpoint.failures >= self.max_failures or endpoint.ejections > 0:
+                self._eject(endpoint, f"after {endpoint.failures} failures")
+
+    def _eject(self, endpoint, reason):
+        """Caller is expected to hold the lock"""
+        eject_time = min(self.eject_time * (2 ** endpoint.ejections), MAX_EJECT_TIME)
+        endpoint.ejected_until = time.monotonic() + eject_time
+        endpoint.ejections += 1
+        metrics().incr("nlp_endpoint_ejections", endpoint=endpoint.url)
+        print(f"NLP endpoint {endpoint.url} ejected for {eject_time:.0f}s {reason}")
+
+    def eject(self, url):
+        """Take the endpoint out of rotation because it failed its probe"""
+        with self.lock:
+            for endpoint in self.endpoints:
+                if endpoint.url == url:
+                    self._eject(endpoint, "after failing its probe")
+
+    def request(self, fn, attempts=None):
+        """Return fn(url) for the best endpoint available. If fn raises (e.g. an
+        EndpointFailure or a connection error), it is tried again on one of the
+        other endpoints, up to attempts times in all. Returns None if none of
+        them could handle it"""
+        if attempts is None:
+            attempts = len(self.endpoints)
+
+        tried = set()
+        for attempt in range(attempts):
+            endpoint = self.acquire(exclude=tried)
+            if endpoint is None:
+                break
+            tried.add(endpoint.url)
+
+            start = time.perf_counter()
+            ok = False
+            try:
+                result = fn(endpoint.url)
+                ok = True
+                return result
+            except Exception as e:
+                print(f"NLP request to {endpoint.url} failed: {e}")
+            finally:
+                seconds = time.perf_counter() - start
+                self.release(endpoint, seconds, ok)
+                metrics().observe("nlp_endpoint_seconds", seconds, endpoint=endpoint.url)
+        return None
+
+    def report(self):
+        lines = []
+        for endpoint in self.endpoints:
+            status = "ejected" if not endpoint.healthy(time.monotonic()) else "healthy"
+            lines.append(f"{endpoint.url}: {endpoint.requests} requests, {endpoint.errors} errors, {endpoint.latency * 1000:.0f}ms average ({status})")
+        return "NLP endpoints:\n\t" + "\n\t".join(lines)
@@ -0,0 +1,218 @@
+"""
+Offline terminology backend built from a local UMLS release.
+
+The RRF files are far too large to load whenever we need a name, so they are
+indexed once into compact code => name files which are memory mapped at run
+time. Each index file consists of:
+
+    header          - magic, format version and the number of codes (n)
+    key offsets     - n+1 uint64 offsets into the key blob
+    value offsets   - n+1 uint64 offsets into the value blob
+    key blob        - the codes, utf-8 encoded, in sorted order
+    value blob      - the names, in the same order as the codes
+
+Lookups are a binary search over the keys, so nothing beyond the pages we
+actually touch is read from disk.
+
+The OfflineTerminology class provides the same get_cui/get_snomed/get_rxnorm
+functions as the NLM and BioPortal clients, and can be used as the display
+source for the external systems (see terminologies.use_offline_backend).
+"""
+
+import csv
+import mmap
+import struct
+import sys
+from pathlib import Path
+
+from ddent.nlm import nlm_error_write
+
+_magic = b"DDIX"
+_format_version = 1
+_header = struct.Struct("<4sIQ")
+
+UMLS_INDEX = "umls.idx"
+SNOMED_INDEX = "snomedct_us.idx"
+RXNORM_INDEX = "rxnorm.idx"
+
+# MRCONSO.RRF columns
+# CUI|LAT|TS|LUI|STT|SUI|ISPREF|AUI|SAUI|SCUI|SDUI|SAB|TTY|CODE|STR|SRL|SUPPRESS|CVF
+_mrconso = {name: idx for idx, name in enumerate("CUI LAT TS LUI STT SUI ISPREF AUI SAUI SCUI SDUI SAB TTY CODE STR SRL SUPPRESS CVF".split())}
+
+# RXNCONSO.RRF columns
+# RXCUI|LAT|RXAUI|SAUI|SCUI|SDUI|SAB|TTY|CODE|STR|SRL|SUPPRESS|CVF
+_rxnconso = {name: idx for idx, name in enumerate("RXCUI LAT RXAUI SAUI SCUI SDUI SAB TTY CODE STR SRL SUPPRESS CVF".split())}
+
+# Term types in order of preference when choosing the name for a code.
+# Anything not listed falls in behind them
+_snomed_ttys = ["PT", "FN", "SY"]
+_rxnorm_ttys = ["SCD", "SBD", "IN", "PIN", "MIN", "BN", "GPCK", "BPCK", "SCDC", "SBDC", "SCDF", "SBDF", "DF", "DFG", "PSN", "SY", "TMSY"]
+
+def _tty_rank(ttys, tty):
+    try:
+        return ttys.index(tty)
+    except ValueError:
+        return len(ttys)
+
+def _read_rrf(filename):
+    # There are some enormous fields in there, and RRF doesn't do any quoting
+    csv.field_size_limit(sys.maxsize)
+    with open(filename, "rt", encoding="utf-8", newline="") as f:
+        for row in csv.reader(f, delimiter="|", quoting=csv.QUOTE_NONE):
+            yield row
+
+def umls_names(mrconso):
+    """Yields (cui, rank, name) for each English string in MRCONSO. Lower
+    ranks are preferred"""
+    c = _mrconso
+    for row in _read_rrf(mrconso):
+        if row[c['LAT']] == 'ENG':
+            rank = (row[c['TS']] != 'P', row[c['STT']] != 'PF', row[c['ISPREF']] != 'Y', row[c['SUPPRESS']] != 'N')
+            yield (row[c['CUI']], rank, row[c['STR']])
+
+def snomed_names(mrconso):
+    c = _mrconso
+    for row in _read_rrf(mrconso):
+        if row[c['SAB']] == 'SNOMEDCT_US':
+            rank = (row[c['SUPPRESS']] != 'N', _tty_rank(_snomed_ttys, row[c['TTY']]))
+            yield (row[c['CODE']], rank, row[c['STR']])
+
+def rxnorm_names(rxnconso):
+    c = _rxnconso
+    for row in _read_rrf(rxnconso):
+        if row[c['SAB']] == 'RXNORM':
+            rank = (row[c['SUPPRESS']] != 'N', _tty_rank(_rxnorm_ttys, row[c['TTY']]))
+            yield (row[c['RXCUI']], rank, row[c['STR']])
+
+def write_index(names, filename):
+    """Write the index for the (code, rank, name) tuples, keeping the best
+    ranked name for each of the codes. Returns the number of codes written"""
+    best = {}
+    for code, rank, name in names:
+        if code not in best or rank < best[code][0]:
+            best[code] = (rank, name)
+
+    keys = []
+    values = []
+    for code in sorted(best, key=lambda x: x.encode("utf-8")):
+        keys.append(code.encode("utf-8"))
+        values.append(best[code][1].encode("utf-8"))
+
+    with open(filename, "wb") as f:
+        f.write(_header.pack(_magic, _format_version, len(keys)))
+
+        for blob in (keys, values):
+            offset = 0
+            offsets = [0]
+            for item in blob:
+                offset += len(item)
+                offsets.append(offset)
+            f.write(struct.pack(f"<{len(offsets)}Q", *offsets))
+
+        for blob in (keys, values):
+            for item in blob:
+                f.write(item)
+    return len(keys)
+
+def build_indexes(index_dir, mrconso=None, rxnconso=None):
+    """Build whichever indexes can be built from the files provided"""
+    index_dir = Path(index_dir)
+    index_dir.mkdir(parents=True, exist_ok=True)
+
+    if mrconso is not None:
+        count = write_index(umls_names(mrconso), index_dir / UMLS_INDEX)
+        print(f"{count} UMLS CUIs written to {index_dir / UMLS_INDEX}")
+        count = write_index(snomed_names(mrconso), index_dir / SNOMED_INDEX)
+        print(f"{count} SNOMED CT codes written to {index_dir / SNOMED_INDEX}")
+
+    if rxnconso is not None:
+        count = write_index(rxnorm_names(rxnconso), index_dir / RXNORM_INDEX)
+        print(f"{count} RxNorm codes written to {index_dir / RXNORM_INDEX}")
+
+class RrfIndex:
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, "rb")
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.count = _header.unpack_from(self.mm, 0)
+        if magic != _magic or version != _format_version:
+            raise ValueError(f"{filename} is not a valid terminology index")
+
+        view = memoryview(self.mm)
+        offset = _header.size
+        width = (self.count + 1) * 8
+        self.key_offsets = view[offset:offset + width].cast("Q")
+        offset += width
+        self.value_offsets = view[offset:offset + width].cast("Q")
+        offset += width
+        self.keys_start = offset
+        self.values_start = offset + self.key_offsets[self.count]
+
+    def _key(self, idx):
+        return self.mm[self.keys_start + self.key_offsets[idx]:self.keys_start + self.key_offsets[idx + 1]]
+
+    def get(self, code):
+        key = code.encode("utf-8")
+        low = 0
+        high = self.count
+        while low < high:
+            mid = (low + high) // 2
+            if self._key(mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+
+        if low < self.count and self._key(low) == key:
+            return self.mm[self.values_start + self.value_offsets[low]:self.values_start + self.value_offsets[low + 1]].decode("utf-8")
+        return None
+
+    def __len__(self):
+        return self.count
+
+class OfflineTerminology:
+    """Name lookups against the indexes found in index_dir. Indexes that
+    haven't been built are skipped, leaving those systems on the web APIs"""
+    def __init__(self, index_dir):
+        index_dir = Path(index_dir)
+        self.indexes = {}
+
+        for index in (UMLS_INDEX, SNOMED_INDEX, RXNORM_INDEX):
+            if (index_dir / index).is_file():
+                self.indexes[index] = RrfIndex(index_dir / index)
+
+    def has_index(self, index):
+        return index in self.indexes
+
+    def get_cui(self, cui, source):
+        name = self.indexes[UMLS_INDEX].get(cui)
+        if name is None:
+            nlm_error_write(source, 'UMLS', cui)
+            name = f"No Matching Concept Found For '{source}'"
+
+        return {
+            "system": "http://terminology.hl7.org/CodeSystem/umls",
+            "code": cui,
+            "display": name
+        }
+
+    def get_snomed(self, term, source):
+        name = self.indexes[SNOMED_INDEX].get(term)
+        if name is not None:
+            return {
+                "system": "http://snomed.info/sct",
+                "code": term,
+                "display": name
+            }
+
+    def get_rxnorm(self, id, source):
+        name = self.indexes[RXNORM_INDEX].get(id)
+        if name is None:
+            nlm_error_write(source, 'RxNorm', id)
+            name = f"No Name Found For '{source}"
+
+        return {
+            "system": "http://www.nlm.nih.gov/research/umls/rxnorm",
+            "code" : id,
+            "display": name
+        }
@@ -0,0 +1,85 @@
+"""
+Shared HTTP plumbing for the remote services we rely on.
+
+Each of the API wrappers should hold onto a pooled session rather than using
+the bare requests functions, so that subsequent calls to the same host reuse
+an existing (keep-alive) connection instead of paying for a new TLS handshake
+every time.
+"""
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlparse
+from contextlib import contextmanager
+from threading import Lock, BoundedSemaphore
+import time
+
+# Large enough to cover the NLP worker pool hitting the same host at once
+DEFAULT_POOL_SIZE = 16
+
+# Responses that are worth trying again after backing off a bit
+_retry_statuses = [429, 500, 502, 503, 504]
+
+def pooled_session(pool_size=DEFAULT_POOL_SIZE, headers=None, retries=0, backoff=1.0):
+    """Return a requests Session which will keep up to pool_size connections
+    alive per host. When retries is non-zero, failed connections and 429/5xx
+    responses to GETs are retried with exponential backoff (honoring any
+    Retry-After the server provides)"""
+    session = requests.Session()
+    max_retries = 0
+    if retries > 0:
+        max_retries = Retry(total=retries, 
+                            backoff_factor=backoff, 
+                            status_forcelist=_retry_statuses, 
+                            raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=max_retries)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    if headers is not None:
+        session.headers.update(headers)
+    return session
+
+class RateLimiter:
+    """Spaces calls out so that no more than rate calls per second are made, 
+    regardless of how many threads are sharing the limiter"""
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_call = 0.0
+        self.lock = Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+
+        if delay > 0:
+            time.sleep(delay)
+
+class HostLimits:
+    """Politeness limits applied to each host separately: no more than 
+    max_per_host requests in flight and no more than rate requests per second"""
+    def __init__(self, max_per_host=3, rate=None):
+        self.max_per_host = max_per_host
+        self.rate = rate
+        self.lock = Lock()
+        self.semaphores = {}
+        self.limiters = {}
+
+    def _host_limits(self, host):
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = BoundedSemaphore(self.max_per_host)
+                if self.rate is not None:
+                    self.limiters[host] = RateLimiter(self.rate)
+            return (self.semaphores[host], self.limiters.get(host))
+
+    @contextmanager
+    def slot(self, url):
+        semaphore, limiter = self._host_limits(urlparse(url).netloc)
+        with semaphore:
+            if limiter is not None:
+                limiter.wait()
+            yield
@@ -1,11 +1,18 @@
 from copy import deepcopy
 from ddent.nlm import NlmClient 
 from ddent.bioportal import BioPortalClient
+from ddent.display_cache import display_cache
+from ddent.sessions import RateLimiter
+from ddent.metrics import metrics
 from pprint import pformat
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+from functools import lru_cache
 
-import pdb
-
+import json
 import re
+import warnings
 
 def NameCui(term, source):
     client = NlmClient()
@@ -23,6 +30,13 @@ def NameSnomed(term, source):
     if client is not None:
         return client.get_snomed(term, source)
 
+def NameSnomedBatch(terms):
+    client = BioPortalClient()
+
+    if client is not None:
+        return client.get_snomed_batch(terms)
+    return {}
+
 
 _basecs_snomed = {      
     "resourceType": "CodeSystem",
@@ -69,17 +83,67 @@ _basecs_rxnorm = {
 }
 
 
+# One token from the CLAMP CUI field per match. In order, the groups are:
+#   SNOMEDCT_US[code,code...]
+#   RxNorm=[code,...] or Generic=[code,...]
+#   A UMLS CUI, C0000000
+#   null, which CLAMP leaves behind for some searches
+#   Separators
+#   Anything else, which we don't know what to do with
+_cui_token = re.compile(r'SNOMEDCT_US\[([0-9,]*)\]|(?:RxNorm|Generic)=\[([0-9,]*)\]|(C[0-9]+)(?![^,;\s])|(null)(?![^,;\s])|([,;\s]+)|([^,;\s]+)')
+
+class CuiParseWarning(UserWarning):
+    """Part of a CLAMP CUI field couldn't be parsed"""
+    def __init__(self, cui_data, leftovers):
+        self.cui_data = cui_data
+        self.leftovers = leftovers
+        super().__init__(f"Unrecognized content, {leftovers}, in CUI field: {cui_data}")
+
+@lru_cache(maxsize=65536)
+def parse_cui_field(cui_data):
+    """Split the CUI field from CLAMP into ((system name, code), ...) and a
+    tuple of anything we couldn't make sense of. Each (system, code) pair is
+    only returned once. CLAMP returns the same fields over and over again,
+    so the results are memoized"""
+    codes = {}
+    leftovers = []
+    for token in _cui_token.finditer(cui_data):
+        group = token.lastindex
+        if group == 1:
+            for code in token.group(1).split(","):
+                if code:
+                    codes[("SNOMED", code)] = None
+        elif group == 2:
+            for code in token.group(2).split(","):
+                if code:
+                    codes[("RxNorm", code)] = None
+        elif group == 3:
+            codes[("UMLS", token.group(3))] = None
+        elif group == 6:
+            leftovers.append(token.group(6))
+    return tuple(codes), tuple(leftovers)
+
 class ExternalSystem:
     """Represents a single external terminology such as SNOMED or RxNorm. This can build VS and CodeSystems. """
-    def __init__(self, name, regex, use_findall, base_cs, display_source=None):
+    def __init__(self, name, base_cs, display_source=None, bulk_source=None, rate_limit=None):
         self.name = name
-        self.matchers = [re.compile(x) for x in regex]
-        self.use_findall = use_findall
         self.base_cs = base_cs
         self.url = base_cs['url']
         self.codes = {}
-        self.changes_made = 0                       # Tracks number of codes inserted since last save/load
+        self.pending = []                           # Codes inserted since last save/load
+        self.resource_id = None                     # The CS's id on the FHIR server, once we know it
+        self.pushed = 0                             # Number of concepts in the server's copy of the CS
         self.display_source = display_source        # This is the function that will attempt to identify the code
+        self.lock = Lock()                          # NLP extraction may be matching terms from several threads
+        self.bulk_source = bulk_source              # Optional function to identify a list of codes in one go
+        self.rate_limit = None                      # Max lookups per second made against display_source
+
+        if rate_limit is not None:
+            self.rate_limit = RateLimiter(rate_limit)
+
+    @property
+    def changes_made(self):
+        return len(self.pending)
     
     def pull_current_version(self, fhirclient):
         """Load whatever we have previously found for the given CS"""
@@ -91,6 +155,8 @@ class ExternalSystem:
                 # content, including stuff like filters that we don't want to 
                 # overwrit. 
                 self.base_cs = entry['resource']
+                self.resource_id = entry['resource'].get('id')
+                self.pushed = len(entry['resource'].get('concept', []))
                 #pdb.set_trace()
                 if 'concept' in entry['resource']:
                     for concept in entry['resource']['concept']:
@@ -98,82 +164,204 @@ class ExternalSystem:
                         self.codes[concept['code']]['system'] = self.url
         return response
 
-    def get_codesystem(self):
-        self.base_cs['concept'] = []
-        for code in self.codes:
-            self.base_cs['concept'].append({
+    def get_codesystem(self, codes=None):
+        """codes is a snapshot of self.codes' items, if the caller has one"""
+        # Other studies may be adding codes while we build this
+        if codes is None:
+            with self.lock:
+                codes = list(self.codes.items())
+
+        # ...or building (and pushing) their own copy of the CS, so base_cs
+        # itself is never touched
+        cs = dict(self.base_cs)
+        cs['concept'] = []
+        for code, concept in codes:
+            cs['concept'].append({
                 'code': code,
-                'display' : self.codes[code]['display']
+                'display' : concept['display']
             })
         
-        self.base_cs['count'] = len(self.codes)
-
-        if self.base_cs['count'] > 0:
-            self.base_cs['content'] = "fragment"
-        return self.base_cs
-
-    def push_current_version(self, fhirclient):
-        """Save the CS back to the fhir server, assuming we added some new codes since it was last saved/loaded"""
-        cs = self.get_codesystem()
-        response = fhirclient.load("CodeSystem", cs)
-        self.changes_made = 0
+        cs['count'] = len(codes)
+
+        if cs['count'] > 0:
+            cs['content'] = "fragment"
+        return cs
+
+    def patch_current_version(self, fhirclient, codes):
+        """Append just the new codes to the server's copy of the CS using a 
+        JSON Patch. Returns None if the FHIR client can't do that"""
+        patch = getattr(fhirclient, "patch", None)
+        if patch is None:
+            return None
+
+        operations = []
+        for code in codes:
+            operations.append({
+                "op": "add",
+                "path": "/concept/-",
+                "value": {
+                    "code": code,
+                    "display": self.codes[code]['display']
+                }
+            })
+        operations.append({
+            "op": "add",
+            "path": "/count",
+            "value": self.pushed + len(codes)
+        })
+        metrics().uploaded("CodeSystem", len(json.dumps(operations)))
+        with metrics().request("fhir"):
+            return patch("CodeSystem", self.resource_id, operations)
+
+    def push_current_version(self, fhirclient, delta=True):
+        """Save the CS back to the fhir server, assuming we added some new codes since it was last saved/loaded.
+
+        If the server already has a copy of the CS, only the new codes are sent
+        when delta is true. Otherwise, the entire fragment is uploaded"""
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+
+        response = None
+        if delta and self.resource_id is not None and self.pushed > 0:
+            response = self.patch_current_version(fhirclient, pending)
+            if response is not None and response['status_code'] < 300:
+                self.pushed += len(pending)
+            else:
+                response = None
+
+        if response is None:
+            # The full CS also carries anything added since pending was taken,
+            # so those codes must come out of pending at the same moment, or
+            # the next delta push would append them a second time
+            with self.lock:
+                codes = list(self.codes.items())
+                pending = pending + self.pending
+                self.pending = []
+            cs = self.get_codesystem(codes)
+            metrics().uploaded("CodeSystem", len(json.dumps(cs)))
+            with metrics().request("fhir"):
+                response = fhirclient.load("CodeSystem", cs)
+            if response['status_code'] < 300:
+                self.pushed = cs['count']
+                if isinstance(response.get('response'), dict):
+                    self.resource_id = response['response'].get('id', self.resource_id)
+
+        # Make sure the codes go out with the next push if this one failed
+        if response['status_code'] >= 300:
+            with self.lock:
+                self.pending = pending + self.pending
 
         return response
 
+    def add_concept(self, cui, concept):
+        with self.lock:
+            if cui not in self.codes:
+                self.codes[cui] = concept
+                self.pending.append(cui)
+
+    def lookup(self, cui, source):
+        """Identify the code using the display cache or, failing that, the display source"""
+        # Anything we've resolved during a previous run should be in the
+        # display cache. Otherwise, the lookup itself happens outside of 
+        # the lock so that other threads aren't waiting on the remote service
+        cache = display_cache()
+        concept = None
+        if cache is not None:
+            concept = cache.get(self.url, cui)
+
+        if concept is None:
+            # Includes any time spent waiting on the rate limit
+            with metrics().timer("lookup_seconds", system=self.name):
+                if self.rate_limit is not None:
+                    self.rate_limit.wait()
+                concept = self.display_source(cui, source)
+            if concept and cache is not None:
+                cache.put(self.url, cui, concept)
+        return concept
+
     def get_vs_concept(self, cui, source):
+        metrics().cache(f"{self.name.lower()}_concepts", cui in self.codes)
         if cui not in self.codes:
-            concept = self.display_source(cui, source)
+            concept = self.lookup(cui, source)
             if concept:
-                self.codes[cui] = concept
-                self.changes_made += 1
+                self.add_concept(cui, concept)
 
         return self.codes.get(cui)        
 
-    def match(self, cui_data, chars_used, orig_text):
-        chars_spanned = 0
-        cui_list = set()
-        matched_concepts = []
-        for rex in self.matchers:
-            if chars_spanned > 0:
-                chars_spanned += 1
-            if self.use_findall:
-                matches = rex.findall(cui_data)
-                if len(matches) == 0:
-                    matches = None
+    def resolve(self, pending, workers=4):
+        """Identify all of the codes in pending (code => source text) that 
+        haven't already been identified. The bulk source is used when 
+        available, with anything it misses looked up individually."""
+        pending = {cui: source for cui, source in pending.items() if cui not in self.codes}
+        cache = display_cache()
+
+        if self.bulk_source is not None and len(pending) > 0:
+            uncached = []
+            for cui in pending:
+                concept = None
+                if cache is not None:
+                    concept = cache.get(self.url, cui)
+
+                if concept is None:
+                    uncached.append(cui)
                 else:
-                    for cui in matches:
-                        chars_spanned += len(cui)
-                        
-                        cui_list.add(cui)
-
-                    chars_spanned += len(matches) - 1
-            else:
-                matches = rex.search(cui_data)
-                if matches:
-                    gspan = matches.span()
-                    chars_spanned += (gspan[1] - gspan[0])
-
-                    for group in matches.groups():
-                        for cui in group.split(","):
-                            cui_list.add(cui)
-
-        for cui in cui_list:
-            cui = self.get_vs_concept(cui, orig_text)
-
-            if cui is not None:
-                matched_concepts.append(cui)
-
-        if len(matched_concepts) > 0 and chars_used > 0:
-            chars_used += 1
-        chars_used += chars_spanned
-
-        return (matched_concepts, chars_used)
+                    self.add_concept(cui, concept)
+
+            if len(uncached) > 0:
+                for cui, concept in self.bulk_source(uncached).items():
+                    if cache is not None:
+                        cache.put(self.url, cui, concept)
+                    self.add_concept(cui, concept)
+            pending = {cui: source for cui, source in pending.items() if cui not in self.codes}
+
+        def resolve_one(cui):
+            self.get_vs_concept(cui, pending[cui])
+
+        if len(pending) > 0:
+            print(f"Resolving {len(pending)} {self.name} codes")
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(resolve_one, pending))
+
+    def match(self, cui, orig_text, resolve=True):
+        """Return the concept for the code, or None if it can't be identified"""
+        if resolve:
+            return self.get_vs_concept(cui, orig_text)
+
+        # The concept will be identified later on by resolve_concepts
+        return self.codes.get(cui, {
+            'system': self.url,
+            'code': cui
+        })
 
 _external_systems = [
-    ExternalSystem("SNOMED", [r"SNOMEDCT_US\[([0-9,]+)\]"], False, _basecs_snomed, display_source=NameSnomed),
-    ExternalSystem("UMLS", [r"(C[0-9]+)"], True, _basecs_umls, display_source=NameCui),
-    ExternalSystem("RxNorm", [r"RxNorm=\[([0-9,]+)\]", r"Generic=\[([0-9,]+)\]"], False, _basecs_rxnorm, display_source=NameRxNorm)
+    ExternalSystem("SNOMED", _basecs_snomed, display_source=NameSnomed, bulk_source=NameSnomedBatch, rate_limit=15),
+    ExternalSystem("UMLS", _basecs_umls, display_source=NameCui, rate_limit=20),
+    ExternalSystem("RxNorm", _basecs_rxnorm, display_source=NameRxNorm, rate_limit=20)
 ]
+_systems_by_name = {system.name: system for system in _external_systems}
+
+def use_offline_backend(index_dir):
+    """Identify codes using the local indexes (see ddent.rrf) rather than the 
+    web APIs for any of the systems whose index has been built"""
+    from ddent.rrf import OfflineTerminology, UMLS_INDEX, SNOMED_INDEX, RXNORM_INDEX
+
+    backend = OfflineTerminology(index_dir)
+    sources = {
+        "UMLS": (UMLS_INDEX, backend.get_cui),
+        "SNOMED": (SNOMED_INDEX, backend.get_snomed),
+        "RxNorm": (RXNORM_INDEX, backend.get_rxnorm)
+    }
+
+    for system in _external_systems:
+        index, display_source = sources[system.name]
+        if backend.has_index(index):
+            print(f"Using offline index for {system.name}")
+            system.display_source = display_source
+            # Lookups are in process, so there is nothing to batch or throttle
+            system.bulk_source = None
+            system.rate_limit = None
+    return backend
 
 def get_codesystems_used(urls):
     global _external_systems
@@ -185,32 +373,80 @@ def get_codesystems_used(urls):
     return codesystems
 
 
-def match_terms(nlp_result, orig_text):
-    # Quick sanity check to make sure there aren't some vocabularies we aren't supporting
-    
-    cui_data_raw = nlp_result['CUI']
-    # We have some junk that does show up for some searches, so let's strip it out
-    cui_data = cui_data_raw.replace("null,", "").replace("null", "")
-    data_len = len(cui_data)
-    chars_consumed = 0
+def match_terms(nlp_result, orig_text, resolve=True):
+    """Return the concepts for each of the codes in the CUI field of the
+    CLAMP result. Anything in the field we don't recognize is reported as a
+    CuiParseWarning and skipped"""
+    codes, leftovers = parse_cui_field(nlp_result['CUI'])
+    if len(leftovers) > 0:
+        warnings.warn(CuiParseWarning(nlp_result['CUI'], leftovers), stacklevel=2)
+
     concepts = []
-    
-    for system in _external_systems:
-        (concepts_found, chars_consumed) = system.match(cui_data, chars_consumed, orig_text)
-        concepts+= concepts_found
-
-    if chars_consumed != data_len:
-        sum = 0
-        for concept in concepts:
-            sum += len(concept['code'])
-            print(f" - {len(concept['code'])}/{sum}\t {concept['system']}:{concept['code']} - {concept['display']}")
-        print(f"Original Source data: {cui_data}")
-        print(f"The concepts: {concepts}")
-        pdb.set_trace()
-        print(f"Some data was left behind? {chars_consumed} != {data_len}")
+    for name, code in codes:
+        concept = _systems_by_name[name].match(code, orig_text, resolve=resolve)
+        if concept is not None:
+            concepts.append(concept)
 
     return concepts
 
+def resolve_concepts(nlp_results, workers=4):
+    """Identify all of the concepts left unresolved by match_terms(resolve=False)
+    in one pass. nlp_results is a list of NlpResult lists, as returned by 
+    extract_cuis. The returned lists will only contain those results whose 
+    concepts could be identified"""
+    systems = {system.url: system for system in _external_systems}
+
+    pending = defaultdict(dict)             # system url => {code => source text}
+    for results in nlp_results:
+        for result in results:
+            if 'display' not in result.concept:
+                pending[result.system()].setdefault(result.cui, result.source_text)
+
+    # The systems are backed by different services, so we can work on them 
+    # simultaneously without running afoul of the rate limits
+    with ThreadPoolExecutor(max_workers=max(len(pending), 1)) as executor:
+        for future in [executor.submit(systems[url].resolve, pending[url], workers) for url in pending]:
+            future.result()
+
+    resolved = []
+    for results in nlp_results:
+        matched = []
+        for result in results:
+            if 'display' not in result.concept:
+                concept = systems[result.system()].codes.get(result.cui)
+                if concept is None:
+                    continue
+                result.concept = concept
+            matched.append(result)
+        resolved.append(matched)
+    return resolved
+
+def register_concepts(nlp_results):
+    """Add the (already identified) concepts from the NlpResults to their 
+    systems. This is for results that didn't come through match_terms, such 
+    as those carried forward from a previous ingest"""
+    systems = {system.url: system for system in _external_systems}
+
+    for results in nlp_results:
+        for result in results:
+            if result.system() in systems:
+                systems[result.system()].add_concept(result.cui, result.concept)
+
+def add_concept(url, code, display):
+    """Add a code that was identified some other way (e.g. by the dictionary
+    NLP module's term list) to its system, unless the system already has it,
+    and return the system's concept for it. None if url isn't one of ours"""
+    systems = {system.url: system for system in _external_systems}
+    if url not in systems:
+        return None
+
+    systems[url].add_concept(code, {
+        "system": url,
+        "code": code,
+        "display": display
+    })
+    return systems[url].codes[code]
+
 def make_cui_valueset(cuivars, url, name, title, desc):
     cui_vs = {
         "resourceType": "ValueSet",
@@ -245,12 +481,34 @@ def load_terminologies(fhirclient):
     for system in _external_systems:
         system.pull_current_version(fhirclient)
 
-def push_changes(fhirclient):
+# Concurrent studies shouldn't be pushing the same CodeSystems over each other
+_push_lock = Lock()
+
+# Number of new codes (across all systems) that must accumulate before 
+# push_changes will actually push anything. None means we wait until we are 
+# forced to, i.e. at the end of each study
+_push_threshold = None
+
+def push_policy(threshold=None):
+    """Set the number of new codes that will trigger a push"""
+    global _push_threshold
+
+    _push_threshold = threshold
+    return _push_threshold
+
+def push_changes(fhirclient, force=False):
+    """Push the new codes for each of the systems if force is set or enough
+    have accumulated to satisfy the push policy"""
     changes_made = 0
-    for system in _external_systems:
-        if system.changes_made > 0:
-            changes_made += system.changes_made
-            system.push_current_version(fhirclient)
+    with _push_lock:
+        pending = sum(system.changes_made for system in _external_systems)
+        if not force and (_push_threshold is None or pending < _push_threshold):
+            return 0
+
+        for system in _external_systems:
+            if system.changes_made > 0:
+                changes_made += system.changes_made
+                system.push_current_version(fhirclient)
     return changes_made
 
 
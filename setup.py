@@ -16,5 +16,5 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     install_requires=requirements,
-    scripts=['scripts/ingest_dbgap_table']
+    scripts=['scripts/ingest_dbgap_table', 'scripts/build_umls_index']
 )
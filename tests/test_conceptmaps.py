@@ -0,0 +1,82 @@
+import json
+import random
+
+import pytest
+
+from ddent.conceptmaps import ConceptMapWriter, load_shard
+
+HEADER = {
+    "resourceType": "ConceptMap",
+    "url": "http://example.org/ConceptMap/phs000001-DDtoCUI",
+    "name": "phs000001-DDtoCUI",
+    "title": "Study Concept Map",
+    "status": "draft",
+    "group": []
+}
+
+def elements(seed=3):
+    """(source, target, element) in group order, as transform_dd_codesystem
+    writes them"""
+    rng = random.Random(seed)
+    result = []
+    for table in range(6):
+        for system in ["http://terminology.hl7.org/CodeSystem/umls", "http://snomed.info/sct"]:
+            for variable in range(rng.randint(1, 40)):
+                element = {
+                    "code": f"phv{table:03d}{variable:05d}",
+                    "display": "x" * rng.randint(0, 200),
+                    "target": [{"code": f"C{rng.randrange(10 ** 7):07d}", "equivalence": "relatedto"} for cui in range(rng.randint(1, 4))]
+                }
+                result.append((f"http://example.org/CodeSystem/pht{table:06d}", system, element))
+    return result
+
+def write(directory, max_bytes):
+    shards = []
+    writer = ConceptMapWriter(HEADER, directory, max_bytes=max_bytes, on_shard=lambda url, path: shards.append((url, path)))
+    for source, target, element in elements():
+        writer.add_element(source, target, element)
+    assert writer.close() == shards
+    return [(url, load_shard(path)) for url, path in shards]
+
+def merge(shards):
+    """Put the groups split across shards back together"""
+    groups = []
+    for url, shard in shards:
+        for group in shard['group']:
+            if len(groups) > 0 and (groups[-1]['source'], groups[-1]['target']) == (group['source'], group['target']):
+                groups[-1]['element'] += group['element']
+            else:
+                groups.append(dict(group, element=list(group['element'])))
+    return groups
+
+def test_single_shard(tmp_path):
+    shards = write(tmp_path, 1024 * 1024 * 1024)
+    assert len(shards) == 1
+    url, conceptmap = shards[0]
+    assert url == HEADER['url']
+    assert {key: value for key, value in conceptmap.items() if key != 'group'} == {key: value for key, value in HEADER.items() if key != 'group'}
+    assert [(source, target, element) for group in conceptmap['group'] for source, target, element in
+            [(group['source'], group['target'], element) for element in group['element']]] == elements()
+
+@pytest.mark.parametrize("max_bytes", [2000, 5000, 20000])
+def test_shards_merge_to_single(tmp_path, max_bytes):
+    (tmp_path / "single").mkdir()
+    (tmp_path / "sharded").mkdir()
+    single = write(tmp_path / "single", 1024 * 1024 * 1024)
+    shards = write(tmp_path / "sharded", max_bytes)
+
+    assert len(shards) > 1
+    assert merge(shards) == single[0][1]['group']
+
+    for part, (url, shard) in enumerate(shards, start=1):
+        assert url == f"{HEADER['url']}-{part}"
+        assert shard['url'] == url
+        assert shard['name'] == f"{HEADER['name']}-{part}"
+        assert shard['title'] == f"{HEADER['title']} (part {part})"
+        assert len(json.dumps(shard)) <= max_bytes or sum(len(group['element']) for group in shard['group']) == 1
+
+def test_empty(tmp_path):
+    writer = ConceptMapWriter(HEADER, tmp_path)
+    (url, path), = writer.close()
+    assert url == HEADER['url']
+    assert load_shard(path)['group'] == []
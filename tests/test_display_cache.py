@@ -0,0 +1,70 @@
+from ddent.display_cache import DisplayCache, is_negative
+
+UMLS_URL = "http://terminology.hl7.org/CodeSystem/umls"
+
+ASTHMA = {"system": UMLS_URL, "code": "C0004096", "display": "Asthma"}
+UNKNOWN = {"system": UMLS_URL, "code": "C9999999", "display": "No Matching Concept Found For 'something'"}
+
+class Clock:
+    def __init__(self):
+        self.now = 1000000.0
+
+    def __call__(self):
+        return self.now
+
+def cache(tmp_path, clock, **ttls):
+    return DisplayCache(str(tmp_path / "display.db"), clock=clock, **ttls)
+
+def test_is_negative():
+    assert is_negative(UNKNOWN)
+    assert is_negative({"display": "No Name Found For 'aspirin"})
+    assert not is_negative(ASTHMA)
+
+def test_positive_ttl(tmp_path):
+    clock = Clock()
+    display = cache(tmp_path, clock, ttl=100, negative_ttl=10)
+    assert display.get(UMLS_URL, "C0004096") is None
+    display.put(UMLS_URL, "C0004096", ASTHMA)
+
+    clock.now += 99
+    assert display.get(UMLS_URL, "C0004096") == ASTHMA
+    clock.now += 1
+    assert display.get(UMLS_URL, "C0004096") is None
+    assert (display.hits, display.negative_hits, display.misses) == (1, 0, 2)
+
+def test_negative_ttl(tmp_path):
+    clock = Clock()
+    display = cache(tmp_path, clock, ttl=100, negative_ttl=10)
+    display.put(UMLS_URL, "C9999999", UNKNOWN)
+
+    clock.now += 9
+    assert display.get(UMLS_URL, "C9999999") == UNKNOWN
+    clock.now += 1
+    assert display.get(UMLS_URL, "C9999999") is None
+    assert (display.hits, display.negative_hits, display.misses) == (0, 1, 1)
+
+def test_put_refreshes(tmp_path):
+    clock = Clock()
+    display = cache(tmp_path, clock, ttl=100)
+    display.put(UMLS_URL, "C0004096", UNKNOWN)
+    clock.now += 50
+    display.put(UMLS_URL, "C0004096", ASTHMA)
+
+    clock.now += 99
+    assert display.get(UMLS_URL, "C0004096") == ASTHMA
+    assert display.get("http://snomed.info/sct", "C0004096") is None
+
+def test_persists(tmp_path):
+    clock = Clock()
+    display = cache(tmp_path, clock, ttl=100)
+    display.put(UMLS_URL, "C0004096", ASTHMA)
+    display.close()
+
+    clock.now += 50
+    display = cache(tmp_path, clock, ttl=100)
+    assert display.get(UMLS_URL, "C0004096") == ASTHMA
+    assert display.hit_rate() == 1.0
+
+    # The TTL applies when the entry is read, not when it was written
+    display = cache(tmp_path, clock, ttl=10)
+    assert display.get(UMLS_URL, "C0004096") is None
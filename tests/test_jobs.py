@@ -0,0 +1,106 @@
+import json
+import threading
+import time
+
+import ddent.terminologies
+from ddent.jobs import JobQueue, run_batch
+from ddent.nlp import NlpBase, NlpResult
+from ddent.terminologies import add_concept
+
+def finished_study(queue, accession):
+    queue.add_study(accession, accession)
+    queue.claim_study()
+    queue.add_tables(accession, {"https://example.org/table.xml": ("table", "A table")})
+    queue.study_done(accession, 10)
+
+def test_done_studies_are_skipped():
+    queue = JobQueue(":memory:")
+    finished_study(queue, "phs000001.v1.p1")
+
+    assert not queue.add_study("phs000001.v1.p1", "Again")
+    assert queue.claim_study() is None
+
+def test_requeue():
+    queue = JobQueue(":memory:")
+    finished_study(queue, "phs000001.v1.p1")
+
+    assert queue.add_study("phs000001.v1.p1", "Again", requeue=True)
+    assert not queue.has_tables("phs000001.v1.p1")
+    assert queue.claim_study() == ("phs000001.v1.p1", "Again")
+
+def test_failed_studies_are_queued_again():
+    queue = JobQueue(":memory:")
+    queue.add_study("phs000001.v1.p1", "Study")
+    queue.claim_study()
+    queue.study_failed("phs000001.v1.p1", "ValueError: nope")
+
+    assert queue.add_study("phs000001.v1.p1", "Study")
+    assert queue.claim_study() == ("phs000001.v1.p1", "Study")
+
+UMLS_URL = "http://terminology.hl7.org/CodeSystem/umls"
+
+class SharedTerms(NlpBase):
+    """Every definition is "term N", which is found as the UMLS code C000000N"""
+    def __init__(self):
+        super().__init__({})
+        self.endpoint = "http://nlp"
+
+    def get_cuis(self, text, resolve=True):
+        time.sleep(0.001)
+        code = f"C{int(text.split()[1]):07}"
+        concept = add_concept(UMLS_URL, code, f"Term {code}")
+        return [NlpResult(concept, 0, len(text), text)]
+
+class TerminologyFhir:
+    """Keeps the UMLS CodeSystems as they were sent"""
+    def __init__(self):
+        self.pushed = []
+        self.lock = threading.Lock()
+
+    def load(self, resource_type, resource):
+        if resource['url'] == UMLS_URL:
+            body = json.dumps(resource)
+            time.sleep(0.002)
+            with self.lock:
+                self.pushed.append((resource, json.loads(body)))
+        return {"status_code": 201, "response": {"id": "1"}}
+
+def queue_study(queue, accession, terms):
+    queue.add_study(accession, accession)
+    tables = {f"https://example.org/{accession}.pht{i}.xml": (f"table{i}", "A table") for i in range(len(terms))}
+    queue.add_tables(accession, tables)
+    for xml_url, table_terms in zip(tables, terms):
+        queue.table_downloaded(accession, xml_url, {
+            "resourceType": "CodeSystem",
+            "url": xml_url.replace(".xml", ""),
+            "name": xml_url.rsplit("/", 1)[1],
+            "concept": [{"code": f"var{term}", "display": f"Variable {term}", "definition": f"term {term}"} for term in table_terms]
+        })
+
+def test_studies_sharing_a_terminology(monkeypatch):
+    """Two studies at a time, each pushing UMLS after every table and building
+    its own copy of the UMLS CodeSystem at the end, over the same system"""
+    umls = ddent.terminologies._systems_by_name["UMLS"]
+    monkeypatch.setattr(umls, "codes", {})
+    monkeypatch.setattr(umls, "pending", [])
+    monkeypatch.setattr(umls, "resource_id", None)
+    monkeypatch.setattr(umls, "pushed", 0)
+    monkeypatch.setattr(ddent.terminologies, "_push_threshold", 1)
+
+    queue = JobQueue(":memory:")
+    for study in range(4):
+        # Half of each table's terms are shared with the other studies
+        queue_study(queue, f"phs00000{study}.v1.p1", [[term for term in range(table * 20, table * 20 + 20) if term % 2 == 0 or term % 7 == study] for table in range(5)])
+
+    fhir = TerminologyFhir()
+    assert run_batch(queue, SharedTerms(), fhir, workers=2) == sum(variables for count, variables in queue.summary().values())
+    assert queue.summary()['done'][0] == 4
+
+    assert len(fhir.pushed) > 0
+    for resource, sent in fhir.pushed:
+        codes = [concept['code'] for concept in sent['concept']]
+        assert sent['count'] == len(codes)
+        assert len(set(codes)) == len(codes)
+        assert resource == sent
+    assert umls.pending == []
+    assert set(codes) == set(umls.codes)
@@ -0,0 +1,130 @@
+import threading
+
+import pytest
+import requests
+
+import ddent.loaders
+from ddent.loaders import BundleLoader, ParallelLoader, UploadExecutor, location_id
+
+@pytest.mark.parametrize("location, expected", [
+    ("CodeSystem/123/_history/1", "123"),
+    ("CodeSystem/123", "123"),
+    ("http://host/fhir/CodeSystem/123/_history/1", "123"),
+    ("https://host:8080/fhir/CodeSystem/abc-def", "abc-def"),
+    ("/fhir/CodeSystem/123/_history/2", "123"),
+    ("http://host/fhir/123/_history/1", "123"),
+])
+def test_location_id(location, expected):
+    assert location_id(location, "CodeSystem") == expected
+
+class BundleFhir:
+    def __init__(self, base):
+        self.base = base
+        self.bundles = []
+
+    def post(self, path, bundle):
+        self.bundles.append(bundle)
+        entries = []
+        for idx, entry in enumerate(bundle['entry']):
+            resource_type = entry['request']['url'].split("?")[0]
+            entries.append({"response": {"status": "201 Created", "location": f"{self.base}{resource_type}/{len(self.bundles)}-{idx}/_history/1"}})
+        return {"status_code": 200, "response": {"resourceType": "Bundle", "entry": entries}}
+
+@pytest.mark.parametrize("base", ["", "http://host/fhir/"])
+def test_bundle_ids(base):
+    fhir = BundleFhir(base)
+    loader = BundleLoader(fhir, max_bytes=250)
+    results = [loader.add("ValueSet", {"resourceType": "ValueSet", "url": f"http://example.org/vs/{idx}"}) for idx in range(4)]
+    loader.finish()
+
+    # Bundles go out as they fill, and the resources aren't kept once loaded
+    assert len(fhir.bundles) > 1
+    assert sum(len(bundle['entry']) for bundle in fhir.bundles) == 4
+    assert all(result.id is not None and "/" not in result.id for result in results)
+    assert all(result.resource is None for result in results)
+    assert results[0].reference() == {"resourceType": "ValueSet", "url": "http://example.org/vs/0", "id": "1-0"}
+
+class BusyFhir:
+    """Answers with each of the statuses in turn, then 201 from there on"""
+    def __init__(self, *statuses):
+        self.statuses = list(statuses)
+        self.calls = 0
+
+    def load(self, resource_type, resource):
+        self.calls += 1
+        status = self.statuses.pop(0) if len(self.statuses) > 0 else 201
+        if isinstance(status, Exception):
+            raise status
+        return {"status_code": status, "response": {"id": "1"}}
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    delays = []
+    monkeypatch.setattr(ddent.loaders.time, "sleep", delays.append)
+    return delays
+
+RESOURCE = {"resourceType": "ValueSet", "url": "http://example.org/vs"}
+
+def test_busy_server_is_retried(sleeps):
+    fhir = BusyFhir(503, 429)
+    uploader = UploadExecutor(fhir, backoff=0.5)
+    assert uploader.load("ValueSet", RESOURCE)['status_code'] == 201
+    assert fhir.calls == 3
+    assert sleeps == [0.5, 1.0]
+    assert (uploader.uploaded, uploader.retried) == (1, 2)
+
+def test_retries_run_out(sleeps):
+    fhir = BusyFhir(502, 504, 503, 503, 503)
+    uploader = UploadExecutor(fhir, retries=3, backoff=1.0)
+    assert uploader.load("ValueSet", RESOURCE)['status_code'] == 503
+    assert fhir.calls == 4
+    assert sleeps == [1.0, 2.0, 4.0]
+
+def test_errors_are_not_retried(sleeps):
+    fhir = BusyFhir(500)
+    uploader = UploadExecutor(fhir)
+    assert uploader.load("ValueSet", RESOURCE)['status_code'] == 500
+    assert fhir.calls == 1
+    assert sleeps == []
+
+def test_connection_errors(sleeps):
+    fhir = BusyFhir(requests.exceptions.ConnectionError("refused"), 201)
+    assert UploadExecutor(fhir).load("ValueSet", RESOURCE)['status_code'] == 201
+    assert fhir.calls == 2
+
+    fhir = BusyFhir(*[requests.exceptions.ConnectionError("refused")] * 3)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        UploadExecutor(fhir, retries=2).load("ValueSet", RESOURCE)
+    assert fhir.calls == 3
+
+def test_patch_without_client_support():
+    assert UploadExecutor(BusyFhir()).patch("CodeSystem", "1", []) is None
+
+def test_submit_blocks_when_full():
+    uploader = UploadExecutor(BusyFhir(), workers=1, max_pending=2)
+    release = threading.Event()
+    futures = [uploader.submit(release.wait) for i in range(2)]
+
+    submitted = threading.Event()
+    def submit_another():
+        futures.append(uploader.submit(release.wait))
+        submitted.set()
+    producer = threading.Thread(target=submit_another)
+    producer.start()
+
+    assert not submitted.wait(0.2)
+    release.set()
+    assert submitted.wait(5)
+    producer.join()
+    for future in futures:
+        future.result(timeout=5)
+    uploader.shutdown()
+
+def test_parallel_loader():
+    uploader = UploadExecutor(BusyFhir(503), backoff=0.0)
+    loader = ParallelLoader(uploader)
+    results = [loader.add("ValueSet", {"resourceType": "ValueSet", "url": f"http://example.org/vs/{idx}"}) for idx in range(5)]
+    loader.finish()
+    uploader.shutdown()
+    assert [result.status_code for result in results] == [201] * 5
+    assert uploader.retried == 1
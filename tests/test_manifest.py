@@ -0,0 +1,103 @@
+import ddent.terminologies
+from ddent.ddent import transform_dd_codesystem
+from ddent.manifest import IngestManifest, fingerprint, unversioned
+from ddent.nlp import NlpBase, NlpResult
+
+UMLS_URL = "http://terminology.hl7.org/CodeSystem/umls"
+
+def variable(code, definition, display="Variable"):
+    return {"code": code, "display": display, "definition": definition}
+
+def asthma(text):
+    start = text.lower().index("asthma")
+    return [NlpResult({"system": UMLS_URL, "code": "C0004096", "display": "Asthma"}, start, start + 6, text)]
+
+def test_unversioned():
+    assert unversioned("phs000888.v1.p1") == "phs000888"
+    assert unversioned("phv00054119.v12") == "phv00054119"
+    assert unversioned("phs000888") == "phs000888"
+
+def test_fingerprint():
+    entry = variable("phv00054119.v1.p1", "History of asthma")
+    assert fingerprint(entry) == fingerprint(variable("phv00054119.v2.p1", "History  of\tasthma "))
+    assert fingerprint(entry) != fingerprint(variable("phv00054119.v1.p1", "History of asthma", display="Other"))
+    assert fingerprint(entry) != fingerprint(variable("phv00054119.v1.p1", "History of Asthma"))
+    assert fingerprint(entry) != fingerprint(variable("phv00054120.v1.p1", "History of asthma"))
+
+def test_nothing_recorded():
+    manifest = IngestManifest(":memory:")
+    assert manifest.carry_forward("phs000001.v1.p1", [variable("phv1.v1.p1", "Asthma")]) == [None]
+    assert (manifest.reused, manifest.changed) == (0, 1)
+
+def test_version_bump_carries_forward():
+    manifest = IngestManifest(":memory:")
+    v1 = [variable("phv00000001.v1.p1", "History of asthma"), variable("phv00000002.v1.p1", "Age")]
+    manifest.record("phs000001.v1.p1", v1, [asthma("History of asthma"), []])
+
+    # Same definitions, new version of both the study and its variables
+    v2 = [variable("phv00000001.v2.p1", "History of  asthma"), variable("phv00000002.v2.p1", "Age")]
+    carried = manifest.carry_forward("phs000001.v2.p1", v2)
+    assert [result.cui for result in carried[0]] == ["C0004096"]
+    assert carried[0][0].matched_text == "asthma"
+    assert carried[0][0].source_text == "History of asthma"
+    assert carried[1] == []
+    assert (manifest.reused, manifest.changed) == (2, 0)
+
+def test_changed_definition_is_ingested_again():
+    manifest = IngestManifest(":memory:")
+    manifest.record("phs000001.v1.p1", [variable("phv00000001.v1.p1", "History of asthma")], [asthma("History of asthma")])
+
+    carried = manifest.carry_forward("phs000001.v2.p1", [variable("phv00000001.v2.p1", "Childhood asthma"), variable("phv00000003.v1.p1", "Asthma")])
+    assert carried == [None, None]
+    assert manifest.changed == 2
+
+    # Each study is recorded separately
+    assert manifest.carry_forward("phs000002.v1.p1", [variable("phv00000001.v1.p1", "History of asthma")]) == [None]
+
+class CountingNlp(NlpBase):
+    def __init__(self):
+        super().__init__({})
+        self.endpoint = "http://nlp"
+        self.submitted = []
+
+    def get_cuis(self, text, resolve=True):
+        self.submitted.append(text)
+        return asthma(text) if "asthma" in text.lower() else []
+
+class AcceptingFhir:
+    def __init__(self):
+        self.loaded = []
+
+    def load(self, resource_type, resource):
+        self.loaded.append(resource_type)
+        return {"status_code": 201, "response": {"id": str(len(self.loaded))}}
+
+def test_unchanged_study_is_skipped(monkeypatch):
+    umls = ddent.terminologies._systems_by_name["UMLS"]
+    monkeypatch.setattr(umls, "codes", {})
+    monkeypatch.setattr(umls, "pending", [])
+    monkeypatch.setattr(umls, "resource_id", None)
+    monkeypatch.setattr(umls, "pushed", 0)
+
+    manifest = IngestManifest(":memory:")
+    def ingest(version):
+        codesystem = {
+            "resourceType": "CodeSystem",
+            "url": f"https://example.org/phs000001.{version}/table",
+            "name": "table",
+            "concept": [variable(f"phv00000001.{version}.p1", "History of asthma"), variable(f"phv00000002.{version}.p1", "Age")]
+        }
+        nlp = CountingNlp()
+        fhir = AcceptingFhir()
+        output = transform_dd_codesystem(f"phs000001.{version}.p1", "Study", "Study", [codesystem], nlp, fhir, manifest=manifest)
+        return nlp, fhir, output
+
+    nlp, fhir, output = ingest("v1")
+    assert nlp.submitted == ["History of asthma", "Age"]
+
+    # The mappings still come out the same, without anything going to NLP
+    nlp, fhir, output = ingest("v2")
+    assert nlp.submitted == []
+    assert manifest.reused == 2
+    assert "ConceptMap" in fhir.loaded
+    assert list(output.codesystems['DD']) == ["https://example.org/phs000001.v2/table"]
@@ -0,0 +1,74 @@
+import random
+from collections import defaultdict
+
+from ddent.mappings import Interner, MappingIndex
+
+def random_edges(seed, count=2000):
+    rng = random.Random(seed)
+    tables = [f"http://example.org/CodeSystem/pht{idx:06d}" for idx in range(5)]
+    systems = ["http://terminology.hl7.org/CodeSystem/umls", "http://snomed.info/sct"]
+    # Duplicate edges are expected, since a CUI may be found more than once
+    # in the same definition
+    return [(rng.choice(tables), rng.choice(systems), f"phv{rng.randrange(300):08d}", f"C{rng.randrange(150):07d}") for idx in range(count)]
+
+def reference(edges):
+    """The dict of sets MappingIndex replaces"""
+    forward = defaultdict(lambda: defaultdict(set))
+    reverse = defaultdict(lambda: defaultdict(set))
+    for table, system, code, cui in edges:
+        forward[(table, system)][code].add(cui)
+        reverse[(table, system)][cui].add(code)
+    return forward, reverse
+
+def as_dict(groups):
+    result = {}
+    for table, system, elements in groups:
+        rows = {}
+        for source, targets in elements:
+            assert source not in rows
+            assert len(targets) == len(set(targets))
+            rows[source] = set(targets)
+        result[(table, system)] = rows
+    return result
+
+def test_interner():
+    interner = Interner()
+    assert [interner(value) for value in ["b", "a", "b", "c", "a"]] == [0, 1, 0, 2, 1]
+    assert [interner[id] for id in range(len(interner))] == ["b", "a", "c"]
+
+def test_matches_reference():
+    for seed in range(5):
+        edges = random_edges(seed)
+        index = MappingIndex()
+        for edge in edges:
+            index.add(*edge)
+
+        forward, reverse = reference(edges)
+        assert as_dict(index.dd_to_cui()) == forward
+        assert as_dict(index.cui_to_dd()) == reverse
+
+def test_order():
+    """Groups, rows and targets come out in the order they were first added"""
+    index = MappingIndex()
+    index.add("t2", "umls", "v2", "C2")
+    index.add("t1", "umls", "v1", "C3")
+    index.add("t2", "umls", "v1", "C1")
+    index.add("t2", "umls", "v2", "C1")
+    index.add("t2", "umls", "v2", "C2")
+
+    assert [(table, system, list(elements)) for table, system, elements in index.dd_to_cui()] == [
+        ("t2", "umls", [("v2", ["C2", "C1"]), ("v1", ["C1"])]),
+        ("t1", "umls", [("v1", ["C3"])])
+    ]
+    assert [(table, system, list(elements)) for table, system, elements in index.cui_to_dd()] == [
+        ("t2", "umls", [("C2", ["v2"]), ("C1", ["v2", "v1"])]),
+        ("t1", "umls", [("C3", ["v1"])])
+    ]
+
+def test_add_after_building():
+    index = MappingIndex()
+    index.add("t1", "umls", "v1", "C1")
+    list(index.dd_to_cui())
+    index.add("t1", "umls", "v2", "C1")
+    assert as_dict(index.cui_to_dd()) == {("t1", "umls"): {"C1": {"v1", "v2"}}}
+    assert as_dict(index.dd_to_cui()) == {("t1", "umls"): {"v1": {"C1"}, "v2": {"C1"}}}
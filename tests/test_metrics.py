@@ -0,0 +1,88 @@
+import json
+
+import ddent.metrics
+from ddent.metrics import Metrics, Histogram, emit, metrics_output
+
+def test_counters():
+    m = Metrics()
+    m.incr("requests", service="fhir")
+    m.incr("requests", 2, service="fhir")
+    m.incr("requests", service="clamp")
+    m.incr("studies")
+
+    lines = m.prometheus().splitlines()
+    assert lines[:4] == [
+        "# TYPE ddent_requests_total counter",
+        'ddent_requests_total{service="clamp"} 1',
+        'ddent_requests_total{service="fhir"} 3',
+        "# TYPE ddent_studies_total counter",
+    ]
+    assert lines[4] == "ddent_studies_total 1"
+    assert m.snapshot()['counters'] == {"requests": {"service=clamp": 1, "service=fhir": 3}, "studies": 1}
+
+def test_label_escaping():
+    m = Metrics()
+    m.incr("errors", url='http://host/"quoted"\\path\nnext')
+    m.cache('odd "cache"', True)
+    m.uploaded('Code\\System', 10)
+
+    text = m.prometheus()
+    assert 'ddent_errors_total{url="http://host/\\"quoted\\"\\\\path\\nnext"} 1' in text
+    assert 'ddent_cache_hits_total{cache="odd \\"cache\\""} 1' in text
+    assert 'ddent_uploaded_bytes_total{resource_type="Code\\\\System"} 10' in text
+    # Every sample is on its own line
+    assert all(line.startswith("ddent_") or line.startswith("# TYPE") for line in text.splitlines())
+
+def test_histogram_format():
+    m = Metrics()
+    for seconds in [0.003, 0.02, 0.02, 400.0]:
+        m.observe("request_seconds", seconds, service="fhir")
+
+    lines = [line for line in m.prometheus().splitlines() if "request_seconds" in line]
+    assert lines[0] == "# TYPE ddent_request_seconds histogram"
+    buckets = lines[1:-2]
+    assert buckets[0] == 'ddent_request_seconds_bucket{service="fhir",le="0.001"} 0'
+    assert buckets[1] == 'ddent_request_seconds_bucket{service="fhir",le="0.005"} 1'
+    assert buckets[3] == 'ddent_request_seconds_bucket{service="fhir",le="0.025"} 3'
+    assert buckets[-2] == 'ddent_request_seconds_bucket{service="fhir",le="300.0"} 3'
+    assert buckets[-1] == 'ddent_request_seconds_bucket{service="fhir",le="+Inf"} 4'
+    assert len(buckets) == len(ddent.metrics.DEFAULT_BUCKETS) + 1
+    assert lines[-2] == f'ddent_request_seconds_sum{{service="fhir"}} {0.003 + 0.02 + 0.02 + 400.0}'
+    assert lines[-1] == 'ddent_request_seconds_count{service="fhir"} 4'
+
+def test_histogram_quantiles():
+    histogram = Histogram()
+    assert histogram.quantile(0.5) == 0.0
+    for seconds in [0.02] * 19 + [400.0]:
+        histogram.observe(seconds)
+    assert histogram.to_dict() == {"count": 20, "sum": 400.38, "mean": 20.019, "p50": 0.025, "p95": 0.025, "max": 400.0}
+    assert histogram.quantile(1.0) == 400.0
+
+def test_json_round_trip(tmp_path, monkeypatch):
+    m = Metrics()
+    monkeypatch.setattr(ddent.metrics, "_metrics", m)
+    m.incr("request_errors", service="fhir")
+    m.observe("stage_seconds", 0.5, stage="nlp")
+    m.cache("nlp", True)
+    m.cache("nlp", False)
+    m.uploaded("ConceptMap", 2048)
+    m.study_done("phs000001.v1.p1", 100, 4.0)
+
+    report = tmp_path / "report.json"
+    prometheus = tmp_path / "metrics.prom"
+    metrics_output(report=str(report), prometheus=str(prometheus))
+    try:
+        emit()
+    finally:
+        metrics_output()
+
+    snapshot = json.loads(report.read_text())
+    assert snapshot == json.loads(json.dumps(m.snapshot())) | {"elapsed": snapshot['elapsed'], "variables_per_second": snapshot['variables_per_second']}
+    assert snapshot['counters'] == {"request_errors": {"service=fhir": 1}, "studies": 1, "variables": 100}
+    assert snapshot['latency']['stage_seconds']['stage=nlp']['count'] == 1
+    assert snapshot['caches'] == {"nlp": {"hits": 1, "misses": 1, "hit_rate": 0.5}}
+    assert snapshot['uploads'] == {"ConceptMap": {"resources": 1, "bytes": 2048}}
+    assert snapshot['studies'] == [{"accession": "phs000001.v1.p1", "variables": 100, "seconds": 4.0, "variables_per_second": 25.0}]
+    assert prometheus.read_text().startswith("# TYPE ddent_request_errors_total counter\n")
+    # Nothing partially written is left behind
+    assert sorted(tmp_path.iterdir()) == sorted([report, prometheus])
@@ -0,0 +1,41 @@
+import pytest
+import requests
+
+from ddent.mirror import Mirror
+
+class StreamedResponse:
+    def __init__(self, chunks, fail_after=None):
+        self.status_code = 200
+        self.headers = {"ETag": '"1"'}
+        self.chunks = chunks
+        self.fail_after = fail_after
+
+    def iter_content(self, chunk_size):
+        for idx, chunk in enumerate(self.chunks):
+            if idx == self.fail_after:
+                raise requests.exceptions.ChunkedEncodingError("Connection broken")
+            yield chunk
+
+def leftovers(mirror):
+    return list(mirror.objects.glob("*.tmp"))
+
+def test_store(tmp_path):
+    mirror = Mirror(tmp_path)
+    url = "https://example.org/phs000001.v1.p1/table.xml"
+    response = mirror.get(url, lambda url, headers, stream: StreamedResponse([b"<data", b"/>"]))
+    assert response.content == b"<data/>"
+
+    # The same content under another URL is only stored once
+    mirror.get("https://example.org/other.xml", lambda url, headers, stream: StreamedResponse([b"<data/>"]))
+    assert len(list(mirror.objects.glob("*/*.gz"))) == 1
+    assert leftovers(mirror) == []
+
+def test_failed_download_leaves_nothing_behind(tmp_path):
+    mirror = Mirror(tmp_path)
+    url = "https://example.org/phs000001.v1.p1/table.xml"
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        mirror.get(url, lambda url, headers, stream: StreamedResponse([b"<data", b"/>"], fail_after=1))
+
+    assert leftovers(mirror) == []
+    assert list(mirror.objects.glob("*/*.gz")) == []
+    assert mirror._entry(url) is None
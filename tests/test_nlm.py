@@ -0,0 +1,88 @@
+import itertools
+import threading
+import time
+
+import pytest
+
+import ddent.nlm
+from ddent.nlm import NlmApi, UtsResponseWarning
+
+class FakeResponse:
+    def __init__(self, content):
+        self.content = content
+        self.text = str(content)
+
+    def json(self):
+        return self.content
+
+def uts(monkeypatch, content):
+    api = NlmApi("key", ticket_pool_size=0)
+    monkeypatch.setattr(api, "_get", lambda url: FakeResponse(content))
+    return api
+
+def test_get_cui(monkeypatch):
+    api = uts(monkeypatch, {"result": {"ui": "C0004096", "name": "Asthma"}})
+    assert api.get_cui("C0004096", "asthma")['display'] == "Asthma"
+
+def test_get_cui_unexpected_response(monkeypatch):
+    api = uts(monkeypatch, {"result": {"ui": "C0004096"}})
+    with pytest.warns(UtsResponseWarning):
+        concept = api.get_cui("C0004096", "asthma")
+    assert concept == {
+        "system": "http://terminology.hl7.org/CodeSystem/umls",
+        "code": "C0004096",
+        "display": "No Matching Concept Found For 'asthma'"
+    }
+
+def ticket_office(monkeypatch, api):
+    """UTS hands out numbered tickets"""
+    numbers = itertools.count(1)
+    monkeypatch.setattr(api, "request_service_ticket", lambda: (f"ST-{next(numbers)}", "response"))
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+def test_service_tickets_are_prefetched(monkeypatch):
+    api = NlmApi("key", ticket_pool_size=4)
+    ticket_office(monkeypatch, api)
+
+    first = api.get_service_ticket()
+    wait_for(api.tickets.full)
+
+    # Straight from the queue, so there's no response, and the queue is
+    # topped back off afterward
+    tickets = [api.get_service_ticket() for i in range(4)]
+    assert [response for ticket, response in tickets] == [None] * 4
+    wait_for(api.tickets.full)
+    tickets.append(first)
+    assert len(set(ticket for ticket, response in tickets)) == 5
+
+def test_stale_tickets_are_tossed(monkeypatch):
+    api = NlmApi("key", ticket_pool_size=4)
+    ticket_office(monkeypatch, api)
+    api.ticket_thread = "not started"
+    api.tickets.put(("ST-old", time.time() - ddent.nlm._service_ticket_lifetime - 1))
+
+    assert api.get_service_ticket() == ("ST-1", "response")
+    assert api.tickets.empty()
+
+def test_one_prefetch_thread(monkeypatch):
+    started = []
+    class SlowThread(threading.Thread):
+        def __init__(self, *args, **kwargs):
+            time.sleep(0.05)
+            super().__init__(*args, **kwargs)
+            started.append(self)
+    monkeypatch.setattr(ddent.nlm, "Thread", SlowThread)
+
+    api = NlmApi("key", ticket_pool_size=4)
+    ticket_office(monkeypatch, api)
+    callers = [threading.Thread(target=api.get_service_ticket) for i in range(8)]
+    for caller in callers:
+        caller.start()
+    for caller in callers:
+        caller.join()
+    assert len(started) == 1
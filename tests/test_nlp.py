@@ -0,0 +1,83 @@
+import re
+import threading
+import time
+
+import pytest
+
+from ddent.nlp import NlpBase, NlpResult, extract_cuis
+
+UMLS_URL = "http://terminology.hl7.org/CodeSystem/umls"
+
+class SlowNlp(NlpBase):
+    """Finds "asthma" wherever it appears. The earlier a text is submitted,
+    the longer it takes, so the responses come back in reverse order"""
+    def __init__(self, count):
+        super().__init__({})
+        self.endpoint = "http://nlp"
+        self.count = count
+        self.submitted = []
+        self.finished = []
+        self.lock = threading.Lock()
+
+    def extract(self, text):
+        with self.lock:
+            position = len(self.submitted)
+            self.submitted.append(text)
+        time.sleep(0.002 * (self.count - position))
+        with self.lock:
+            self.finished.append(text)
+        match = re.search("asthma", text, re.IGNORECASE)
+        return [] if match is None else [list(match.span())]
+
+    def build_results(self, payload, text, resolve=True):
+        return [NlpResult({"system": UMLS_URL, "code": "C0004096", "display": "Asthma"}, start, end, text) for start, end in payload]
+
+@pytest.mark.parametrize("batch_size", [1, 3])
+def test_order_with_workers(batch_size):
+    texts = [f"Variable {i}" + (" asthma" if i % 3 == 0 else "") for i in range(12)]
+    nlp = SlowNlp(len(texts))
+    results = extract_cuis(nlp, texts, workers=4, batch_size=batch_size)
+
+    assert nlp.finished != nlp.submitted
+    assert [[cui.source_text for cui in cuis] for cuis in results] == [[text] if "asthma" in text else [] for text in texts]
+
+def test_duplicates_share_results():
+    texts = ["History of asthma", "history of  ASTHMA ", "", "Age", "History of asthma", "   ", "AGE", "History\tof Asthma"]
+    nlp = SlowNlp(len(texts))
+    results = extract_cuis(nlp, texts, workers=3)
+
+    # Only the first copy of each is submitted, and empty texts not at all
+    assert sorted(nlp.submitted) == ["Age", "History of asthma"]
+    assert [len(cuis) for cuis in results] == [1, 1, 0, 0, 1, 0, 0, 1]
+
+    # Each copy gets results matched against its own text
+    for text, cuis in zip(texts, results):
+        for cui in cuis:
+            assert cui.source_text == " ".join(text.split())
+            assert (cui.start_loc, cui.end_loc) == (11, 17)
+            assert cui.matched_text == text.split()[-1]
+    assert results[0][0] is results[4][0]
+    assert results[1][0].matched_text == "ASTHMA"
+    assert results[0][0].matched_text == "asthma"
+
+def test_no_dedupe():
+    texts = ["Asthma", "asthma", "Asthma"]
+    nlp = SlowNlp(len(texts))
+    results = extract_cuis(nlp, texts, workers=2, dedupe=False)
+    assert sorted(nlp.submitted) == sorted(texts)
+    assert [cuis[0].matched_text for cuis in results] == texts
+
+def test_length_changing_case_is_not_shared():
+    # "İ".lower() is two characters, so the offsets wouldn't line up
+    texts = ["İstanbul asthma", "i̇stanbul asthma"]
+    nlp = SlowNlp(len(texts))
+    results = extract_cuis(nlp, texts)
+    assert len(nlp.submitted) == 2
+    assert [cuis[0].matched_text for cuis in results] == ["asthma", "asthma"]
+
+def test_rebase():
+    result = NlpResult({"system": UMLS_URL, "code": "C0004096", "display": "Asthma"}, 11, 17, "history of asthma", semantics="T047")
+    rebased = result.rebase("History of ASTHMA")
+    assert (rebased.source_text, rebased.matched_text) == ("History of ASTHMA", "ASTHMA")
+    assert (rebased.start_loc, rebased.end_loc, rebased.semantics, rebased.concept) == (11, 17, "T047", result.concept)
+    assert (result.source_text, result.matched_text) == ("history of asthma", "asthma")
@@ -0,0 +1,49 @@
+import ddent.nlp.cache
+from ddent.nlp.cache import NlpCache
+
+def last_used(cache, text):
+    key = NlpCache.key("nlp_clamp", "http://clamp", text)
+    return cache.db.execute("SELECT last_used FROM nlp_results WHERE key=?", (key,)).fetchone()[0]
+
+def test_hits(tmp_path):
+    cache = NlpCache(str(tmp_path / "cache.db"))
+    cache.put("nlp_clamp", "http://clamp", "asthma", [{"CUI": "C0004096"}])
+    assert cache.get("nlp_clamp", "http://clamp", "asthma") == [{"CUI": "C0004096"}]
+    assert cache.get("nlp_clamp", "http://other", "asthma") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+def test_hits_are_written_in_batches(tmp_path, monkeypatch):
+    monkeypatch.setattr(ddent.nlp.cache, "_touch_batch", 3)
+    cache = NlpCache(str(tmp_path / "cache.db"))
+    for text in ["a", "b", "c"]:
+        cache.put("nlp_clamp", "http://clamp", text, [])
+    stored = last_used(cache, "a")
+
+    cache.get("nlp_clamp", "http://clamp", "a")
+    cache.get("nlp_clamp", "http://clamp", "a")
+    cache.get("nlp_clamp", "http://clamp", "b")
+    assert last_used(cache, "a") == stored
+    cache.get("nlp_clamp", "http://clamp", "c")
+    assert last_used(cache, "a") > stored
+    assert cache.touched == {}
+
+def test_eviction_sees_recent_hits(tmp_path):
+    """a was put first, but has been used since, so b is evicted instead"""
+    cache = NlpCache(str(tmp_path / "cache.db"), max_size=30)
+    cache.put("nlp_clamp", "http://clamp", "a", ["x" * 8])
+    cache.put("nlp_clamp", "http://clamp", "b", ["x" * 8])
+    assert cache.get("nlp_clamp", "http://clamp", "a") is not None
+
+    cache.put("nlp_clamp", "http://clamp", "c", ["x" * 8])
+    assert cache.get("nlp_clamp", "http://clamp", "a") is not None
+    assert cache.get("nlp_clamp", "http://clamp", "b") is None
+
+def test_close_writes_hits(tmp_path):
+    filename = str(tmp_path / "cache.db")
+    cache = NlpCache(filename)
+    cache.put("nlp_clamp", "http://clamp", "a", [])
+    stored = last_used(cache, "a")
+    cache.get("nlp_clamp", "http://clamp", "a")
+    cache.close()
+
+    assert last_used(NlpCache(filename), "a") > stored
@@ -0,0 +1,84 @@
+import re
+
+import pytest
+
+import ddent.nlp.nlp_clamp
+from ddent.nlp.nlp_clamp import NlpClamp, BATCH_SEPARATOR
+
+TERMS = {"asthma": "C0004096", "heart rate": "C0018810", "a&b": "C0000001"}
+
+class FakeResponse:
+    def __init__(self, results):
+        self.status_code = 200
+        self.results = results
+
+    def json(self):
+        return {"Results": self.results}
+
+@pytest.fixture
+def clamp(monkeypatch):
+    """CLAMP, with the server replaced by a search for TERMS. Each text it is
+    sent is kept in sent"""
+    sent = []
+
+    def get(url, params=None, timeout=None):
+        assert "?" not in url, "The text must go in params so it is encoded"
+        text = params['text']
+        sent.append(text)
+        results = []
+        for term, cui in TERMS.items():
+            for match in re.finditer(re.escape(term), text):
+                results.append({"CUI": cui, "Location_Start": match.start(), "Location_End": match.end(),
+                                "Semantics": None, "Assertion": None, "Entity": None})
+        return FakeResponse(results)
+
+    monkeypatch.setattr(ddent.nlp.nlp_clamp.requests, "get", get)
+    module = NlpClamp({"CLAMP": {"endpoint": "http://clamp"}})
+    module.sent = sent
+    return module
+
+def locations(payload):
+    return [(result['CUI'], result['Location_Start'], result['Location_End']) for result in payload]
+
+def test_text_is_sent_intact(clamp):
+    text = "a&b #1 + 50% asthma"
+    assert locations(clamp.extract(text)) == [("C0004096", 13, 19), ("C0000001", 0, 3)]
+    assert clamp.sent == [text]
+
+def test_batch_locations_match_single_requests(clamp):
+    texts = ["asthma", "Resting heart rate", "no concepts", "asthma and heart rate", "a&b #2 heart rate"]
+    batch = clamp.extract_batch(texts)
+    assert len(clamp.sent) == 1
+    assert clamp.sent[0] == BATCH_SEPARATOR.join(texts)
+
+    for text, payload in zip(texts, batch):
+        assert locations(payload) == locations(clamp.extract(text))
+        for cui, start, end in locations(payload):
+            assert text[start:end] in TERMS
+
+def test_results_spanning_texts_are_dropped(clamp):
+    # With the separator, "heart" and "rate" end up on either side of it
+    TERMS["heart\n\nrate"] = "C9999999"
+    try:
+        batch = clamp.extract_batch(["heart", "rate"])
+    finally:
+        del TERMS["heart\n\nrate"]
+    assert batch == [[], []]
+
+def test_pack(clamp, monkeypatch):
+    monkeypatch.setattr(ddent.nlp.nlp_clamp, "MAX_BATCH_BYTES", 10)
+    groups = list(clamp.pack(["abcd", "efg", "hijklmnopq", "r"]))
+    assert groups == [["abcd", "efg"], ["hijklmnopq"], ["r"]]
+
+def test_pack_measures_encoded_size(clamp, monkeypatch):
+    monkeypatch.setattr(ddent.nlp.nlp_clamp, "MAX_BATCH_BYTES", 10)
+    # "ßßßß" is four characters but eight bytes, so nothing else fits with it
+    groups = list(clamp.pack(["ßßßß", "ab", "éé", "cd"]))
+    assert groups == [["ßßßß"], ["ab", "éé"], ["cd"]]
+
+def test_packed_requests_fit(clamp):
+    texts = ["naïve café", "Größe in cm", "asthma"] * 500
+    groups = list(clamp.pack(texts))
+    assert [text for group in groups for text in group] == texts
+    for group in groups:
+        assert len(BATCH_SEPARATOR.join(group).encode("utf-8")) <= ddent.nlp.nlp_clamp.MAX_BATCH_BYTES
@@ -0,0 +1,122 @@
+import random
+
+import pytest
+
+import ddent.terminologies
+from ddent.nlp import extract_cuis
+from ddent.nlp.nlp_dictionary import TermAutomaton, NlpDictionary, tokenize, MIN_POOL_BATCH
+
+TERMS = [
+    ("C0000001", "heart", None),
+    ("C0000002", "heart rate", "T201"),
+    ("C0000003", "rate variability", None),
+    ("C0000004", "blood pressure", "T201"),
+    ("C0000005", "high blood pressure", "T047"),
+    ("C0000006", "pressure", None),
+    ("C0000007", "a b c d", None),
+    ("C0000008", "b c", None),
+]
+
+def naive_matches(terms, text):
+    """Every occurrence of every term, then the longest leftmost of those that
+    don't overlap, as (start, end, cuis)"""
+    tokens = tokenize(text)
+    words = [token for token, start, end in tokens]
+
+    found = {}                  # (first token, last token) => [cuis]
+    for cui, term, semantics in terms:
+        term_words = [token for token, start, end in tokenize(term)]
+        for first in range(len(words) - len(term_words) + 1):
+            if words[first:first + len(term_words)] == term_words:
+                found.setdefault((first, first + len(term_words) - 1), []).append(cui)
+
+    result = []
+    covered = -1
+    for first, last in sorted(found, key=lambda span: (span[0], span[0] - span[1])):
+        if first > covered:
+            result.append((tokens[first][1], tokens[last][2], sorted(found[(first, last)])))
+            covered = last
+    return result
+
+def automaton_matches(automaton, text):
+    return [(start, end, sorted(cui for cui, semantics in concepts)) for start, end, concepts in automaton.matches(text)]
+
+@pytest.mark.parametrize("text", [
+    "Heart rate and blood pressure",
+    "heart rate variability",               # overlapping terms
+    "high blood pressure",                  # nested terms
+    "heart heart rate pressure",            # adjacent terms
+    "a b c x",                              # only found through a fail link
+    "a b c d",
+    "no terms here",
+    ""
+])
+def test_matches_naive_scan(text):
+    automaton = TermAutomaton(TERMS, min_length=1)
+    assert automaton_matches(automaton, text) == naive_matches(TERMS, text)
+
+def test_matches_naive_scan_random():
+    rng = random.Random(17)
+    vocabulary = ["a", "b", "c", "d", "e"]
+    terms = []
+    for idx in range(40):
+        term = " ".join(rng.choice(vocabulary) for word in range(rng.randint(1, 4)))
+        terms.append((f"C{idx:07d}", term, None))
+    automaton = TermAutomaton(terms, min_length=1)
+
+    for trial in range(200):
+        text = " ".join(rng.choice(vocabulary) for word in range(rng.randint(0, 12)))
+        assert automaton_matches(automaton, text) == naive_matches(terms, text)
+
+def test_min_length():
+    automaton = TermAutomaton([("C0000001", "of", None), ("C0000002", "heart", None)], min_length=3)
+    assert automaton_matches(automaton, "rate of heart") == [(8, 13, ["C0000002"])]
+
+@pytest.fixture
+def dictionary(tmp_path, monkeypatch):
+    """The dictionary module over TERMS, with UMLS lookups that fail the test"""
+    def no_lookups(cui, source):
+        raise AssertionError(f"{cui} was looked up remotely")
+
+    for system in ddent.terminologies._external_systems:
+        monkeypatch.setattr(system, "display_source", no_lookups)
+        monkeypatch.setattr(system, "bulk_source", None)
+        monkeypatch.setattr(system, "codes", {})
+        monkeypatch.setattr(system, "pending", [])
+
+    terms = tmp_path / "terms.tsv"
+    # Alternate names after the preferred one
+    terms.write_text("\n".join(f"{cui}\t{term}\t{semantics or ''}" for cui, term, semantics in TERMS) + "\nC0000002\tpulse\t\n")
+    module = NlpDictionary({"DICTIONARY": {"terms": str(terms), "processes": 2, "min_length": 1}})
+    yield module
+    module.close()
+
+def test_build_results_uses_preferred_term(dictionary):
+    text = "Resting pulse and heart rate"
+    results = dictionary.build_results(dictionary.extract(text), text)
+
+    assert [(result.cui, result.concept['display']) for result in results] == [("C0000002", "heart rate"), ("C0000002", "heart rate")]
+    umls = ddent.terminologies._systems_by_name["UMLS"]
+    assert umls.pending == ["C0000002"]
+
+def test_pool(dictionary):
+    texts = [f"heart rate {idx} and high blood pressure" for idx in range(MIN_POOL_BATCH)]
+    assert dictionary.extract_batch(texts) == [dictionary.extract(text) for text in texts]
+    assert dictionary.pool is not None
+
+    dictionary.close()
+    assert dictionary.pool is None
+
+def test_default_batches_use_the_pool(dictionary):
+    """extract_cuis with the defaults gives the module batches big enough for the pool"""
+    texts = [f"heart rate {idx} and high blood pressure" for idx in range(3 * MIN_POOL_BATCH)]
+    assert dictionary.get_batch_size() >= MIN_POOL_BATCH
+
+    results = extract_cuis(dictionary, texts, workers=4)
+    assert dictionary.pool is not None
+    assert [[result.cui for result in cuis] for cuis in results] == [["C0000002", "C0000005"]] * len(texts)
+
+def test_single_process_batches(tmp_path):
+    terms = tmp_path / "terms.tsv"
+    terms.write_text("C0000002\theart rate\n")
+    assert NlpDictionary({"DICTIONARY": {"terms": str(terms), "processes": 1}}).get_batch_size() == 1
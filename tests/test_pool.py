@@ -0,0 +1,103 @@
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from threading import Barrier
+
+from ddent.nlp.pool import EndpointPool, EndpointFailure
+
+def test_cold_requests_are_spread():
+    """Nothing has been measured yet, so in flight requests decide"""
+    pool = EndpointPool(["a", "b", "c"])
+    barrier = Barrier(9, timeout=10)
+
+    def request(url):
+        barrier.wait()
+        return url
+
+    with ThreadPoolExecutor(max_workers=9) as executor:
+        urls = list(executor.map(lambda idx: pool.request(request), range(9)))
+    assert Counter(urls) == {"a": 3, "b": 3, "c": 3}
+
+def test_unmeasured_endpoint_gets_average_latency():
+    pool = EndpointPool(["a", "b", "c"])
+    pool.endpoints[0].latency = 0.1
+    pool.endpoints[1].latency = 0.3
+
+    # c is assumed to be as fast as the average (0.2), so it beats b
+    assert pool.acquire().url == "a"
+    assert pool.acquire().url == "c"
+
+def test_least_loaded_with_latency():
+    pool = EndpointPool(["slow", "fast"])
+    pool.endpoints[0].latency = 0.3
+    pool.endpoints[1].latency = 0.1
+
+    # With 2 in flight, fast ties with slow (0.3s each) and the tie goes to
+    # the one with fewer in flight
+    assert [pool.acquire().url for idx in range(4)] == ["fast", "fast", "slow", "fast"]
+
+def test_failover():
+    pool = EndpointPool(["a", "b"])
+
+    def request(url):
+        if url == "a":
+            raise EndpointFailure("down")
+        return url
+
+    assert all(pool.request(request) == "b" for idx in range(5))
+    assert pool.endpoints[0].errors > 0
+
+def test_all_endpoints_failing():
+    pool = EndpointPool(["a", "b"])
+
+    def request(url):
+        raise EndpointFailure("down")
+
+    assert pool.request(request) is None
+    assert [endpoint.requests for endpoint in pool.endpoints] == [1, 1]
+
+def test_ejection_and_probation():
+    pool = EndpointPool(["a", "b"], max_failures=2, eject_time=0.2)
+    a, b = pool.endpoints
+    a_up = False
+
+    def request(url):
+        if url == "a" and not a_up:
+            raise EndpointFailure("down")
+        return url
+
+    # Ejected after max_failures in a row (b picks up each of those)
+    for idx in range(2):
+        pool.release(pool.acquire(exclude=["b"]), 0.01, False)
+    assert not a.healthy(time.monotonic())
+    assert a.ejections == 1
+    assert pool.request(request) == "b"
+    assert a.requests == 2
+
+    # Readmitted on probation, where a single failure ejects it for twice as long
+    time.sleep(0.25)
+    assert a.healthy(time.monotonic())
+    b.latency = 10.0
+    assert pool.request(request) == "b"
+    assert a.ejections == 2
+    assert 0.3 < a.ejected_until - time.monotonic() <= 0.4
+
+    # A success on probation restores it
+    time.sleep(0.45)
+    a_up = True
+    assert pool.request(request) == "a"
+    assert a.ejections == 0
+    assert a.failures == 0
+    assert a.healthy(time.monotonic())
+
+def test_all_ejected_uses_first_readmitted():
+    pool = EndpointPool(["a", "b"], eject_time=10)
+    pool.eject("a")
+    time.sleep(0.01)
+    pool.eject("b")
+    assert pool.acquire().url == "a"
+
+def test_probe_ejection():
+    pool = EndpointPool(["a", "b"])
+    pool.eject("a")
+    assert [pool.acquire().url for idx in range(3)] == ["b", "b", "b"]
@@ -0,0 +1,78 @@
+import pytest
+
+from ddent.rrf import RrfIndex, write_index, build_indexes, OfflineTerminology, UMLS_INDEX, SNOMED_INDEX, RXNORM_INDEX
+
+def index(tmp_path, names):
+    filename = tmp_path / "test.idx"
+    write_index(names, filename)
+    return RrfIndex(filename)
+
+def test_round_trip(tmp_path):
+    names = {f"C{i:07}": f"Concept {i}" for i in range(0, 3000, 3)}
+    idx = index(tmp_path, [(code, 0, name) for code, name in reversed(names.items())])
+
+    assert len(idx) == len(names)
+    for code, name in names.items():
+        assert idx.get(code) == name
+
+    # Before the first, after the last and in between the keys
+    assert idx.get("C0000000") == "Concept 0"
+    assert idx.get("C0002997") == "Concept 2997"
+    for code in ["A", "C", "C0000001", "C00000000", "C0001000", "C0002998", "D"]:
+        assert idx.get(code) is None
+
+def test_best_ranked_name(tmp_path):
+    idx = index(tmp_path, [("C1", (1, 0), "Synonym"), ("C1", (0, 1), "Preferred"), ("C1", (0, 2), "Other"), ("C2", (5,), "Only")])
+    assert idx.get("C1") == "Preferred"
+    assert idx.get("C2") == "Only"
+
+def test_utf8(tmp_path):
+    # Sorted by the encoded bytes, which is what the lookups compare
+    idx = index(tmp_path, [("é", 0, "Café au lait"), ("z", 0, "Zed"), ("ß", 0, "Straße")])
+    assert idx.get("é") == "Café au lait"
+    assert idx.get("ß") == "Straße"
+    assert idx.get("z") == "Zed"
+    assert idx.get("e") is None
+
+def test_empty(tmp_path):
+    idx = index(tmp_path, [])
+    assert len(idx) == 0
+    assert idx.get("C0004096") is None
+
+def test_single(tmp_path):
+    idx = index(tmp_path, [("C0004096", 0, "Asthma")])
+    assert idx.get("C0004096") == "Asthma"
+    assert idx.get("C0004095") is None
+    assert idx.get("C0004097") is None
+
+def test_not_an_index(tmp_path):
+    filename = tmp_path / "bogus.idx"
+    filename.write_bytes(b"\0" * 64)
+    with pytest.raises(ValueError):
+        RrfIndex(filename)
+
+def mrconso_row(cui, lat, ts, stt, ispref, sab, tty, code, name, suppress="N"):
+    row = [""] * 18
+    row[0], row[1], row[2], row[4], row[6], row[11], row[12], row[13], row[14], row[16] = cui, lat, ts, stt, ispref, sab, tty, code, name, suppress
+    return "|".join(row) + "|"
+
+def test_build_indexes(tmp_path):
+    mrconso = tmp_path / "MRCONSO.RRF"
+    mrconso.write_text("\n".join([
+        mrconso_row("C0004096", "ENG", "S", "VO", "N", "MSH", "SY", "D001249", "Asthmas"),
+        mrconso_row("C0004096", "ENG", "P", "PF", "Y", "MSH", "MH", "D001249", "Asthma"),
+        mrconso_row("C0004096", "FRE", "P", "PF", "Y", "MSHFRE", "MH", "D001249", "Asthme"),
+        mrconso_row("C0004096", "ENG", "P", "PF", "Y", "SNOMEDCT_US", "SY", "195967001", "Asthma (synonym)"),
+        mrconso_row("C0004096", "ENG", "P", "PF", "Y", "SNOMEDCT_US", "PT", "195967001", "Asthma (disorder)"),
+    ]) + "\n", encoding="utf-8")
+
+    build_indexes(tmp_path, mrconso=mrconso)
+    assert not (tmp_path / RXNORM_INDEX).exists()
+
+    backend = OfflineTerminology(tmp_path)
+    assert backend.has_index(UMLS_INDEX) and backend.has_index(SNOMED_INDEX)
+    assert not backend.has_index(RXNORM_INDEX)
+    assert backend.get_cui("C0004096", "asthma")['display'] == "Asthma"
+    assert backend.get_cui("C0000000", "nothing")['display'] == "No Matching Concept Found For 'nothing'"
+    assert backend.get_snomed("195967001", "asthma")['display'] == "Asthma (disorder)"
+    assert backend.get_snomed("1", "asthma") is None
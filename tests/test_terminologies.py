@@ -0,0 +1,135 @@
+import json
+import threading
+import time
+import warnings
+
+import pytest
+
+import ddent.terminologies
+from ddent.terminologies import ExternalSystem, CuiParseWarning, parse_cui_field, match_terms
+
+@pytest.mark.parametrize("cui_data, codes, leftovers", [
+    ("C0004096", [("UMLS", "C0004096")], []),
+    (" C0004096 , C0018810 ", [("UMLS", "C0004096"), ("UMLS", "C0018810")], []),
+    ("C0004096;\tC0018810\n", [("UMLS", "C0004096"), ("UMLS", "C0018810")], []),
+    ("C0004096,C0004096", [("UMLS", "C0004096")], []),
+    ("SNOMEDCT_US[195967001,195967001] RxNorm=[1234] C0004096", [("SNOMED", "195967001"), ("RxNorm", "1234"), ("UMLS", "C0004096")], []),
+    ("Generic=[5,6]", [("RxNorm", "5"), ("RxNorm", "6")], []),
+    ("SNOMEDCT_US[]", [], []),
+    ("SNOMEDCT_US[,12,]", [("SNOMED", "12")], []),
+    ("null", [], []),
+    ("", [], []),
+    ("   ", [], []),
+    ("C0004096x", [], ["C0004096x"]),
+    ("c0004096", [], ["c0004096"]),
+    ("garbage;C0000001", [("UMLS", "C0000001")], ["garbage"]),
+    ("SNOMEDCT_US[12", [], ["SNOMEDCT_US[12"]),
+    ("nullable", [], ["nullable"]),
+])
+def test_parse_cui_field(cui_data, codes, leftovers):
+    assert parse_cui_field(cui_data) == (tuple(codes), tuple(leftovers))
+
+@pytest.fixture
+def offline_systems(monkeypatch):
+    for system in ddent.terminologies._external_systems:
+        monkeypatch.setattr(system, "display_source", lambda code, source: {"code": code, "display": f"Name of {code}"})
+        monkeypatch.setattr(system, "bulk_source", None)
+        monkeypatch.setattr(system, "rate_limit", None)
+        monkeypatch.setattr(system, "codes", {})
+        monkeypatch.setattr(system, "pending", [])
+
+def test_match_terms_warns_about_leftovers(offline_systems):
+    with pytest.warns(CuiParseWarning) as record:
+        concepts = match_terms({"CUI": "C0004096 bogus"}, "asthma")
+    assert [concept['code'] for concept in concepts] == ["C0004096"]
+    assert len(record) == 1
+    assert record[0].message.leftovers == ("bogus",)
+    assert record[0].message.cui_data == "C0004096 bogus"
+
+def test_match_terms_clean_field_is_quiet(offline_systems):
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        concepts = match_terms({"CUI": " C0004096 ; SNOMEDCT_US[195967001] "}, "asthma")
+    assert [concept['code'] for concept in concepts] == ["C0004096", "195967001"]
+
+class RacingFhir:
+    """Another study adds a code while the push is underway, after the
+    pending codes have been taken but before the full CS is built"""
+    def __init__(self, system):
+        self.system = system
+        self.loaded = []
+        self.patches = []
+
+    def patch(self, resource_type, id, ops):
+        self.patches.append(ops)
+        if len(self.patches) == 1:
+            self.system.add_concept("C0000003", {"code": "C0000003", "display": "Three"})
+            return {"status_code": 500, "response": {}}
+        return {"status_code": 200, "response": {}}
+
+    def load(self, resource_type, resource):
+        self.loaded.append([concept['code'] for concept in resource['concept']])
+        return {"status_code": 201, "response": {"id": "cs"}}
+
+def test_full_push_clears_codes_it_sent():
+    system = ExternalSystem("Test", {"resourceType": "CodeSystem", "url": "http://example.org/cs"})
+    system.resource_id = "cs"
+    system.pushed = 1
+    system.codes["C0000001"] = {"code": "C0000001", "display": "One"}
+    system.add_concept("C0000002", {"code": "C0000002", "display": "Two"})
+    fhir = RacingFhir(system)
+
+    # The delta fails, so everything goes out in the full CS, C0000003 included
+    system.push_current_version(fhir)
+    assert fhir.loaded == [["C0000001", "C0000002", "C0000003"]]
+    assert system.pending == []
+    assert system.pushed == 3
+
+    # ...and isn't appended again by the next delta
+    system.add_concept("C0000004", {"code": "C0000004", "display": "Four"})
+    system.push_current_version(fhir)
+    ops = fhir.patches[-1]
+    assert [op['value']['code'] for op in ops if op['path'] == "/concept/-"] == ["C0000004"]
+    assert ops[-1] == {"op": "add", "path": "/count", "value": 4}
+
+class RecordingFhir:
+    """Keeps what was actually sent, since the CS handed to load could still
+    be changed by someone else afterward"""
+    def __init__(self):
+        self.loaded = []
+        self.lock = threading.Lock()
+
+    def load(self, resource_type, resource):
+        body = json.dumps(resource)
+        time.sleep(0.001)
+        with self.lock:
+            self.loaded.append((resource, json.loads(body)))
+        return {"status_code": 201, "response": {"id": "cs"}}
+
+def test_codesystems_built_while_pushing():
+    """Studies build the terminology CodeSystems (get_codesystems_used) outside
+    of the push lock, while another study may be pushing the same system"""
+    base_cs = {"resourceType": "CodeSystem", "url": "http://example.org/cs"}
+    system = ExternalSystem("Test", base_cs)
+    fhir = RecordingFhir()
+
+    def study(worker):
+        for i in range(30):
+            system.add_concept(f"C{worker}{i:04}", {"code": f"C{worker}{i:04}", "display": f"{worker} {i}"})
+            if worker % 2 == 0:
+                system.push_current_version(fhir, delta=False)
+            else:
+                system.get_codesystem()
+
+    threads = [threading.Thread(target=study, args=(worker,)) for worker in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for resource, sent in fhir.loaded:
+        codes = [concept['code'] for concept in sent['concept']]
+        assert sent['count'] == len(codes)
+        assert len(set(codes)) == len(codes)
+        assert resource == sent
+    assert "concept" not in base_cs